@@ -1 +1,27 @@
+import importlib
+
 __version__ = "0.2.4"
+
+# Submodules are imported on first use, so that importing one part of
+# reclib does not load the rest.
+_submodules = {
+    "columnar",
+    "format",
+    "parse",
+    "progress",
+    "reconcile",
+    "sort",
+    "stats",
+    "util",
+    "validate",
+}
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
@@ -0,0 +1,359 @@
+"""Convert between fixed width and delimited files.
+
+    python -m reclib fw2csv myapp.layouts.ClaimParser claims.txt.gz -o claims.csv
+    python -m reclib csv2fw myapp.layouts.ClaimFormatter claims.csv -o claims.txt
+
+Parsers and formatters are named by dotted path to a class, which is
+created with no arguments, or to an instance. fw2csv reads with a
+fw.Parser and writes a header row and one CSV row per record. csv2fw reads
+a CSV file with a header row, or rows parsed by --parser, a delim.Parser,
+and writes them with a format.fw.Formatter.
+
+Input may be gzip, bz2 or xz compressed. Input and output default to stdin
+and stdout. Files are streamed in chunks, so memory use does not grow with
+the size of the file. With --jobs N, chunks are converted in N processes
+and written in their original order.
+
+With --rejects PATH, records with errors are left out of the output and
+their errors written to PATH as CSV rows of line_no, field, value, message.
+Without it, records that csv2fw cannot format are still left out, and their
+line and error are printed to stderr. A summary is printed to stderr at the
+end, with throughput in bytes of the input as decoded, in its encoding.
+"""
+
+import argparse
+import contextlib
+import csv
+import importlib
+import itertools
+import sys
+import time
+
+from reclib.util import chunks, csv_cell, open_input, ordered_map
+
+
+def load(path):
+    """The object at a dotted path, an instance if the path names a class."""
+    module, _, name = path.rpartition(".")
+    if not module:
+        raise ValueError("%r is not a dotted path" % path)
+    obj = getattr(importlib.import_module(module), name)
+    if isinstance(obj, type):
+        obj = obj()
+    return obj
+
+
+def _error_rows(line_no, errors):
+    rows = []
+    for field, value, msg, col in errors:
+        rows.append((line_no, getattr(field, "name", field), csv_cell(value), msg))
+    return rows
+
+
+class _Rows(list):
+    """Collects the rows given to writerows, copying them."""
+
+    def writerows(self, rows):
+        self.extend(list(r) for r in rows)
+
+
+class FWToCSV(object):
+    """Converts chunks of (line_no, line) into (CSV rows, error rows,
+    record count, rejected count, error count, dropped error rows).
+    fw.Parser.transcode is used when the parser has no post processing
+    hooks and fields are all fields of its layout; otherwise each line is
+    parsed into a Record.
+    """
+
+    def __init__(self, parser, fields=None, reject=False):
+        self.parser = load(parser)
+        self.fields = fields or [f.name for f in self.parser.fields]
+        self.reject = reject
+        self.transcode = _transcodes(self.parser, self.fields)
+
+    def header(self):
+        return self.fields
+
+    def __call__(self, lines):
+        if not self.transcode:
+            return self.convert(lines)
+        out = _Rows()
+        rejects = _Rows() if self.reject else None
+        report = self.parser.transcode(
+            [line for line_no, line in lines], out, rejects, self.fields
+        )
+        errors = []
+        if rejects:
+            offset = lines[0][0] - 1
+            errors = [[row[0] + offset] + row[1:] for row in rejects]
+        rejected = report.error_size if self.reject else 0
+        return out, errors, report.record_count, rejected, report.error_count, []
+
+    def convert(self, lines):
+        parser = self.parser
+        from reclib.parse import rec
+
+        records = [parser.parse_raw(line, line_no) for line_no, line in lines]
+        records = list(rec.post_processed(parser, records))
+        rows = []
+        errors = []
+        rejected = 0
+        for record in records:
+            record_errors = _error_rows(record.line_no, record.errors)
+            if record_errors and self.reject:
+                rejected += 1
+            else:
+                rows.append([csv_cell(record.get(name)) for name in self.fields])
+            errors.extend(record_errors)
+        return rows, errors, len(records), rejected, len(errors), []
+
+
+def _transcodes(parser, fields):
+    """Whether transcode gives what parsing parser would for fields: it
+    does not call post processing hooks or add derived keys.
+    """
+    from reclib.parse import fw
+
+    cls = type(parser)
+    if cls.post_process is not fw.Parser.post_process:
+        return False
+    if cls.post_process_batch is not fw.Parser.post_process_batch:
+        return False
+    names = set(f.name for f in parser.fields)
+    return all(name in names for name in fields)
+
+
+class CSVToFW(object):
+    """Converts chunks of (line_no, CSV row) into (fixed width lines,
+    error rows, record count, rejected count, error count, dropped error
+    rows). A record that cannot be formatted is left out and counted as
+    rejected; without reject, its error row is also dropped, for the
+    caller to report.
+    """
+
+    def __init__(self, formatter, header, parser=None, fields=None,
+                 reject=False):
+        self.formatter = load(formatter)
+        self.parser = load(parser) if parser else None
+        self.header = header
+        self.fields = fields
+        self.reject = reject
+
+    def __call__(self, rows):
+        from reclib.format.fw import Reporter
+        from reclib.parse import delim, rec
+
+        if self.parser is None:
+            records = [dict(zip(self.header, row)) for line_no, row in rows]
+        else:
+            records = []
+            for line_no, row in rows:
+                record = delim.Record(self.parser.fields, row, line_no)
+                record.parse()
+                records.append(record)
+            records = list(rec.post_processed(self.parser, records))
+
+        lines = []
+        error_rows = []
+        dropped = []
+        rejected = 0
+        for (line_no, row), record in zip(rows, records):
+            errors = _error_rows(line_no, getattr(record, "errors", ()))
+            if errors and self.reject:
+                rejected += 1
+            else:
+                if self.fields is not None:
+                    record = dict((f, record[f]) for f in self.fields if f in record)
+                try:
+                    lines.append(self.formatter.formatline(record, Reporter(), line_no))
+                except (ValueError, TypeError, AttributeError) as e:
+                    failed = (line_no, "", "", str(e))
+                    errors.append(failed)
+                    rejected += 1
+                    if not self.reject:
+                        dropped.append(failed)
+            error_rows.extend(errors)
+        return lines, error_rows, len(rows), rejected, len(error_rows), dropped
+
+
+_worker = None
+
+
+def _init_worker(factory, args):
+    global _worker
+    _worker = factory(*args)
+
+
+def _convert_chunk(chunk):
+    return _worker(chunk)
+
+
+class Summary(object):
+    """Counts for the throughput summary."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.rows = 0
+        self.rejected = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def count_input(self, file_obj):
+        """Yield the lines of file_obj, a text file, counting their size in
+        bytes of its encoding.
+        """
+        encoding = getattr(file_obj, "encoding", None) or "utf-8"
+        errors = getattr(file_obj, "errors", None) or "strict"
+        for line in file_obj:
+            self.bytes += len(line.encode(encoding, errors))
+            yield line
+
+    def format(self):
+        seconds = max(time.perf_counter() - self.start, 1e-9)
+        mb = self.bytes / 2.0**20
+        return (
+            "%d rows, %d rejected, %d errors in %.2fs: "
+            "%.0f rows/s, %.2f MB/s"
+            % (self.rows, self.rejected, self.errors, seconds,
+               self.rows / seconds, mb / seconds)
+        )
+
+
+def run(factory, args, items, write, rejects, summary, jobs=1, chunk_size=2000):
+    """Convert (line_no, item) pairs with factory(*args) and write each
+    converted row in order. Error rows go to rejects, a csv writer or None.
+    """
+    batches = chunks(items, chunk_size)
+    if jobs == 1:
+        convert = factory(*args)
+        results = (convert(chunk) for chunk in batches)
+        _write_results(results, write, rejects, summary)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        jobs, initializer=_init_worker, initargs=(factory, args)
+    ) as pool:
+        results = ordered_map(pool, _convert_chunk, batches, (jobs or 4) * 2)
+        _write_results(results, write, rejects, summary)
+
+
+def _write_results(results, write, rejects, summary):
+    for rows, errors, count, rejected, error_count, dropped in results:
+        summary.rows += count
+        summary.rejected += rejected
+        summary.errors += error_count
+        for row in rows:
+            write(row)
+        if rejects is not None:
+            rejects.writerows(errors)
+        for line_no, field, value, msg in dropped:
+            sys.stderr.write("line %d left out: %s\n" % (line_no, msg))
+
+
+def fw2csv(opts, summary, output, rejects):
+    args = (opts.layout, opts.fields, rejects is not None)
+    converter = FWToCSV(*args)
+    writer = csv.writer(output)
+    writer.writerow(converter.header())
+    with _open(opts.input) as f:
+        lines = summary.count_input(f)
+        if opts.jobs == 1 and converter.transcode:
+            report = converter.parser.transcode(
+                lines, writer, rejects, converter.fields
+            )
+            summary.rows = report.record_count
+            summary.rejected = report.error_size if rejects is not None else 0
+            summary.errors = report.error_count
+            return
+        run(FWToCSV, args, enumerate(lines, 1), writer.writerow, rejects,
+            summary, opts.jobs, opts.chunk_size)
+
+
+def csv2fw(opts, summary, output, rejects):
+    with _open(opts.input, newline="") as f:
+        reader = csv.reader(summary.count_input(f))
+        header = None
+        if opts.parser:
+            skip = load(opts.parser).header_lines
+        else:
+            header = next(reader, [])
+            skip = 0
+        start = 2 if header is not None else 1
+        rows = itertools.islice(enumerate(reader, start), skip, None)
+        args = (opts.layout, header, opts.parser, opts.fields,
+                rejects is not None)
+
+        def write(line):
+            output.write(line)
+            output.write("\n")
+
+        run(CSVToFW, args, rows, write, rejects, summary, opts.jobs,
+            opts.chunk_size)
+
+
+def _open(path, newline=None):
+    if path in (None, "-"):
+        return contextlib.nullcontext(sys.stdin)
+    return open_input(path, newline=newline)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(
+        prog="python -m reclib", description=__doc__.split("\n")[0]
+    )
+    sub = ap.add_subparsers(dest="command")
+    sub.required = True
+    for name, layout, help in (
+        ("fw2csv", "parser", "fixed width to CSV"),
+        ("csv2fw", "formatter", "CSV to fixed width"),
+    ):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("layout", metavar=layout,
+                       help="dotted path to the %s" % layout)
+        p.add_argument("input", nargs="?", help="input file, default stdin")
+        p.add_argument("-o", "--output", help="output file, default stdout")
+        p.add_argument("-j", "--jobs", type=int, default=1,
+                       help="number of worker processes")
+        p.add_argument("--chunk-size", type=int, default=2000,
+                       help="lines converted per task")
+        p.add_argument("--fields", type=lambda s: s.split(","),
+                       help="comma separated field names to keep")
+        p.add_argument("--rejects", help="write errors here and leave "
+                       "records with errors out of the output")
+        p.add_argument("-q", "--quiet", action="store_true",
+                       help="do not print a summary")
+        if name == "csv2fw":
+            p.add_argument("--parser", help="dotted path to a delim.Parser "
+                           "for the input, which has a header row otherwise")
+    opts = ap.parse_args(argv)
+
+    summary = Summary()
+    if opts.output in (None, "-"):
+        output = sys.stdout
+    else:
+        newline = "" if opts.command == "fw2csv" else None
+        output = open(opts.output, "w", newline=newline)
+    rejects_file = rejects = None
+    if opts.rejects:
+        rejects_file = open(opts.rejects, "w", newline="")
+        rejects = csv.writer(rejects_file)
+        rejects.writerow(["line_no", "field", "value", "message"])
+    try:
+        command = fw2csv if opts.command == "fw2csv" else csv2fw
+        command(opts, summary, output, rejects)
+    finally:
+        if output is sys.stdout:
+            output.flush()
+        else:
+            output.close()
+        if rejects_file is not None:
+            rejects_file.close()
+    if not opts.quiet:
+        sys.stderr.write(summary.format() + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
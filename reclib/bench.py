@@ -0,0 +1,274 @@
+"""Micro benchmarks for the hot paths of reclib.
+
+Run all of them with python -m reclib.bench, or name the ones to run:
+
+    python -m reclib.bench strftime
+"""
+
+import datetime
+import io
+import sys
+import time
+import timeit
+
+from reclib import util
+from reclib.parse import fw
+
+
+def bench_strftime(number=200000):
+    """util.strftime on dates before and after 1900, with the per-(time tuple,
+    zone, fmt) memo both hit (a repeated date) and bypassed (util._strftime).
+    """
+    results = []
+    for year in (1850, 1999):
+        for fmt in ("%Y%m%d", "%m/%d/%Y", "%b %Y"):
+            dt = datetime.date(year, 7, 4)
+            raw = timeit.timeit(lambda: util._strftime(dt, fmt), number=number)
+            memo = timeit.timeit(lambda: util.strftime(dt, fmt), number=number)
+            results.append(("%s %-10s" % (year, fmt), number, raw, memo))
+    for name, n, raw, memo in results:
+        print(
+            "strftime %s  %8.0f/s uncached  %8.0f/s memo" % (name, n / raw, n / memo)
+        )
+
+
+def pharmacy_parser():
+    """A layout with 25-repetition compound groups."""
+    return fw.Parser(
+        fw.String("member_id", 12),
+        fw.Date("dob", 8, "%Y%m%d"),
+        fw.Multi(fw.String("qualifier", 2), 25, join="", rstrip=True),
+        fw.Multi(fw.Currency("amount", 8, implicit=2), 25),
+        fw.RecordList(
+            "lines", 25, fw.String("ndc", 11), fw.Integer("qty", 4)
+        ),
+    )
+
+
+def pharmacy_file(rows=2000):
+    line = (
+        "MEMBER000001" + "19750412" + "01" * 25 + "00012345" * 25
+        + "00002345678" "0030" * 25
+    )
+    return "\n".join([line] * rows) + "\n"
+
+
+def _rate(fn, rows):
+    start = time.perf_counter()
+    fn()
+    return rows / (time.perf_counter() - start)
+
+
+def bench_slices(rows=2000):
+    """fw.Parser with compiled slice offsets against the RecordStream path."""
+    parser = pharmacy_parser()
+    text = pharmacy_file(rows)
+
+    def stream():
+        stream = fw.RecordStream(io.StringIO(text))
+        while not stream.eof:
+            parser.parseline(stream)
+
+    print("slices  compiled %8.0f rows/s" % _rate(
+        lambda: parser.parse(io.StringIO(text)), rows))
+    print("slices  stream   %8.0f rows/s" % _rate(stream, rows))
+
+
+def bench_fwarray(rows=200000):
+    """fwarray.parse_buffer against fw.Parser.parse on clean data."""
+    from reclib.parse import fwarray
+
+    parser = fw.Parser(
+        fw.String("member_id", 12),
+        fw.Integer("qty", 6),
+        fw.Currency("amount", 10, implicit=2),
+        fw.Date("filled", 8, "%Y%m%d"),
+    )
+    text = "MEMBER000001" "000030" "0000012345" "20240131\n" * rows
+    data = text.encode("ascii")
+    print("fwarray numpy  %8.0f rows/s" % _rate(
+        lambda: fwarray.parse_buffer(parser, data), rows))
+    print("fwarray python %8.0f rows/s" % _rate(
+        lambda: parser.parse(io.StringIO(text)), rows))
+
+
+def bench_intern(rows=100000):
+    """Memory held by a parse of an eligibility-like file with and without
+    interning of its low cardinality columns.
+    """
+    import random
+    import tracemalloc
+
+    rand = random.Random(0)
+    states = ["TX", "OK", "LA", "AR", "NM", "KS", "MO", "CO"]
+    plans = ["PLAN%04d" % i for i in range(40)]
+    lines = []
+    for i in range(rows):
+        lines.append(
+            "%-10s%-8s%-2s%-3s%-1s"
+            % ("M%09d" % i, rand.choice(plans), rand.choice(states),
+               rand.choice(["01", "03", "N4"]), rand.choice("AIT"))
+        )
+    text = "\n".join(lines) + "\n"
+
+    def parser(intern):
+        return fw.Parser(
+            fw.String("member_id", 10),
+            fw.String("plan_id", 8, intern=intern),
+            fw.String("state", 2, intern=intern),
+            fw.String("ndc_qualifier", 3, intern=intern),
+            fw.String("status", 1, intern=intern),
+        )
+
+    for intern in (False, True):
+        tracemalloc.start()
+        records = parser(intern).parse(io.StringIO(text))
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("intern=%-5s %d rows  %6.1f MB  %5.0f bytes/row" % (
+            intern, len(records), size / 2.0**20, size / float(rows)))
+        del records
+
+
+def bench_scan(rows=50000):
+    """fw.Parser.scan against a full fw.Parser.parse."""
+    parser = fw.Parser(
+        fw.String("member_id", 12, required=True),
+        fw.Integer("qty", 6),
+        fw.Currency("amount", 10, nonzero=True),
+        fw.Date("filled", 8, "%Y%m%d"),
+        fw.Date("dob", 8, "%Y%m%d"),
+        fw.String("state", 2, values=["TX", "OK"]),
+    )
+    text = "MEMBER000001" "000030" "0000012345" "20240131" "19750412TX\n" * rows
+    print("scan   %8.0f rows/s" % _rate(
+        lambda: parser.scan(io.StringIO(text)), rows))
+    print("parse  %8.0f rows/s" % _rate(
+        lambda: parser.parse(io.StringIO(text)), rows))
+
+
+def bench_decompress(rows=200000):
+    """fw.Parser.parse_file straight from compressed files, with and without
+    a decompression thread, against decompressing to disk and parsing the
+    plain file.
+    """
+    import bz2
+    import gzip
+    import lzma
+    import os
+    import shutil
+    import tempfile
+
+    parser = fw.Parser(
+        fw.String("member_id", 12),
+        fw.Integer("qty", 6),
+        fw.Currency("amount", 10, implicit=2),
+        fw.Date("filled", 8, "%Y%m%d"),
+    )
+    data = "".join(
+        "MEMBER%06d%06d%010d20240131\n" % (i, i % 90, i * 7) for i in range(rows)
+    ).encode("ascii")
+    tmp = tempfile.mkdtemp()
+    try:
+        for name, module in (("gzip", gzip), ("bz2", bz2), ("xz", lzma)):
+            path = os.path.join(tmp, "feed." + name)
+            with open(path, "wb") as f:
+                f.write(module.compress(data))
+
+            def to_disk():
+                plain = os.path.join(tmp, "feed.txt")
+                with module.open(path, "rb") as src, open(plain, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                parser.parse_file(plain)
+                os.remove(plain)
+
+            print("%-4s to disk then parse %8.0f rows/s" % (
+                name, _rate(to_disk, rows)))
+            print("%-4s stream             %8.0f rows/s" % (
+                name, _rate(lambda: parser.parse_file(path), rows)))
+            print("%-4s stream threaded    %8.0f rows/s" % (
+                name, _rate(lambda: parser.parse_file(path, threaded=True), rows)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_transcode(rows=100000):
+    """fw.Parser.transcode to CSV against parsing records and writing their
+    values with a csv.writer.
+    """
+    import csv
+
+    parser = fw.Parser(
+        fw.String("member_id", 12),
+        fw.String("last_name", 15),
+        fw.String("first_name", 10),
+        fw.Integer("qty", 6),
+        fw.Currency("amount", 10, implicit=2),
+        fw.Date("filled", 8, "%Y%m%d"),
+        fw.String("state", 2),
+    )
+    text = "".join(
+        "MEMBER%06d%-15s%-10s%06d%010d20240131TX\n"
+        % (i, "SMITH", "JANE", i % 90, i * 7)
+        for i in range(rows)
+    )
+
+    def parse_then_write():
+        writer = csv.writer(io.StringIO())
+        names = [f.name for f in parser.fields]
+        for record in parser.parse_iter(io.StringIO(text)):
+            writer.writerow([util.csv_cell(record.get(n)) for n in names])
+
+    def transcode(raw):
+        parser.transcode(io.StringIO(text), csv.writer(io.StringIO()), raw=raw)
+
+    print("transcode parse+write %8.0f rows/s" % _rate(parse_then_write, rows))
+    print("transcode             %8.0f rows/s" % _rate(
+        lambda: transcode(False), rows))
+    print("transcode raw         %8.0f rows/s" % _rate(
+        lambda: transcode(True), rows))
+
+
+def bench_importtime(runs=10):
+    """The time python -X importtime gives for importing the parsers, best
+    of runs. Bytecode is written on the first run unless
+    PYTHONDONTWRITEBYTECODE is set, in which case every run compiles.
+    """
+    import subprocess
+
+    for module in ("reclib.parse.fw", "reclib.parse.delim", "reclib.validate"):
+        best = None
+        for i in range(runs):
+            out = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", "import " + module],
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            ).stderr
+            for line in out.splitlines():
+                fields = line.split("|")
+                if len(fields) == 3 and fields[2].strip() == module:
+                    total = int(fields[1])
+                    best = total if best is None else min(best, total)
+        print("importtime %-20s %6.1f ms" % (module, best / 1000.0))
+
+
+BENCHMARKS = {
+    "importtime": bench_importtime,
+    "transcode": bench_transcode,
+    "decompress": bench_decompress,
+    "scan": bench_scan,
+    "intern": bench_intern,
+    "fwarray": bench_fwarray,
+    "slices": bench_slices,
+    "strftime": bench_strftime,
+}
+
+
+def main(argv):
+    for name in argv or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,381 @@
+""" Compact binary column files for parsed records.
+
+dump() writes the records of a fw or delim parse as one contiguous typed
+column per field, and load() memory maps such a file so that reading one
+column does not touch the others:
+
+    columnar.dump(parser.parse_file("claims.txt"), "claims.col")
+
+    with columnar.load("claims.col") as claims:
+        total = sum(claims.column("amount"))
+
+Columns are stored by kind:
+
+    int       int64 values
+    date      int32 proleptic Gregorian ordinals
+    datetime  int64 microseconds since 0001-01-01, for naive datetimes
+    decimal   int64 values scaled by 10**scale, one scale per column
+    str       uint64 offsets into a UTF-8 blob
+    object    uint64 offsets into a blob of pickles, for anything else
+
+Each column also has one byte per row that is 1 where the value was None.
+A decimal column gives back every value with the column's scale, so
+Decimal("1.5") in a column of cents loads as Decimal("1.50").
+
+Line numbers are stored as a column of their own, and errors and warnings
+in a side table of (row, field name, value, message, column) tuples.
+"""
+
+import array
+import datetime
+import decimal
+import json
+import mmap
+import pickle
+import struct
+import sys
+
+MAGIC = b"RECLIBCOL1\n\0\0\0\0\0"
+_footer = struct.Struct("<Q")
+_epoch = datetime.datetime(1, 1, 1)
+_max_int = 2**63 - 1
+
+
+def dump(records, path, fields=None):
+    """Write records to a column file at path. fields defaults to every key
+    of the records, in the order they are first seen. Returns the number
+    of records written.
+    """
+    columns = {}
+    if fields is not None:
+        for name in fields:
+            columns[name] = _ColumnWriter()
+    line_nos = _ColumnWriter()
+    errors = []
+    warnings = []
+
+    count = 0
+    for row, record in enumerate(records):
+        if fields is None:
+            for name in record:
+                if name not in columns:
+                    column = columns[name] = _ColumnWriter()
+                    column.pad(row)
+        for name, column in columns.items():
+            column.append(record.get(name))
+        line_nos.append(getattr(record, "line_no", None))
+        for error in getattr(record, "errors", ()):
+            errors.append(_side_entry(row, error))
+        for warning in getattr(record, "warnings", ()):
+            warnings.append(_side_entry(row, warning))
+        count += 1
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        footer = {
+            "count": count,
+            "byteorder": sys.byteorder,
+            "columns": [],
+        }
+        for name, column in columns.items():
+            info = column.write(f)
+            info["name"] = name
+            footer["columns"].append(info)
+        footer["line_no"] = line_nos.write(f)
+        footer["errors"] = _write_section(f, pickle.dumps(errors, 4))
+        footer["warnings"] = _write_section(f, pickle.dumps(warnings, 4))
+        data = json.dumps(footer).encode("utf-8")
+        f.write(data)
+        f.write(_footer.pack(len(data)))
+    return count
+
+
+def load(path):
+    """Open a column file written by dump."""
+    return ColumnFile(path)
+
+
+def _side_entry(row, entry):
+    field, value, msg, col = entry
+    return (row, getattr(field, "name", field), value, msg, col)
+
+
+def _write_section(f, data):
+    """Write data at the next 8 byte boundary and return its location."""
+    pad = -f.tell() % 8
+    f.write(b"\0" * pad)
+    offset = f.tell()
+    f.write(data)
+    return [offset, len(data)]
+
+
+class _ColumnWriter(object):
+    """Accumulates one column, changing its kind to object when a value
+    does not fit the kind chosen from the first value that is not None.
+    """
+
+    def __init__(self):
+        self.kind = None
+        self.nulls = bytearray()
+        self.values = array.array("q")
+        self.scale = 0
+        self.blob = bytearray()
+        self.offsets = array.array("Q", [0])
+
+    def pad(self, count):
+        for i in range(count):
+            self.append(None)
+
+    def append(self, value):
+        if value is None:
+            self.nulls.append(1)
+            self._append_null()
+            return
+        if self.kind is None:
+            self._choose(value)
+        try:
+            self._append(value)
+        except (TypeError, ValueError, OverflowError, AttributeError):
+            self._promote()
+            self._append(value)
+        self.nulls.append(0)
+
+    def _choose(self, value):
+        # Only nulls have been appended so far, as zeros.
+        count = len(self.nulls)
+        self._choose_kind(value)
+        if self.kind in ("str", "object"):
+            self.offsets = array.array("Q", [0] * (count + 1))
+        elif self.kind == "date":
+            self.values = array.array("i", [0] * count)
+
+    def _choose_kind(self, value):
+        if isinstance(value, bool):
+            self.kind = "object"
+        elif isinstance(value, int):
+            self.kind = "int"
+        elif isinstance(value, decimal.Decimal):
+            self.kind = "decimal"
+        elif isinstance(value, datetime.datetime):
+            self.kind = "datetime" if value.tzinfo is None else "object"
+        elif isinstance(value, datetime.date):
+            self.kind = "date"
+        elif isinstance(value, str):
+            self.kind = "str"
+        else:
+            self.kind = "object"
+
+    def _append_null(self):
+        if self.kind in ("str", "object"):
+            self.offsets.append(len(self.blob))
+        else:
+            self.values.append(0)
+
+    def _append(self, value):
+        kind = self.kind
+        if kind == "int":
+            if type(value) is not int:
+                raise TypeError(value)
+            self.values.append(value)
+        elif kind == "date":
+            if type(value) is not datetime.date:
+                raise TypeError(value)
+            self.values.append(value.toordinal())
+        elif kind == "datetime":
+            if type(value) is not datetime.datetime or value.tzinfo is not None:
+                raise TypeError(value)
+            self.values.append((value - _epoch) // datetime.timedelta(microseconds=1))
+        elif kind == "decimal":
+            self._append_decimal(value)
+        elif kind == "str":
+            if type(value) is not str:
+                raise TypeError(value)
+            self.blob += value.encode("utf-8")
+            self.offsets.append(len(self.blob))
+        else:
+            self.blob += pickle.dumps(value, 4)
+            self.offsets.append(len(self.blob))
+
+    def _append_decimal(self, value):
+        if type(value) is not decimal.Decimal or not value.is_finite():
+            raise TypeError(value)
+        exponent = value.as_tuple().exponent
+        if -exponent > self.scale:
+            factor = 10 ** (-exponent - self.scale)
+            if any(abs(v) * factor > _max_int for v in self.values):
+                raise OverflowError(value)
+            self.values = array.array("q", (v * factor for v in self.values))
+            self.scale = -exponent
+        scaled = int(value.scaleb(self.scale))
+        if abs(scaled) > _max_int:
+            raise OverflowError(value)
+        self.values.append(scaled)
+
+    def _decoded(self):
+        column = _Column(self.kind, self.nulls, self.values, self.offsets,
+                         self.blob, self.scale)
+        return list(column)
+
+    def _promote(self):
+        values = self._decoded()
+        self.kind = "object"
+        self.values = array.array("q")
+        self.blob = bytearray()
+        self.offsets = array.array("Q", [0])
+        for value in values:
+            if value is None:
+                self._append_null()
+            else:
+                self._append(value)
+
+    def write(self, f):
+        info = {"kind": self.kind or "int", "scale": self.scale}
+        info["nulls"] = _write_section(f, bytes(self.nulls))
+        if self.kind in ("str", "object"):
+            info["offsets"] = _write_section(f, self.offsets.tobytes())
+            info["blob"] = _write_section(f, bytes(self.blob))
+        else:
+            info["typecode"] = self.values.typecode
+            info["values"] = _write_section(f, self.values.tobytes())
+        return info
+
+
+class ColumnFile(object):
+    """A memory mapped column file. Columns are decoded only when they are
+    read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[: len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a reclib column file" % path)
+        end = len(self._map) - _footer.size
+        (size,) = _footer.unpack(self._map[end:])
+        self._footer = json.loads(self._map[end - size : end].decode("utf-8"))
+        self._swap = self._footer["byteorder"] != sys.byteorder
+        self._columns = dict((c["name"], c) for c in self._footer["columns"])
+
+    def __len__(self):
+        return self._footer["count"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the file. Columns still in use keep the mapping open
+        until they are released.
+        """
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._file.close()
+            self._map = None
+
+    @property
+    def names(self):
+        return [c["name"] for c in self._footer["columns"]]
+
+    def kind(self, name):
+        return self._columns[name]["kind"]
+
+    def column(self, name):
+        """A sequence of the values of one column."""
+        return self._column(self._columns[name])
+
+    __getitem__ = column
+
+    @property
+    def line_nos(self):
+        return self._column(self._footer["line_no"])
+
+    @property
+    def errors(self):
+        """[(row, field name, value, msg, col)]"""
+        return pickle.loads(self._section(self._footer["errors"]))
+
+    @property
+    def warnings(self):
+        """[(row, field name, value, msg, col)]"""
+        return pickle.loads(self._section(self._footer["warnings"]))
+
+    def records(self, fields=None):
+        """Yield each row as a dict of the given fields, by default all."""
+        columns = [(n, self.column(n)) for n in fields or self.names]
+        for i in range(len(self)):
+            yield dict((n, c[i]) for n, c in columns)
+
+    def _section(self, location):
+        offset, size = location
+        return memoryview(self._map)[offset : offset + size]
+
+    def _array(self, location, typecode):
+        view = self._section(location)
+        if not self._swap:
+            return view.cast(typecode)
+        values = array.array(typecode, view)
+        values.byteswap()
+        return values
+
+    def _column(self, info):
+        kind = info["kind"]
+        nulls = self._section(info["nulls"])
+        if kind in ("str", "object"):
+            offsets = self._array(info["offsets"], "Q")
+            blob = self._section(info["blob"])
+            return _Column(kind, nulls, None, offsets, blob, 0)
+        values = self._array(info["values"], info["typecode"])
+        return _Column(kind, nulls, values, None, None, info["scale"])
+
+
+class _Column(object):
+    """Decodes the values of one column on access."""
+
+    def __init__(self, kind, nulls, values, offsets, blob, scale):
+        self.kind = kind
+        self.nulls = nulls
+        self.values = values
+        self.offsets = offsets
+        self.blob = blob
+        self.scale = scale
+        self._decode = getattr(self, "_decode_%s" % kind)
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if self.nulls[i]:
+            return None
+        return self._decode(i)
+
+    def __iter__(self):
+        decode = self._decode
+        for i, null in enumerate(self.nulls):
+            yield None if null else decode(i)
+
+    def _decode_int(self, i):
+        return self.values[i]
+
+    def _decode_date(self, i):
+        return datetime.date.fromordinal(self.values[i])
+
+    def _decode_datetime(self, i):
+        return _epoch + datetime.timedelta(microseconds=self.values[i])
+
+    def _decode_decimal(self, i):
+        return decimal.Decimal(self.values[i]).scaleb(-self.scale)
+
+    def _decode_str(self, i):
+        return bytes(self.blob[self.offsets[i] : self.offsets[i + 1]]).decode("utf-8")
+
+    def _decode_object(self, i):
+        return pickle.loads(self.blob[self.offsets[i] : self.offsets[i + 1]])
@@ -1,5 +1,5 @@
+import io
 import re
-import six
 from decimal import Decimal
 
 from reclib.util import decimal2implicit, parse_decimal
@@ -158,42 +158,184 @@ class Array:
         return self.sep.join(value)
 
 
+def field_width(field):
+    """The number of characters field formats to, or None if it is not
+    known.
+    """
+    length = getattr(field, "length", None)
+    if isinstance(length, tuple):
+        width, height = length
+        return width * height
+    if isinstance(length, int):
+        return length
+    if isinstance(field, Array):
+        width = field_width(field.stype)
+        if width is not None:
+            return width * field.count + len(field.sep) * (field.count - 1)
+    return None
+
+
 class Formatter:
     fields = []
+    _span_cache = None
 
-    def format(self, records, file_obj=None, reset=True):
+    def format(self, records, file_obj=None, reset=True, progress=None):
+        """Write records to file_obj, one line each. progress is a
+        callback, or a reclib.progress.Progress, to report to while
+        writing; it counts warnings as errors.
+        """
         if file_obj is None:
-            file_obj = six.StringIO()
+            file_obj = io.StringIO()
         reporter = Reporter()
-        for idx, record in enumerate(records):
-            for field in self.fields:
-                reporter.set_field(field, idx)
-                value = field.format(record, reporter)
-                file_obj.write(value)
-            if idx != len(records) - 1:
-                file_obj.write("\n")
+        if progress is not None:
+            self._format_tracked(records, file_obj, reporter, progress)
+        else:
+            for idx, record in enumerate(records):
+                if idx:
+                    file_obj.write("\n")
+                file_obj.write(self.formatline(record, reporter, idx))
         if reset:
             file_obj.seek(0)
         return file_obj
 
+    def _format_tracked(self, records, file_obj, reporter, progress,
+                        batch_size=1000):
+        from reclib.progress import tracker
+
+        progress = tracker(progress)
+        count = size = warned = 0
+        for idx, record in enumerate(records):
+            line = self.formatline(record, reporter, idx)
+            if idx:
+                line = "\n" + line
+            file_obj.write(line)
+            count += 1
+            size += len(line)
+            if count == batch_size:
+                errors = len(reporter.warnings) - warned
+                progress.update(count, errors=errors, characters=size)
+                warned += errors
+                count = size = 0
+        errors = len(reporter.warnings) - warned
+        progress.update(count, errors=errors, characters=size)
+        progress.finish()
+
+    async def format_async(self, records, writer, encoding="utf-8",
+                           chunk_size=1 << 16):
+        """Write records, an iterable or an async iterable, to writer, an
+        asyncio.StreamWriter or anything with write and an awaitable drain,
+        as format would, encoded. Lines are written about chunk_size
+        characters at a time and drain is awaited after each write, so a
+        slow reader holds the formatting back. Returns the Reporter with
+        the warnings.
+        """
+        reporter = Reporter()
+        if not hasattr(records, "__aiter__"):
+            records = _async_iter(records)
+        # Each line after the first is written with the separator before it.
+        lines = []
+        size = 0
+        idx = 0
+        async for record in records:
+            line = self.formatline(record, reporter, idx)
+            lines.append("\n" + line if idx else line)
+            size += len(line)
+            idx += 1
+            if size >= chunk_size:
+                writer.write("".join(lines).encode(encoding))
+                await writer.drain()
+                lines = []
+                size = 0
+        if lines:
+            writer.write("".join(lines).encode(encoding))
+            await writer.drain()
+        return reporter
+
     def formatone(self, record, file_obj=None, reset=True):
         if file_obj is None:
-            file_obj = six.StringIO()
-        reporter = Reporter()
-        for field in self.fields:
-            reporter.set_field(field, 1)
-            value = field.format(record, reporter)
-            file_obj.write(value)
+            file_obj = io.StringIO()
+        file_obj.write(self.formatline(record, Reporter(), 1))
         if reset:
             file_obj.seek(0)
         return file_obj
 
+    def formatline(self, record, reporter, record_num):
+        """The fixed width text of one record, without a line ending. An
+        fw.EditRecord, from a parser with keep_lines, is written as its
+        original line with only its edited fields formatted and spliced in,
+        if this formatter has the same fields at the same columns as the
+        parser.
+        """
+        if getattr(record, "spans", None) is not None:
+            line = self._splice(record, reporter, record_num)
+            if line is not None:
+                return line
+        values = []
+        for field in self.fields:
+            reporter.set_field(field, record_num)
+            values.append(field.format(record, reporter))
+        return "".join(values)
+
+    def spans(self):
+        """{name: (field, start, end)} for the fields at known columns."""
+        return self._spans()[1]
+
+    def _spans(self):
+        # (fields, spans, columns, matched): columns is {name: (start, end)}
+        # when every field is at known columns, else None, and matched holds
+        # the last Layout.spans found equal to it.
+        cache = self._span_cache
+        if cache is None or cache[0] is not self.fields:
+            spans = {}
+            pos = 0
+            for field in self.fields:
+                width = field_width(field)
+                if width is None:
+                    break
+                spans[field.name] = (field, pos, pos + width)
+                pos += width
+            columns = None
+            if len(spans) == len(self.fields):
+                columns = dict((name, s[1:]) for name, s in spans.items())
+            cache = self._span_cache = (self.fields, spans, columns, [None])
+        return cache
+
+    def _splice(self, record, reporter, record_num):
+        """The line of record with its edited fields formatted in place, or
+        None if this formatter does not write exactly the fields of the
+        record's layout at the same columns.
+        """
+        fields, spans, columns, matched = self._spans()
+        if record.spans is not matched[0]:
+            if columns is None or record.spans != columns:
+                return None
+            matched[0] = record.spans
+        line = record.line
+        for name in record.edited:
+            if name not in spans:
+                # Not written by this formatter
+                continue
+            field, start, end = spans[name]
+            reporter.set_field(field, record_num)
+            text = field.format(record, reporter)
+            if len(text) != end - start:
+                return None
+            if len(line) < end:
+                line = line.ljust(end)
+            line = line[:start] + text + line[end:]
+        return line
+
     def format2file(self, records, path):
         f = open(path, "w")
-        self.format(record, f, False)
+        self.format(records, f, False)
         f.close()
 
 
+async def _async_iter(items):
+    for item in items:
+        yield item
+
+
 class Reporter:
     def __init__(self):
         self.warnings = []
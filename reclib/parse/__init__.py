@@ -0,0 +1,15 @@
+import importlib
+
+# Parsers are imported on first use. fwarray needs numpy, which is only
+# imported when reclib.parse.fwarray is.
+_submodules = {"delim", "fw", "fwarray", "rec"}
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
@@ -1,18 +1,23 @@
-from builtins import zip
-from builtins import str
-from builtins import object
 import csv
 import datetime
 import decimal
-import logging
+import itertools
 import os
 import re
 import time
 
+from reclib.util import (chunks, date_tuple, decimal_error,
+                         decimal_is_zero, intern_table, is_int, logger,
+                         open_input, ordered_map, read_ahead)
 from . import rec
 
 
-log = logging.getLogger('reclib')
+def __getattr__(name):
+    # log is looked up on first use, see util.logger
+    if name == 'log':
+        return logger()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
 
 class Parser(object):
     fields = []
@@ -20,9 +25,54 @@ class Parser(object):
     _field_cache = None
     delimiter = ','
     dialect=csv.excel
+    memory_budget = None
+    batch_size = 1000
+
+    def parse(self, file_obj, src=None, progress=None):
+        """Parse file_obj into a RecordSet. progress is a callback, or a
+        reclib.progress.Progress, to report to while parsing.
+        """
+        progress = rec.tracked(progress, file_obj)
+        records = self._parse(file_obj, src, progress)
+        if progress is not None:
+            progress.finish()
+        return records
+
+    def _parse(self, file_obj, src, progress):
+        records = self.record_set(src)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        parsed = self._iter_records(file_obj)
+        for record in rec.post_processed(self, parsed, progress):
+            records.append(record)
+        return records
+
+    def parse_iter(self, file, progress=None):
+        """Yield the records of file, a path or a file object, one at a
+        time.
+        """
+        if not isinstance(file, str):
+            for record in self._iter_tracked(file, progress):
+                yield record
+            return
+        with open_input(file) as file_obj:
+            for record in self._iter_tracked(file_obj, progress):
+                yield record
+
+    def _iter_tracked(self, file_obj, progress):
+        progress = rec.tracked(progress, file_obj)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        records = self._iter_records(file_obj)
+        try:
+            for record in rec.post_processed(self, records, progress):
+                yield record
+        finally:
+            if progress is not None:
+                progress.finish()
 
-    def parse(self, file_obj, src=None):
-        records = rec.RecordSet(src)
+    def _iter_records(self, file_obj):
+        """Yield the records of file_obj before post processing."""
         r = csv.reader(file_obj, delimiter=self.delimiter,
                        dialect=self.dialect)
         for i, line in enumerate(r):
@@ -31,24 +81,210 @@ class Parser(object):
             line_no = i + 1
             record = Record(self.fields, line, line_no)
             record.parse()
+            yield record
+
+    def post_process(self, record):
+        pass
+
+    def post_process_batch(self, records):
+        """Called with lists of up to batch_size records, in order, before
+        they are added to a RecordSet or yielded, in the thread that reads
+        the records, whatever the chunk_size of a threaded or pipelined
+        parse. Override it to do work that is cheaper in bulk. By default
+        it calls post_process on each record.
+        """
+        for record in records:
             self.post_process(record)
+
+    def sample(self, file_obj, every=None, random=None, first=None,
+               last=None, seed=None):
+        """Parse a sample of the rows of file_obj into a RecordSet. See
+        rec.Sampler for the kinds of sample. The file is read through but
+        only the chosen rows are parsed, and records keep their line_no.
+        """
+        sampler = rec.Sampler(every, random, first, last, seed)
+        records = self.record_set()
+        r = csv.reader(file_obj, delimiter=self.delimiter,
+                       dialect=self.dialect)
+        rows = itertools.islice(r, self.header_lines, None)
+        for record in rec.post_processed(self, self._sampled(sampler, rows)):
             records.append(record)
         return records
 
-    def post_process(self, record):
-        pass
+    def _sampled(self, sampler, rows):
+        for index, line in sampler.select(rows):
+            record = Record(self.fields, line, index + self.header_lines + 1)
+            record.parse()
+            yield record
+
+    def scan(self, file_obj, max_errors=10):
+        """Check the rows of file_obj without building records or
+        converting values and return a rec.ScanReport. Only values that
+        fail their field's check are converted, to count every error parse
+        would. Rows that do not have one value per field are counted as
+        width errors.
+        """
+        report = rec.ScanReport(max_errors)
+        checks = [(f.name, rec.checker(f, f.parse)) for f in self.fields]
+        size = len(checks)
+        r = csv.reader(file_obj, delimiter=self.delimiter,
+                       dialect=self.dialect)
+        for i, line in enumerate(r):
+            if i < self.header_lines:
+                continue
+            line_no = i + 1
+            if len(line) != size:
+                report.width_error(line_no, len(line))
+                line = line + [''] * (size - len(line))
+            failed = False
+            for (name, check), value in zip(checks, line):
+                messages = check(value)
+                if messages:
+                    for msg in messages:
+                        report.error(name, line_no, value, msg)
+                    failed = True
+            report.record(failed)
+        return report
+
+    def record_set(self, src=None):
+        """The RecordSet that parse fills. With a memory_budget in bytes,
+        records beyond the budget are spilled to a temporary file.
+        """
+        if self.memory_budget:
+            return rec.SpillingRecordSet(src, self.memory_budget)
+        return rec.RecordSet(src)
 
     def field(self, name):
-        if not self._field_cache:
-            self._field_cache = dict((f.name, f) for f in self.fields)
-        return self._field_cache[name]
-
-    def parse_file(self, path, *args, **kwargs):
-        file_obj = open(path, *args, **kwargs)
-        records = self.parse(file_obj, os.path.basename(path))
-        file_obj.close()
+        # Built into a local and published whole so that threads sharing
+        # the parser never see a partly built cache.
+        cache = self._field_cache
+        if cache is None or cache[0] is not self.fields:
+            cache = self._field_cache = (
+                self.fields, dict((f.name, f) for f in self.fields))
+        return cache[1][name]
+
+    def parse_file(self, path, mode="r", *, progress=None, **kwargs):
+        """Parse the file at path, which may be gzip, bz2 or xz compressed.
+        mode and the other arguments, which are keyword only since they do
+        not follow the order of open's, are passed on to util.open_input.
+        """
+        with open_input(path, mode, **kwargs) as file_obj:
+            return self.parse(file_obj, os.path.basename(path), progress)
+
+    def parse_many(self, files, jobs=None, progress=None):
+        """Parse each of files, paths or file objects, in a pool of jobs
+        threads. Returns a list of RecordSets in the order of files.
+        progress reports on all the files together.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        files = list(files)
+        progress = rec.tracked(progress)
+        if progress is not None and progress.total is None:
+            from reclib.progress import total_size
+
+            progress.total = total_size(files)
+        with ThreadPoolExecutor(jobs) as pool:
+            if progress is None:
+                parts = itertools.repeat(None)
+            else:
+                parts = (progress.part() for file in files)
+            results = list(pool.map(self._parse_one, files, parts))
+        if progress is not None:
+            progress.finish()
+        return results
+
+    def _parse_one(self, file, progress=None):
+        if isinstance(file, str):
+            return self.parse_file(file, progress=progress)
+        return self.parse(file, progress=progress)
+
+    def parse_threaded(self, file_obj, src=None, jobs=None, chunk_size=2000,
+                       progress=None):
+        """Parse file_obj like parse, converting chunks of chunk_size rows
+        in a pool of jobs threads. The csv reader and the post processing
+        hooks run in the calling thread, and records are appended and the
+        hooks called in row order, as parse calls them.
+        """
+        if jobs == 1:
+            return self.parse(file_obj, src, progress)
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        progress = rec.tracked(progress, file_obj)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        records = self.record_set(src)
+        r = csv.reader(file_obj, delimiter=self.delimiter,
+                       dialect=self.dialect)
+        rows = itertools.islice(enumerate(r, 1), self.header_lines, None)
+        with ThreadPoolExecutor(jobs) as pool:
+            batches = ordered_map(pool, self._parse_chunk,
+                                  chunks(rows, chunk_size), (jobs or 4) * 2)
+            parsed = itertools.chain.from_iterable(batches)
+            for record in rec.post_processed(self, parsed, progress):
+                records.append(record)
+        if progress is not None:
+            progress.finish()
         return records
 
+    def _parse_chunk(self, rows):
+        batch = []
+        for line_no, line in rows:
+            record = Record(self.fields, line, line_no)
+            record.parse()
+            batch.append(record)
+        return batch
+
+    def parse_pipelined(self, file, jobs=1, chunk_size=2000, ahead=4,
+                        progress=None):
+        """Yield the records of file like parse_iter, with reading, parsing
+        and the consumer in stages of their own. Rows are read by the csv
+        reader chunk_size at a time in a thread, up to ahead chunks before
+        they are parsed, and parsed in a pool of jobs threads, up to ahead
+        chunks before they are consumed. Records come in row order, and
+        the post processing hooks run in the consumer's thread, as in
+        parse_iter.
+
+        An error reading is raised to the consumer after the records read
+        before it. An error parsing is raised in place of the records of
+        its chunk, and an error in the hooks in place of those of its
+        batch, after the records of the chunks or batches before.
+        Closing the generator stops the threads.
+        """
+        file_obj = open_input(file) if isinstance(file, str) else file
+        stages = self._pipeline(file_obj, jobs, chunk_size, ahead, progress)
+        try:
+            for record in stages:
+                yield record
+        finally:
+            # Stop the reader before closing the file under it.
+            stages.close()
+            if file_obj is not file:
+                file_obj.close()
+
+    def _pipeline(self, file_obj, jobs, chunk_size, ahead, progress):
+        from concurrent.futures import ThreadPoolExecutor
+
+        progress = rec.tracked(progress, file_obj)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        r = csv.reader(file_obj, delimiter=self.delimiter,
+                       dialect=self.dialect)
+        rows = itertools.islice(enumerate(r, 1), self.header_lines, None)
+        blocks = read_ahead(chunks(rows, chunk_size), ahead)
+        with ThreadPoolExecutor(jobs) as pool:
+            batches = ordered_map(pool, self._parse_chunk, blocks, ahead)
+            try:
+                parsed = itertools.chain.from_iterable(batches)
+                for record in rec.post_processed(self, parsed, progress):
+                    yield record
+            finally:
+                batches.close()
+                blocks.close()
+                if progress is not None:
+                    progress.finish()
+
 class Record(dict):
     def __init__(self, fields, src, line_no):
         self.fields = fields
@@ -93,8 +329,24 @@ class Currency(object):
             return
         return value
 
+    def check(self, value):
+        """ The first error parse would report for value, or None. """
+        value = value.strip()
+        if not value:
+            if self.required:
+                return "missing required value"
+            if self.nonzero:
+                return "value cannot be zero"
+            return
+        error = decimal_error(value)
+        if error is not None:
+            return error
+        if self.nonzero and decimal_is_zero(value):
+            return "value cannot be zero"
+
 class Integer(object):
-    sexp = re.compile("[^\d]")
+    sexp = re.compile(r"[^\d]")
+    digit = re.compile(r"\d")
     def __init__(self, name, required=False, strip_nonnumeric=True):
         self.name = name
         self.required = required
@@ -111,6 +363,16 @@ class Integer(object):
             return
         return value
 
+    def check(self, value):
+        """ The first error parse would report for value, or None. """
+        value = value.strip()
+        if self.strip_nonnumeric:
+            valid = self.digit.search(value) is not None
+        else:
+            valid = is_int(value)
+        if not valid:
+            return "cannot translate to number"
+
 class String(object):
     def __init__(self, name, **kw):
         self.name = name
@@ -125,6 +387,7 @@ class String(object):
         self.lower = kw.get('lower', False)
         self.tr = kw.get('tr', False)
         self.tr_match = kw.get('tr_match', True)
+        self.intern = intern_table(kw.get('intern', False))
 
     def parse(self, value, err, warn):
         # Manage white space
@@ -134,7 +397,6 @@ class String(object):
             value = value.rstrip()
 
         # Validate
-        self.errors = []
         if self.required and value == "":
             err("missing required value")
             return
@@ -158,8 +420,26 @@ class String(object):
             value = value.upper()
         if self.lower:
             value = value.lower()
+        if self.intern is not None:
+            value = self.intern(value)
         return value
 
+    def check(self, value):
+        """ The first error parse would report for value, or None. """
+        if self.strip_left:
+            value = value.lstrip()
+        if self.strip_right:
+            value = value.rstrip()
+        if self.required and value == "":
+            return "missing required value"
+        if (value != "" or self.validate_blank):
+            if self.regex and not re.match(self.regex, value):
+                return "does not match pattern %s" % self.regex
+            if self.values and value not in self.values:
+                return "unexpected value"
+        if self.tr and self.tr_match and value not in self.tr:
+            return "unexpected value"
+
 class Date(object):
     def __init__(self, name, format='%m%d%Y', 
                  required=False, 
@@ -190,3 +470,16 @@ class Date(object):
             return
         return value
 
+    def check(self, value):
+        """ The first error parse would report for value, or None. """
+        if self.strip_spaces:
+            value = value.strip()
+        if not value:
+            if self.required:
+                return "missing required value"
+            return
+        parts = date_tuple(value, self.format)
+        if parts is None:
+            return "invalid date, expected format %r" % self.format
+        if self.min_year and parts[0] < self.min_year:
+            return "Expected year after %s" % self.min_year
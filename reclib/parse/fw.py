@@ -5,20 +5,36 @@ Not meant for complex multi field logic or business rules processing. Need to
 have a general validation object system for that.
 """
 
-import csv
 import datetime
 import decimal
-import logging
+import io
+import itertools
 import os
 import re
 import time
 
-import six
-
-from reclib.util import strftime
+from reclib.util import (
+    chunks,
+    csv_cell,
+    date_tuple,
+    decimal_error,
+    decimal_is_zero,
+    intern_table,
+    is_int,
+    logger,
+    open_input,
+    ordered_map,
+    read_ahead,
+    strftime,
+)
 from . import rec
 
-log = logging.getLogger("reclib")
+
+def __getattr__(name):
+    # log is looked up on first use, see util.logger
+    if name == "log":
+        return logger()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 class Parser:
@@ -29,29 +45,310 @@ class Parser:
     spacing = 0
 
     file_name = None
+    memory_budget = None
+    batch_size = 1000
+    # Parse into EditRecords that keep their line, for round trip edits.
+    keep_lines = False
     _field_cache = None
+    _layout = None
 
     def __init__(self, *fields):
         if fields:
             self.fields = fields
 
-    def parse(self, file_obj, src=None):
-        stream = RecordStream(file_obj)
-        records = rec.RecordSet(src)
-        while not stream.eof:
-            record = self.parseline(stream)
-            if not stream.eof:
-                self.post_process(record)
-                records.append(record)
+    def parse(self, file_obj, src=None, progress=None):
+        """Parse file_obj into a RecordSet. progress is a callback, or a
+        reclib.progress.Progress, to report to while parsing.
+        """
+        progress = rec.tracked(progress, file_obj)
+        records = self._parse(file_obj, src, progress)
+        if progress is not None:
+            progress.finish()
+        return records
+
+    def _parse(self, file_obj, src, progress):
+        records = self.record_set(src)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        parsed = self._iter_records(file_obj)
+        for record in rec.post_processed(self, parsed, progress):
+            records.append(record)
         return records
 
     def post_process(self, record):
         pass
 
+    def post_process_batch(self, records):
+        """Called with lists of up to batch_size records, in order, before
+        they are added to a RecordSet or yielded, in the thread that reads
+        the records, whatever the chunk_size of a threaded or pipelined
+        parse. Override it to do work that is cheaper in bulk. By default
+        it calls post_process on each record.
+        """
+        for record in records:
+            self.post_process(record)
+
+    def record_set(self, src=None):
+        """The RecordSet that parse fills. With a memory_budget in bytes,
+        records beyond the budget are spilled to a temporary file.
+        """
+        if self.memory_budget:
+            return rec.SpillingRecordSet(src, self.memory_budget)
+        return rec.RecordSet(src)
+
     def field(self, name):
-        if not self._field_cache:
-            self._field_cache = dict((f.name, f) for f in self.fields)
-        return self._field_cache[name]
+        # Built into a local and published whole so that threads sharing
+        # the parser never see a partly built cache.
+        cache = self._field_cache
+        if cache is None or cache[0] is not self.fields:
+            cache = self._field_cache = (
+                self.fields,
+                dict((f.name, f) for f in self.fields),
+            )
+        return cache[1][name]
+
+    @property
+    def layout(self):
+        """The Layout of the parser's fields, compiled on first use."""
+        layout = self._layout
+        if (
+            layout is None
+            or layout.fields is not self.fields
+            or layout.spacing != self.spacing
+        ):
+            layout = self._layout = Layout(self.fields, self.spacing)
+        return layout
+
+    @property
+    def sliced(self):
+        """Whether lines are parsed by slicing them at the offsets of the
+        layout: it compiles, and parseline, which slicing bypasses, is not
+        overridden.
+        """
+        return self.layout.compiled and type(self).parseline is Parser.parseline
+
+    def parse_raw(self, line, line_no=None):
+        """Parse a single line of text into a Record."""
+        if line and line[-1] == "\n":
+            line = line[:-1]
+        layout = self.layout
+        if not self.sliced:
+            if self.keep_lines:
+                raise ValueError(
+                    "keep_lines needs fields of fixed width and Parser.parseline"
+                )
+            stream = RecordStream([line])
+            record = self.parseline(stream)
+            record.line_no = line_no
+            return record
+        if self.keep_lines:
+            record = EditRecord(self.fields, self.spacing, line, layout.spans)
+        else:
+            record = Record(self.fields, self.spacing)
+        record.parse_slices(line, line_no, layout)
+        return record
+
+    def _iter_records(self, file_obj):
+        """Yield the records of file_obj before post processing. Layouts
+        that compile to fixed offsets are parsed by slicing each line, any
+        other through a RecordStream.
+        """
+        if not self.sliced and not self.keep_lines:
+            stream = RecordStream(file_obj)
+            while True:
+                record = self.parseline(stream)
+                if stream.eof:
+                    return
+                yield record
+        parse_raw = self.parse_raw
+        for line_no, line in enumerate(file_obj, 1):
+            yield parse_raw(line, line_no)
+
+    def sample(
+        self,
+        file,
+        every=None,
+        random=None,
+        first=None,
+        last=None,
+        seed=None,
+        encoding=None,
+    ):
+        """Parse a sample of the records of file, a path or a file object,
+        into a RecordSet. See rec.Sampler for the kinds of sample. Records
+        keep their line_no in the whole file.
+
+        When file is a path to an uncompressed file of equal length lines,
+        the sample is read by seeking to the byte offset of each chosen
+        line, so the rest of the file is never read. Otherwise the file is
+        read through and only the chosen lines are parsed.
+        """
+        sampler = rec.Sampler(every, random, first, last, seed)
+        if isinstance(file, str):
+            records = self.record_set(os.path.basename(file))
+            lines = None
+            with open_input(file, "rb") as file_obj:
+                # Only plain files can be seeked; pipes and compressed
+                # files are read through.
+                if file_obj.seekable():
+                    lines = self._seek_sample(file_obj, sampler, encoding)
+                    if lines is None:
+                        file_obj.seek(0)
+                if lines is None:
+                    text = io.TextIOWrapper(file_obj, encoding)
+                    lines = list(sampler.select(text))
+        else:
+            records = self.record_set()
+            lines = sampler.select(file)
+        parsed = (self.parse_raw(line, index + 1) for index, line in lines)
+        for record in rec.post_processed(self, parsed):
+            records.append(record)
+        return records
+
+    def _seek_sample(self, file_obj, sampler, encoding):
+        """[(index, line)] of the sample read by seeking, or None if the
+        lines of file_obj are not all the same length. Each line read is
+        checked to start after a line ending and to hold no other.
+        """
+        first = file_obj.readline()
+        if not first.endswith(b"\n"):
+            return None
+        size = len(first)
+        end = file_obj.seek(0, os.SEEK_END)
+        count, tail = divmod(end, size)
+        if tail:
+            # Only a last line without its line ending may be short.
+            ending = 2 if first.endswith(b"\r\n") else 1
+            if tail != size - ending:
+                return None
+            count += 1
+        if not encoding:
+            import locale
+
+            encoding = locale.getpreferredencoding(False)
+        lines = []
+        for index in sampler.indexes(count):
+            if index:
+                file_obj.seek(index * size - 1)
+                if file_obj.read(1) != b"\n":
+                    return None
+            else:
+                file_obj.seek(0)
+            data = file_obj.read(size)
+            if index < count - 1 or not tail:
+                if len(data) != size or data.find(b"\n") != size - 1:
+                    return None
+            elif b"\n" in data:
+                return None
+            lines.append((index, data.rstrip(b"\r\n").decode(encoding)))
+        return lines
+
+    def scan(self, file_obj, max_errors=10):
+        """Check the lines of file_obj without building records or
+        converting values and return a rec.ScanReport. Each field's check
+        is run on its slice of the line, Multi repetitions and RecordList
+        sub-fields included, and only slices that fail it are converted, to
+        count every error parse would. Layouts that do not compile to fixed
+        offsets are parsed record by record instead.
+        """
+        report = rec.ScanReport(max_errors)
+        plan = scan_plan(self.layout) if self.sliced else None
+        if plan is None:
+            for record in self._iter_records(file_obj):
+                report.add_errors(record)
+            return report
+
+        width = self.layout.width
+        for line_no, line in enumerate(file_obj, 1):
+            if line and line[-1] == "\n":
+                line = line[:-1]
+            size = len(line)
+            if size != width and not (size == width + 1 and line[-1] == "\r"):
+                report.width_error(line_no, size)
+            failed = False
+            for name, check, start, end in plan:
+                messages = check(line[start:end])
+                if messages:
+                    for msg in messages:
+                        report.error(name, line_no, line[start:end], msg)
+                    failed = True
+            report.record(failed)
+        return report
+
+    def transcode(
+        self, file_obj, out, rejects=None, fields=None, raw=False, batch_size=1000
+    ):
+        """Convert the lines of file_obj straight to rows of text written
+        to out, a csv.writer or anything with a writerows method, without
+        building Records. Values are written as util.csv_cell gives them,
+        warnings are dropped and the post processing hooks are not called.
+        fields names the columns to write, by default every field.
+
+        With rejects, a csv.writer too, lines with errors are left out and
+        (line_no, field, value, message) rows are written to rejects for
+        each error. With raw, String fields that only strip white space are
+        sliced and stripped without being converted.
+
+        Rows are written batch_size at a time from buffers that are reused,
+        so out must not keep the lists it is given. Returns a
+        rec.ScanReport of the errors.
+        """
+        report = rec.ScanReport()
+        names = fields or [f.name for f in self.fields]
+        layout = self.layout
+        if not self.sliced:
+            return self._transcode_records(file_obj, out, rejects, names, report)
+
+        offsets = dict((f.name, (f, pos)) for f, pos in layout.offsets)
+        failures = []
+        columns = []
+        for name in names:
+            field, pos = offsets[name]
+            err = lambda m, v=None, field=field: failures.append((field, v, m))
+            end = pos + field_width(field)
+            columns.append((_cell(field, raw), pos, end, err))
+
+        size = len(columns)
+        batch = [[None] * size for i in range(batch_size)]
+        k = 0
+        for line_no, line in enumerate(file_obj, 1):
+            if line[-1:] == "\n":
+                line = line[:-1]
+            row = batch[k]
+            i = 0
+            for cell, start, end, err in columns:
+                row[i] = cell(line[start:end], err)
+                i += 1
+            if failures:
+                report.record(True)
+                for field, value, msg in failures:
+                    report.error(field.name, line_no, value, msg)
+                reject = [(line_no, f.name, csv_cell(v), m) for f, v, m in failures]
+                del failures[:]
+                if rejects is not None:
+                    rejects.writerows(reject)
+                    continue
+            else:
+                report.record(False)
+            k += 1
+            if k == batch_size:
+                out.writerows(batch)
+                k = 0
+        if k:
+            out.writerows(batch[:k])
+        return report
+
+    def _transcode_records(self, file_obj, out, rejects, names, report):
+        for record in self._iter_records(file_obj):
+            report.add_errors(record)
+            if record.errors and rejects is not None:
+                rejects.writerows(
+                    (record.line_no, f.name, csv_cell(v), m)
+                    for f, v, m, c in record.errors
+                )
+                continue
+            out.writerows([[csv_cell(record.get(name)) for name in names]])
+        return report
 
     def parseline(self, stream):
         # Possible that a file object was passed in
@@ -62,27 +359,163 @@ class Parser:
         record.parse(stream)
         return record
 
-    def parse_file(self, path, *args, **kwargs):
-        file_obj = open(self.file_name, *args, **kwargs)
-        records = self.parse(file_obj, os.path.basename(self.file_name))
-        file_obj.close()
+    def parse_file(self, path, mode="r", *, progress=None, **kwargs):
+        """Parse the file at path, which may be gzip, bz2 or xz compressed.
+        mode and the other arguments, which are keyword only since they do
+        not follow the order of open's, are passed on to util.open_input.
+        """
+        with open_input(path, mode, **kwargs) as file_obj:
+            return self.parse(file_obj, os.path.basename(path), progress)
+
+    def parse_many(self, files, jobs=None, progress=None):
+        """Parse each of files, paths or file objects, in a pool of jobs
+        threads. Returns a list of RecordSets in the order of files.
+        progress reports on all the files together.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        files = list(files)
+        progress = rec.tracked(progress)
+        if progress is not None and progress.total is None:
+            from reclib.progress import total_size
+
+            progress.total = total_size(files)
+        with ThreadPoolExecutor(jobs) as pool:
+            if progress is None:
+                parts = itertools.repeat(None)
+            else:
+                parts = (progress.part() for file in files)
+            results = list(pool.map(self._parse_one, files, parts))
+        if progress is not None:
+            progress.finish()
+        return results
+
+    def _parse_one(self, file, progress=None):
+        if isinstance(file, str):
+            return self.parse_file(file, progress=progress)
+        return self.parse(file, progress=progress)
+
+    def parse_threaded(
+        self, file_obj, src=None, jobs=None, chunk_size=2000, progress=None
+    ):
+        """Parse file_obj like parse, converting chunks of chunk_size lines
+        in a pool of jobs threads. Records are appended in line order, and
+        the post processing hooks are called in the calling thread, in
+        order, as parse calls them. Layouts that do not compile to fixed
+        offsets are parsed serially.
+        """
+        if jobs == 1 or not self.sliced:
+            return self.parse(file_obj, src, progress)
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        progress = rec.tracked(progress, file_obj)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        records = self.record_set(src)
+        lines = chunks(enumerate(file_obj, 1), chunk_size)
+        with ThreadPoolExecutor(jobs) as pool:
+            batches = ordered_map(pool, self._parse_chunk, lines, (jobs or 4) * 2)
+            parsed = itertools.chain.from_iterable(batches)
+            for record in rec.post_processed(self, parsed, progress):
+                records.append(record)
+        if progress is not None:
+            progress.finish()
         return records
 
-    def parse_iter(self, file=None):
+    def _parse_chunk(self, lines):
+        batch = []
+        for line_no, line in lines:
+            record = self.parse_raw(line, line_no)
+            batch.append(record)
+        return batch
+
+    def parse_iter(self, file=None, progress=None):
         if file is None:
-            file_obj, src = open(self.file_name), self.file_name
-        elif isinstance(file, str):
-            file_obj, src = open(file), file
-        else:
-            file_obj, src = file, None
-        stream = RecordStream(file_obj)
-        records = rec.RecordSet(src)
-        while not stream.eof:
-            record = self.parseline(stream)
-            if not stream.eof:
-                self.post_process(record)
+            file = self.file_name
+        if not isinstance(file, str):
+            for record in self._iter_tracked(file, progress):
+                yield record
+            return
+        with open_input(file) as file_obj:
+            for record in self._iter_tracked(file_obj, progress):
                 yield record
 
+    def _iter_tracked(self, file_obj, progress):
+        progress = rec.tracked(progress, file_obj)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        records = self._iter_records(file_obj)
+        try:
+            for record in rec.post_processed(self, records, progress):
+                yield record
+        finally:
+            if progress is not None:
+                progress.finish()
+
+    def parse_pipelined(
+        self, file=None, jobs=1, chunk_size=2000, ahead=4, progress=None
+    ):
+        """Yield the records of file like parse_iter, with reading, parsing
+        and the consumer in stages of their own. Lines are read chunk_size
+        at a time in a thread, up to ahead chunks before they are parsed,
+        and parsed in a pool of jobs threads, up to ahead chunks before
+        they are consumed. Records come in line order, and the post
+        processing hooks run in the consumer's thread, as in parse_iter.
+
+        An error reading is raised to the consumer after the records read
+        before it. An error parsing is raised in place of the records of
+        its chunk, and an error in the hooks in place of those of its
+        batch, after the records of the chunks or batches before.
+        Closing the generator stops the threads.
+
+        Layouts that do not compile to fixed offsets are read ahead but
+        parsed in the consumer's thread.
+        """
+        if file is None:
+            file = self.file_name
+        file_obj = open_input(file) if isinstance(file, str) else file
+        stages = self._pipeline(file_obj, jobs, chunk_size, ahead, progress)
+        try:
+            for record in stages:
+                yield record
+        finally:
+            # Stop the reader before closing the file under it.
+            stages.close()
+            if file_obj is not file:
+                file_obj.close()
+
+    def _pipeline(self, file_obj, jobs, chunk_size, ahead, progress):
+        from concurrent.futures import ThreadPoolExecutor
+
+        progress = rec.tracked(progress, file_obj)
+        if progress is not None:
+            file_obj = progress.lines(file_obj)
+        if not self.sliced:
+            blocks = read_ahead(chunks(file_obj, chunk_size), ahead)
+            try:
+                lines = itertools.chain.from_iterable(blocks)
+                records = self._iter_records(lines)
+                for record in rec.post_processed(self, records, progress):
+                    yield record
+            finally:
+                blocks.close()
+                if progress is not None:
+                    progress.finish()
+        else:
+            blocks = read_ahead(chunks(enumerate(file_obj, 1), chunk_size), ahead)
+            with ThreadPoolExecutor(jobs) as pool:
+                batches = ordered_map(pool, self._parse_chunk, blocks, ahead)
+                try:
+                    parsed = itertools.chain.from_iterable(batches)
+                    for record in rec.post_processed(self, parsed, progress):
+                        yield record
+                finally:
+                    batches.close()
+                    blocks.close()
+                    if progress is not None:
+                        progress.finish()
+
 
 class RecordStream(object):
     def __init__(self, file_obj):
@@ -93,6 +526,7 @@ class RecordStream(object):
         self._file_obj = file_obj
         self._line_iter = iter(file_obj)
         self._cur_line = None
+        self._log = logger()
 
     def move_next(self):
         """Advance to the next line. This must be called between every
@@ -108,7 +542,7 @@ class RecordStream(object):
         if line_str and line_str[-1] == "\n":
             line_str = line_str[:-1]  # Wack off the \n from the end
         self.dead_read = False
-        self._cur_line = six.StringIO(line_str)
+        self._cur_line = io.StringIO(line_str)
         self.line_no += 1
         self._current_column = 0
 
@@ -120,7 +554,7 @@ class RecordStream(object):
             return ""
 
         bytes = self._cur_line.read(size)
-        log.debug("read %r", bytes)
+        self._log.debug("read %r", bytes)
         self._current_column += len(bytes)
         if len(bytes) == 0:
             self.dead_read = True
@@ -136,6 +570,189 @@ class RecordStream(object):
         return getattr(self.file_obj, attr)
 
 
+class Layout(object):
+    """The offsets of a list of fields within a fixed width line.
+
+    A field can be placed at a fixed offset if it has an assign_slice
+    method that its class's parse and assign are not overridden past, and
+    a known width: its width attribute, or its length for simple fields.
+    If any field cannot be placed, offsets and width are None and the line
+    has to be read through a RecordStream instead. spans maps the name of
+    each field to its (start, end) columns, and nested lists the names of
+    the Multi and RecordList fields, whose values are lists.
+    """
+
+    def __init__(self, fields, spacing=0):
+        self.fields = fields
+        self.spacing = spacing
+        self.offsets = None
+        self.width = None
+        self.spans = None
+        self.nested = None
+
+        offsets = []
+        pos = 0
+        for j, field in enumerate(fields):
+            width = field_width(field)
+            if width is None:
+                return
+            offsets.append((field, pos))
+            pos += width
+            if j != (len(fields) - 1) and spacing:
+                pos += spacing
+        self.offsets = offsets
+        self.width = pos
+        self.blank = dict.fromkeys(f.name for f in fields)
+        self.spans = dict(
+            (f.name, (start, start + field_width(f))) for f, start in offsets
+        )
+        self.nested = [
+            f.name for f in fields if isinstance(f, (Multi, RecordList))
+        ]
+
+    @property
+    def compiled(self):
+        return self.offsets is not None
+
+
+def _cell(field, raw=False, memo_size=4096):
+    """A function of (text, err) that gives the text Parser.transcode
+    writes for the raw text of field. Results of text that converted
+    without errors are memoized until memo_size distinct texts have been
+    seen, after which the column is taken to be high cardinality.
+    """
+    strip = _strip_only(field) if raw else None
+    if strip is not None:
+        return lambda text, err: strip(text)
+
+    convert = getattr(field, "convert", None)
+    if convert is None:
+        name = field.name
+
+        def convert(text, err, warn):
+            scratch = {}
+            field.assign_slice(scratch, text, 0, err, warn)
+            return scratch[name]
+
+    memo = {}
+
+    def cell(text, err):
+        nonlocal memo
+        if memo is not None:
+            try:
+                return memo[text]
+            except KeyError:
+                pass
+        failed = []
+        value = convert(text, lambda m, v=None: failed.append((m, v)), _ignore)
+        if value is None:
+            value = ""
+        elif value.__class__ is not str:
+            value = csv_cell(value)
+        if failed:
+            for m, v in failed:
+                err(m, v)
+        elif memo is not None:
+            if len(memo) >= memo_size:
+                memo = None
+            else:
+                memo[text] = value
+        return value
+
+    return cell
+
+
+def _ignore(msg, value=None):
+    pass
+
+
+def _strip_only(field):
+    """The str method that is all the conversion field does if it is a
+    String that only strips white space, else None.
+    """
+    if type(field) is not String or not field.length:
+        return None
+    if (
+        field.values
+        or field.regex
+        or field.title
+        or field.upper
+        or field.lower
+        or field.tr
+        or field.regex_sub
+        or field.validate_blank
+        or field.required
+    ):
+        return None
+    if field.strip_left and field.strip_right:
+        return str.strip
+    if field.strip_left:
+        return str.lstrip
+    if field.strip_right:
+        return str.rstrip
+    return str
+
+
+def field_width(field):
+    """The number of characters field reads from a line, or None if it does
+    not read a fixed amount.
+    """
+    if not _slices_as_parsed(field):
+        return None
+    width = getattr(field, "width", None)
+    if width is None:
+        width = getattr(field, "length", None)
+    if not isinstance(width, int):
+        return None
+    return width
+
+
+def _slices_as_parsed(field):
+    """Whether field has an assign_slice that gives what its parse and
+    assign do: one defined by the same class as them or a subclass. A
+    subclass that only overrides parse or assign has to be read through a
+    RecordStream.
+    """
+    for klass in type(field).__mro__:
+        attrs = vars(klass)
+        if "assign_slice" in attrs:
+            return True
+        if "parse" in attrs or "assign" in attrs:
+            return False
+    return False
+
+
+def scan_plan(layout, start=0):
+    """[(name, check, start, end)] for every simple field slice of a
+    compiled layout, or None if the layout has fields that cannot be
+    checked by slice.
+    """
+    if not layout.compiled:
+        return None
+    plan = []
+    for field, pos in layout.offsets:
+        pos += start
+        if isinstance(field, Multi):
+            stype = field.stype
+            check = rec.checker(stype, stype.convert)
+            for i in range(field.count):
+                begin = pos + i * stype.length
+                plan.append((stype.name, check, begin, begin + stype.length))
+        elif isinstance(field, RecordList):
+            sub = field.layout
+            for i in range(field.count):
+                sub_plan = scan_plan(sub, pos + i * sub.width)
+                if sub_plan is None:
+                    return None
+                plan.extend(sub_plan)
+        elif hasattr(field, "convert"):
+            check = rec.checker(field, field.convert)
+            plan.append((field.name, check, pos, pos + field.length))
+        else:
+            return None
+    return plan
+
+
 class Record(dict):
     def __init__(self, fields, spacing):
         self.fields = fields
@@ -161,6 +778,28 @@ class Record(dict):
             if j != (len(self.fields) - 1) and self.spacing:
                 stream.read(self.spacing)
 
+    def parse_slices(self, line, line_no, layout, start=0):
+        """Parse line, which starts at the given column, with the offsets
+        of a compiled Layout.
+        """
+        self.line_no = line_no
+        self.update(layout.blank)
+
+        # One pair of callbacks for the whole line; current holds the field
+        # being assigned and its column. A RecordStream reports the column
+        # it actually got to, which stops at the end of a short line.
+        current = [None, 0]
+        errors = self.errors
+        warnings = self.warnings
+        err = lambda m, v=None: errors(current[0], v, m, current[1])
+        warn = lambda m, v=None: warnings(current[0], v, m, current[1])
+        size = len(line)
+        for field, pos in layout.offsets:
+            pos += start
+            current[0] = field
+            current[1] = pos if pos < size else size
+            field.assign_slice(self, line, pos, err, warn)
+
     def format(self):
         pad = max(len(v) for v in self)
         return "\n".join("%s: %r" % (k.ljust(pad), self[k]) for k in self)
@@ -169,6 +808,61 @@ class Record(dict):
         return "line: %05d\n%s\n-----\n" % (self.line_no, self.errors.format())
 
 
+class EditRecord(Record):
+    """A Record that keeps the line it was parsed from and the names of the
+    fields set or deleted since, in edited, so that format.fw.Formatter can
+    write it back by re-formatting only those fields. spans is the
+    Layout.spans of the line. edited is None, and nothing is tracked, until
+    parse_slices has filled the record.
+    """
+
+    edited = None
+
+    def __init__(self, fields, spacing, line, spans):
+        Record.__init__(self, fields, spacing)
+        self.line = line
+        self.spans = spans
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if self.edited is not None:
+            self.edited.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        if self.edited is not None:
+            self.edited.add(key)
+
+    def parse_slices(self, line, line_no, layout, start=0):
+        """Parse like Record.parse_slices and track edits from then on. The
+        fields are parsed into a plain Record and copied over, as setting
+        each of them through __setitem__ would slow the parse by half.
+        Changes inside the lists of Multi and RecordList fields cannot be
+        seen, so those count as edited.
+        """
+        parsed = Record(self.fields, self.spacing)
+        parsed.parse_slices(line, line_no, layout, start)
+        dict.update(self, parsed)
+        self.line_no = line_no
+        self.errors = parsed.errors
+        self.warnings = parsed.warnings
+        self.edited = set(layout.nested)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self and self.edited is not None:
+            self.edited.add(key)
+        return dict.pop(self, key, *default)
+
+
 class Multi(object):
     """Multi-value field. Appends the value of the given in a list."""
 
@@ -206,6 +900,35 @@ class Multi(object):
         for k, v in list(self.parse(stream, err, warn).items()):
             record[k] = v
 
+    @property
+    def width(self):
+        if field_width(self.stype) is None or not hasattr(self.stype, "convert"):
+            return None
+        return self.stype.length * self.count
+
+    def assign_slice(self, record, line, start, err, warn):
+        stype = self.stype
+        convert = stype.convert
+        length = stype.length
+        values = [
+            convert(line[start + i * length : start + (i + 1) * length], err, warn)
+            for i in range(self.count)
+        ]
+
+        columns = [(stype.name, values)]
+        derive = getattr(stype, "derive", None)
+        if derive is not None:
+            derived = [derive(v) for v in values]
+            for i, key in enumerate(stype.derived_keys):
+                columns.append((key, [d[i] for d in derived]))
+
+        for k, v in columns:
+            if self.join is not None:
+                v = self.join.join(v)
+                if self.rstrip:
+                    v = v.rstrip()
+            record[k] = v
+
 
 class RecordList(object):
     """A list of sub-records in a main record. Similar to Multi, but parses
@@ -232,6 +955,30 @@ class RecordList(object):
     def assign(self, record, stream, err, warn):
         record[self.name] = self.parse(stream, err, warn)
 
+    @property
+    def layout(self):
+        layout = self.__dict__.get("_layout")
+        if layout is None or layout.fields is not self.fields:
+            layout = self._layout = Layout(self.fields, self.spacing)
+        return layout
+
+    @property
+    def width(self):
+        layout = self.layout
+        if not layout.compiled:
+            return None
+        return layout.width * self.count
+
+    def assign_slice(self, record, line, start, err, warn):
+        layout = self.layout
+        line_no = getattr(record, "line_no", None)
+        records = []
+        for i in range(self.count):
+            sub = Record(self.fields, self.spacing)
+            sub.parse_slices(line, line_no, layout, start + i * layout.width)
+            records.append(sub)
+        record[self.name] = records
+
 
 class String(object):
     def __init__(self, name, length, **kw):
@@ -250,11 +997,17 @@ class String(object):
         self.tr_match = kw.get("tr_match", True)
         self.regex_sub = kw.get("regex_sub")
         self.regex_replace = kw.get("regex_replace", "")
+        self.intern = intern_table(kw.get("intern", False))
 
     def parse(self, stream, err, warn):
         if self.length == 0:
             return ""
-        value = stream.read(self.length)
+        return self.convert(stream.read(self.length), err, warn)
+
+    def convert(self, value, err, warn):
+        """Convert the raw text of the field."""
+        if self.length == 0:
+            return ""
         # Manage white space
         if self.strip_left:
             value = value.lstrip()
@@ -288,11 +1041,40 @@ class String(object):
             value = value.upper()
         if self.lower:
             value = value.lower()
+        if self.intern is not None:
+            value = self.intern(value)
         return value
 
     def assign(self, record, stream, err, warn):
         record[self.name] = self.parse(stream, err, warn)
 
+    def assign_slice(self, record, line, start, err, warn):
+        record[self.name] = self.convert(line[start : start + self.length], err, warn)
+
+    def check(self, value):
+        """The first error convert would report for the raw text of the
+        field, or None. Used by scans, so it does not transform the value
+        more than it has to.
+        """
+        if self.length == 0:
+            return
+        if self.strip_left:
+            value = value.lstrip()
+        if self.strip_right:
+            value = value.rstrip()
+        if self.required and value == "":
+            return "missing required value"
+        if value != "" or self.validate_blank:
+            if self.regex and not re.match(self.regex, value):
+                return "does not match pattern %s" % self.regex
+            if self.values and value not in self.values:
+                return "unexpected value"
+        if self.tr and self.tr_match:
+            if self.regex_sub:
+                value = re.sub(self.regex_sub, self.regex_replace, value)
+            if value not in self.tr:
+                return "unexpected value"
+
 
 class Date(object):
     zero_pat = re.compile("^0+$")
@@ -314,25 +1096,30 @@ class Date(object):
         self.none_if_invalid = none_if_invalid
         self.val_format = val_format
         self.min_year = min_year
+        self.derived_keys = ("%s_fmt" % name, "%s_iso" % name)
 
     def parse(self, stream, err, warn):
         if self.length == 0:
             return
-        value = stream.read(self.length).strip()
+        return self.convert(stream.read(self.length), err, warn)
+
+    def convert(self, value, err, warn):
+        """Convert the raw text of the field."""
+        if self.length == 0:
+            return
+        value = value.strip()
         if self.zero_pat.match(value):
             value = ""
         if not value:
             if self.required:
                 err("missing required value", value)
             return
-        else:
-            try:
-                value = time.strptime(value, self.format)
-                value = datetime.date(*(value[:3]))
-            except ValueError:
-                if not self.none_if_invalid:
-                    err("invalid date, expected format %r" % self.format, value)
-                return
+        parts = date_tuple(value, self.format)
+        if parts is None:
+            if not self.none_if_invalid:
+                err("invalid date, expected format %r" % self.format, value)
+            return
+        value = datetime.date(*parts)
         if self.min_year and value.year < self.min_year:
             err("Expected year after %s" % self.min_year, value)
             return
@@ -344,14 +1131,41 @@ class Date(object):
         return value
 
     def assign(self, record, stream, err, warn):
-        field = self.name
-        record[field] = self.parse(stream, err, warn)
-        if record[field] and isinstance(record[field], datetime.date):
-            record["%s_fmt" % field] = strftime(record[field], "%m/%d/%Y")
-            record["%s_iso" % field] = strftime(record[field], "%Y%m%d")
-        else:
-            record["%s_fmt" % field] = ""
-            record["%s_iso" % field] = ""
+        self.store(record, self.parse(stream, err, warn))
+
+    def assign_slice(self, record, line, start, err, warn):
+        value = self.convert(line[start : start + self.length], err, warn)
+        self.store(record, value)
+
+    def store(self, record, value):
+        record[self.name] = value
+        fmt_key, iso_key = self.derived_keys
+        record[fmt_key], record[iso_key] = self.derive(value)
+
+    def derive(self, value):
+        """The values stored under derived_keys next to value."""
+        if value and isinstance(value, datetime.date):
+            return strftime(value, "%m/%d/%Y"), strftime(value, "%Y%m%d")
+        return "", ""
+
+    def check(self, value):
+        """The first error convert would report for the raw text of the
+        field, or None.
+        """
+        if self.length == 0:
+            return
+        value = value.strip()
+        if not value or self.zero_pat.match(value):
+            if self.required:
+                return "missing required value"
+            return
+        parts = date_tuple(value, self.format)
+        if parts is None:
+            if not self.none_if_invalid:
+                return "invalid date, expected format %r" % self.format
+            return
+        if self.min_year and parts[0] < self.min_year:
+            return "Expected year after %s" % self.min_year
 
 
 class Datetime(object):
@@ -383,11 +1197,18 @@ class Datetime(object):
         self.none_if_invalid = none_if_invalid
         self.val_format = val_format
         self.min_year = min_year
+        self.derived_keys = ("%s_fmt" % name, "%s_iso" % name)
 
     def parse(self, stream, err, warn):
         if self.length == 0:
             return
-        value = stream.read(self.length).strip()
+        return self.convert(stream.read(self.length), err, warn)
+
+    def convert(self, value, err, warn):
+        """Convert the raw text of the field."""
+        if self.length == 0:
+            return
+        value = value.strip()
         if not value:
             if self.required:
                 err("missing required value", value)
@@ -413,14 +1234,22 @@ class Datetime(object):
         return value
 
     def assign(self, record, stream, err, warn):
-        field = self.name
-        record[field] = self.parse(stream, err, warn)
-        if record[field] and isinstance(record[field], datetime.date):
-            record["%s_fmt" % field] = strftime(record[field], "%x %X")
-            record["%s_iso" % field] = strftime(record[field], "%Y%m%d %H:%M")
-        else:
-            record["%s_fmt" % field] = ""
-            record["%s_iso" % field] = ""
+        self.store(record, self.parse(stream, err, warn))
+
+    def assign_slice(self, record, line, start, err, warn):
+        value = self.convert(line[start : start + self.length], err, warn)
+        self.store(record, value)
+
+    def store(self, record, value):
+        record[self.name] = value
+        fmt_key, iso_key = self.derived_keys
+        record[fmt_key], record[iso_key] = self.derive(value)
+
+    def derive(self, value):
+        """The values stored under derived_keys next to value."""
+        if value and isinstance(value, datetime.date):
+            return strftime(value, "%x %X"), strftime(value, "%Y%m%d %H:%M")
+        return "", ""
 
 
 class Currency(object):
@@ -437,7 +1266,13 @@ class Currency(object):
     def parse(self, stream, err, warn):
         if self.length == 0:
             return
-        value = stream.read(self.length).strip()
+        return self.convert(stream.read(self.length), err, warn)
+
+    def convert(self, value, err, warn):
+        """Convert the raw text of the field."""
+        if self.length == 0:
+            return
+        value = value.strip()
         if not value:
             if self.required:
                 err("missing required value")
@@ -462,12 +1297,35 @@ class Currency(object):
     def assign(self, record, stream, err, warn):
         record[self.name] = self.parse(stream, err, warn)
 
+    def assign_slice(self, record, line, start, err, warn):
+        record[self.name] = self.convert(line[start : start + self.length], err, warn)
+
+    def check(self, value):
+        """The first error convert would report for the raw text of the
+        field, or None.
+        """
+        if self.length == 0:
+            return
+        value = value.strip()
+        if not value:
+            if self.required:
+                return "missing required value"
+            if self.nonzero:
+                return "value cannot be zero"
+            return
+        error = decimal_error(value)
+        if error is not None:
+            return error
+        if self.nonzero and decimal_is_zero(value):
+            return "value cannot be zero"
+
 
 Numeric = Currency
 
 
 class Integer(object):
-    sexp = re.compile("[^\d]")
+    sexp = re.compile(r"[^\d]")
+    digit = re.compile(r"\d")
 
     def __init__(self, name, length, required=False, strip_nonnumeric=True):
         self.name = name
@@ -478,7 +1336,13 @@ class Integer(object):
     def parse(self, stream, err, warn):
         if self.length == 0:
             return
-        value = stream.read(self.length).strip()
+        return self.convert(stream.read(self.length), err, warn)
+
+    def convert(self, value, err, warn):
+        """Convert the raw text of the field."""
+        if self.length == 0:
+            return
+        value = value.strip()
         if self.strip_nonnumeric:
             value = self.sexp.sub("", value)
         try:
@@ -490,3 +1354,20 @@ class Integer(object):
 
     def assign(self, record, stream, err, warn):
         record[self.name] = self.parse(stream, err, warn)
+
+    def assign_slice(self, record, line, start, err, warn):
+        record[self.name] = self.convert(line[start : start + self.length], err, warn)
+
+    def check(self, value):
+        """The first error convert would report for the raw text of the
+        field, or None.
+        """
+        if self.length == 0:
+            return
+        value = value.strip()
+        if self.strip_nonnumeric:
+            valid = self.digit.search(value) is not None
+        else:
+            valid = is_int(value)
+        if not valid:
+            return "cannot translate to number"
@@ -0,0 +1,368 @@
+""" NumPy backend for fixed width files.
+
+Views a file of equal length lines as a structured array of S<n> fields laid
+out like the fields of a fw.Parser, without copying it, and converts whole
+columns at a time:
+
+    table = fwarray.parse_file(MyParser(), "claims.txt")
+    table["amount"]          # float64 array
+    table.errors["amount"]   # bool array, True where the field had an error
+
+Integer columns become int64, Currency float64, Date datetime64[D] (but
+object arrays of text when it has a val_format) and simple String columns
+unicode arrays. Rows that the vectorized code does not
+recognize are converted one at a time by the field itself, so the values
+and errors match fw.Parser. Other fields become object arrays of what the
+field would have stored in a Record.
+
+Widths are in bytes. NumPy is an optional dependency: pip install
+reclib[numpy].
+"""
+
+import mmap
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:  # pragma: no cover
+    np = None
+
+from . import fw
+
+
+class Table(object):
+    """Converted columns and per field error masks of a parsed file."""
+
+    def __init__(self, columns, errors, size):
+        self.columns = columns
+        self.errors = errors
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("reclib.parse.fwarray requires numpy")
+
+
+def record_dtype(parser, itemsize=None):
+    """The structured dtype of one line of parser's layout. itemsize is the
+    length of a line including its line ending, which defaults to the
+    layout width plus one for "\\n".
+    """
+    _require_numpy()
+    layout = parser.layout
+    if not layout.compiled:
+        raise ValueError("%r does not have a fixed width layout" % parser)
+    if itemsize is None:
+        itemsize = layout.width + 1
+    return np.dtype(
+        {
+            "names": [f.name for f, pos in layout.offsets],
+            "formats": ["S%d" % fw.field_width(f) for f, pos in layout.offsets],
+            "offsets": [pos for f, pos in layout.offsets],
+            "itemsize": itemsize,
+        }
+    )
+
+
+def parse_file(parser, path, encoding="latin-1"):
+    """Memory map the file at path and parse it with parse_buffer."""
+    with open(path, "rb") as f:
+        if not f.seek(0, 2):
+            return parse_buffer(parser, b"", encoding)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return parse_buffer(parser, buf, encoding)
+
+
+def parse_buffer(parser, buf, encoding="latin-1"):
+    """Parse a bytes-like object of equal length lines into a Table."""
+    _require_numpy()
+    layout = parser.layout
+    first = buf.find(b"\n")
+    if first == -1:
+        first = len(buf)
+    itemsize = first + 1
+    if first and buf[first - 1 : first] == b"\r":
+        first -= 1
+    if len(buf) and first < layout.width:
+        raise ValueError(
+            "lines are %d bytes, the layout needs %d" % (first, layout.width)
+        )
+
+    count, tail = divmod(len(buf), itemsize)
+    if tail and tail != first:
+        raise ValueError("lines are not all %d bytes long" % itemsize)
+    u8 = np.frombuffer(buf, np.uint8)
+    ends = u8[itemsize - 1 : count * itemsize : itemsize]
+    if (ends != 10).any():
+        raise ValueError("lines are not all %d bytes long" % itemsize)
+
+    parts = [_convert(layout, u8, count, itemsize, encoding)]
+    if tail:
+        # The last line has no line ending.
+        ending = bytes(buf[first:itemsize]) or b"\n"
+        last = np.frombuffer(bytes(buf[count * itemsize :]) + ending, np.uint8)
+        parts.append(_convert(layout, last, 1, itemsize, encoding))
+        count += 1
+
+    columns = {}
+    errors = {}
+    for field, pos in layout.offsets:
+        columns[field.name] = _concat([p[0][field.name] for p in parts])
+        errors[field.name] = _concat([p[1][field.name] for p in parts])
+    return Table(columns, errors, count)
+
+
+def _concat(arrays):
+    if len(arrays) == 1:
+        return arrays[0]
+    return np.concatenate(arrays)
+
+
+def _convert(layout, u8, count, itemsize, encoding):
+    columns = {}
+    errors = {}
+    for field, pos in layout.offsets:
+        width = fw.field_width(field)
+        if count and width:
+            m = as_strided(u8[pos:], shape=(count, width), strides=(itemsize, 1))
+        else:
+            m = np.zeros((count, width), np.uint8)
+        convert = _convert_python
+        if width:
+            convert = _converters.get(type(field), _convert_python)
+        values, mask = convert(field, m, encoding)
+        columns[field.name] = values
+        errors[field.name] = mask
+    return columns, errors
+
+
+def _texts(m, rows, encoding):
+    """The decoded text of the given rows of a byte matrix."""
+    return [bytes(m[i]).decode(encoding) for i in rows]
+
+
+def _convert_python(field, m, encoding, rows=None, values=None, mask=None):
+    """Convert rows of m one at a time with the field itself."""
+    if rows is None:
+        rows = range(len(m))
+        values = np.empty(len(m), object)
+        mask = np.zeros(len(m), bool)
+    failed = []
+    err = lambda msg, v=None: failed.append(True)
+    warn = lambda msg, v=None: None
+    scratch = {}
+    for i, text in zip(rows, _texts(m, rows, encoding)):
+        del failed[:]
+        if hasattr(field, "convert"):
+            value = field.convert(text, err, warn)
+        else:
+            field.assign_slice(scratch, text, 0, err, warn)
+            value = scratch.get(field.name)
+        if values.dtype.kind == "M":
+            value = np.datetime64(value) if value is not None else "NaT"
+        elif values.dtype.kind != "O" and value is None:
+            value = 0
+        values[i] = value
+        mask[i] = bool(failed)
+    return values, mask
+
+
+def _digits(m):
+    return (m >= 48) & (m <= 57)
+
+
+def _number(m, digits):
+    """The int64 value of the digits of each row of m, ignoring other bytes."""
+    # The power of ten of a digit is the number of digits to its right.
+    right = np.cumsum(digits[:, ::-1], axis=1)[:, ::-1] - digits
+    power = np.power(np.int64(10), right.astype(np.int64))
+    return np.where(digits, (m.astype(np.int64) - 48) * power, 0).sum(axis=1)
+
+
+def _one_run(mask):
+    """Rows where the True values of mask are contiguous and not empty."""
+    starts = mask & ~np.pad(mask, ((0, 0), (1, 0)))[:, :-1]
+    return starts.sum(axis=1) == 1
+
+
+def _convert_integer(field, m, encoding):
+    if m.shape[1] > 18:
+        return _convert_python(field, m, encoding)
+    digits = _digits(m)
+    values = _number(m, digits)
+    if field.strip_nonnumeric:
+        # Anything that is not a digit is thrown away.
+        return values, ~digits.any(axis=1)
+    space = m == 32
+    simple = (digits | space).all(axis=1) & _one_run(digits)
+    blank = space.all(axis=1)
+    mask = blank.copy()
+    values[blank] = 0
+    other = np.flatnonzero(~simple & ~blank)
+    return _convert_python(field, m, encoding, other, values, mask)
+
+
+def _convert_currency(field, m, encoding):
+    count, width = m.shape
+    if width > 18:
+        values, mask = _convert_python(field, m, encoding)
+        return np.array([float(v) if v is not None else 0.0 for v in values]), mask
+    digits = _digits(m)
+    space = m == 32
+    dot = m == 46
+    minus = m == 45
+    first = np.argmax(~space, axis=1)
+    simple = (
+        (digits | space | dot | minus).all(axis=1)
+        & _one_run(~space)
+        & digits.any(axis=1)
+        & (dot.sum(axis=1) <= 1)
+        & (minus.sum(axis=1) <= 1)
+        & (~minus.any(axis=1) | minus[np.arange(count), first])
+    )
+    # Digits after the decimal point scale the mantissa down.
+    after = np.cumsum(dot, axis=1) > 0
+    scale = (digits & after).sum(axis=1)
+    if field.implicit:
+        scale = scale + int(field.implicit)
+    # One division so that the result is the float nearest the decimal.
+    values = _number(m, digits) / np.power(10.0, scale)
+    values = np.where(minus.any(axis=1), -values, values)
+
+    blank = space.all(axis=1)
+    values[blank] = 0.0
+    mask = np.zeros(count, bool)
+    if field.required:
+        mask |= blank
+    if field.nonzero:
+        mask |= (simple | blank) & (values == 0)
+
+    other = np.flatnonzero(~simple & ~blank)
+    if len(other):
+        objs, omask = _convert_python(field, m[other], encoding)
+        values[other] = [float(v) if v is not None else 0.0 for v in objs]
+        mask[other] = omask
+    return values, mask
+
+
+def _date_pattern(fmt):
+    """[(directive or literal byte, position)] for formats made only of %Y,
+    %m, %d and literal characters other than whitespace, else None.
+    """
+    pattern = []
+    pos = 0
+    i = 0
+    while i < len(fmt):
+        if fmt[i] == "%":
+            d = fmt[i + 1 : i + 2]
+            if d not in ("Y", "m", "d"):
+                return None
+            pattern.append((d, pos))
+            pos += 4 if d == "Y" else 2
+            i += 2
+        else:
+            if fmt[i].isspace() or ord(fmt[i]) > 127:
+                return None
+            pattern.append((ord(fmt[i]), pos))
+            pos += 1
+            i += 1
+    if sorted(d for d, p in pattern if isinstance(d, str)) != ["Y", "d", "m"]:
+        return None
+    return pattern, pos
+
+
+def _convert_date(field, m, encoding):
+    count, width = m.shape
+    if field.val_format:
+        # The values are text in val_format, not dates.
+        return _convert_python(field, m, encoding)
+    compiled = _date_pattern(field.format)
+    if compiled is None or compiled[1] > width:
+        values, mask = _convert_python(field, m, encoding)
+        return np.array(values, "datetime64[D]"), mask
+    pattern, size = compiled
+
+    digits = _digits(m)
+    space = m == 32
+    simple = space[:, size:].all(axis=1)
+    parts = {}
+    for d, pos in pattern:
+        if isinstance(d, str):
+            n = 4 if d == "Y" else 2
+            simple &= digits[:, pos : pos + n].all(axis=1)
+            parts[d] = _number(m[:, pos : pos + n], digits[:, pos : pos + n])
+        else:
+            simple &= m[:, pos] == d
+    year, month, day = parts["Y"], parts["m"], parts["d"]
+
+    blank = space.all(axis=1) | (
+        (m[:, :size] == 48).all(axis=1) & space[:, size:].all(axis=1)
+    )
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    last = month_days[np.clip(month, 0, 12)] + (leap & (month == 2))
+    valid = (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= last)
+
+    simple &= ~blank
+    good = simple & valid
+    values = np.full(count, "NaT", "datetime64[D]")
+    values[good] = (
+        (year[good] - 1970).astype("datetime64[Y]").astype("datetime64[M]")
+        + (month[good] - 1).astype("timedelta64[M]")
+    ).astype("datetime64[D]") + (day[good] - 1).astype("timedelta64[D]")
+    mask = np.zeros(count, bool)
+    if field.required:
+        mask |= blank
+    if not field.none_if_invalid:
+        mask |= simple & ~valid
+    if field.min_year:
+        young = good & (year < field.min_year)
+        mask |= young
+        values[young] = np.datetime64("NaT")
+
+    other = np.flatnonzero(~simple & ~blank)
+    return _convert_python(field, m, encoding, other, values, mask)
+
+
+def _convert_string(field, m, encoding):
+    count, width = m.shape
+    plain = not (
+        field.values
+        or field.regex
+        or field.title
+        or field.upper
+        or field.lower
+        or field.tr
+        or field.regex_sub
+        or field.validate_blank
+    )
+    if not plain or not width or (m == 0).any():
+        return _convert_python(field, m, encoding)
+    raw = np.ascontiguousarray(m).view("S%d" % width).reshape(count)
+    values = np.char.decode(raw, encoding)
+    if field.strip_left:
+        values = np.char.lstrip(values)
+    if field.strip_right:
+        values = np.char.rstrip(values)
+    mask = np.zeros(count, bool)
+    if field.required:
+        mask = values == ""
+    return values, mask
+
+
+_converters = {
+    fw.String: _convert_string,
+    fw.Integer: _convert_integer,
+    fw.Currency: _convert_currency,
+    fw.Date: _convert_date,
+}
@@ -1,4 +1,20 @@
+import collections
+import io
+import sys
+
+from reclib.util import chunks
+
+
 class RecordSet(list):
+    """The records of a parse. Indexes from index_by and the views from
+    accepted and rejected are kept up to date as records are appended; any
+    other change to the list makes them rebuild on their next use.
+    """
+
+    _version = 0
+    _indexes = None
+    _views = None
+
     def __init__(self, src=None):
         self.src = src
 
@@ -11,16 +27,581 @@ class RecordSet(list):
         return sum(len(x.errors) for x in self)
 
     def accepted(self):
-        x = RecordSet(self.src)
-        x.extend([r for r in self if not r.errors])
-        return x
+        """The records without errors. The same RecordSet is returned on
+        each call, with the records appended since filed into it. Errors
+        added to or removed from a record already filed, or changes to the
+        view itself, make the views file every record again.
+        """
+        return self._view(0)
 
     def rejected(self):
-        x = RecordSet(self.src)
-        x.extend([r for r in self if r.errors])
+        """The records with errors, like accepted."""
+        return self._view(1)
+
+    def _view(self, which):
+        if self._views is None:
+            self._views = _Views(self)
+        return self._views.sync()[which]
+
+    def index_by(self, *fields):
+        """The Index of the records by the values of fields. It is built on
+        first use and shared by every call with the same fields.
+        """
+        if self._indexes is None:
+            self._indexes = {}
+        index = self._indexes.get(fields)
+        if index is None:
+            index = self._indexes[fields] = Index(self, fields)
+        return index
+
+    def _changed(self):
+        self._version += 1
+
+    def __setitem__(self, i, value):
+        self._changed()
+        list.__setitem__(self, i, value)
+
+    def __delitem__(self, i):
+        self._changed()
+        list.__delitem__(self, i)
+
+    def __imul__(self, n):
+        self._changed()
+        return list.__imul__(self, n)
+
+    def insert(self, i, record):
+        self._changed()
+        list.insert(self, i, record)
+
+    def pop(self, *args):
+        self._changed()
+        return list.pop(self, *args)
+
+    def remove(self, record):
+        self._changed()
+        list.remove(self, record)
+
+    def clear(self):
+        self._changed()
+        list.clear(self)
+
+    def sort(self, *args, **kwargs):
+        self._changed()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._changed()
+        list.reverse(self)
+
+
+class _Views(object):
+    """The accepted and rejected views of a RecordSet. Records are filed
+    by whether they have errors when the views first see them, and their
+    RecordErrorSet is marked filed so that a change to it is counted in
+    RecordErrorSet.changes.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.views = (RecordSet(records.src), RecordSet(records.src))
+        self._size = 0
+        self._state = None
+
+    def _current(self):
+        accepted, rejected = self.views
+        return (self.records._version, RecordErrorSet.changes,
+                accepted._version, rejected._version,
+                len(accepted) + len(rejected))
+
+    def sync(self):
+        """The (accepted, rejected) views, with every record filed."""
+        records = self.records
+        if self._state != self._current():
+            for view in self.views:
+                view.clear()
+            self._size = 0
+        if self._size < len(records):
+            accepted, rejected = self.views
+            for record in records[self._size:]:
+                errors = record.errors
+                if isinstance(errors, RecordErrorSet):
+                    errors.filed = True
+                list.append(rejected if errors else accepted, record)
+            self._size = len(records)
+        self._state = self._current()
+        return self.views
+
+
+class Index(object):
+    """A hash index of the records of a RecordSet by the values of fields.
+    Keys are the value of a single field, or a tuple of the values of
+    several. Records appended to the set are indexed on the next lookup.
+    """
+
+    def __init__(self, records, fields):
+        if not fields:
+            raise ValueError("index_by needs at least one field")
+        self.records = records
+        self.fields = fields
+        self._map = {}
+        self._size = 0
+        self._version = None
+
+    def _sync(self):
+        records = self.records
+        if self._version != records._version:
+            self._map = {}
+            self._size = 0
+            self._version = records._version
+        if self._size < len(records):
+            index = self._map
+            fields = self.fields
+            if len(fields) == 1:
+                name = fields[0]
+                key = lambda r: r.get(name)
+            else:
+                key = lambda r: tuple([r.get(f) for f in fields])
+            for record in records[self._size:]:
+                index.setdefault(key(record), []).append(record)
+            self._size = len(records)
+        return self._map
+
+    def all(self, key):
+        """Every record with key, in set order."""
+        return list(self._sync().get(key, ()))
+
+    def get(self, key, default=None):
+        """The first record with key, or default."""
+        found = self._sync().get(key)
+        return found[0] if found else default
+
+    def one(self, key):
+        """The only record with key. KeyError if there is none and
+        ValueError if there is more than one.
+        """
+        found = self._sync()[key]
+        if len(found) > 1:
+            raise ValueError("%d records have key %r" % (len(found), key))
+        return found[0]
+
+    __getitem__ = one
+
+    def __contains__(self, key):
+        return key in self._sync()
+
+    def __len__(self):
+        return len(self._sync())
+
+    def keys(self):
+        return self._sync().keys()
+
+class SpillingRecordSet(object):
+    """A RecordSet that keeps at most about memory_budget bytes of records
+    in memory. Once the budget is exceeded the oldest records are pickled
+    to a temporary file in chunks of chunk_size records.
+
+    Counts of records and errors are kept per chunk, so len, error_size and
+    error_count never read the file back, and accepted and rejected skip or
+    copy whole chunks that have no errors or nothing but errors. Records
+    read back from the file are new objects on each read.
+    """
+
+    def __init__(self, src=None, memory_budget=64 * 2**20, chunk_size=1000,
+                 dir=None, registry=None):
+        self.src = src
+        self.memory_budget = memory_budget
+        self.chunk_size = chunk_size
+        self.dir = dir
+        self.registry = registry or FieldRegistry()
+        self._records = []
+        self._memory = 0
+        self._file = None
+        self._chunks = []
+        self._spilled = 0
+        self._cached = (None, None)
+
+    def append(self, record):
+        self.registry.register(record)
+        self._records.append(record)
+        self._memory += estimate_size(record)
+        if self._memory > self.memory_budget:
+            self._spill()
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return self._spilled + len(self._records)
+
+    def __iter__(self):
+        for index in range(len(self._chunks)):
+            for record in self._load(index):
+                yield record
+        for record in list(self._records):
+            yield record
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i >= self._spilled:
+            return self._records[i - self._spilled]
+        start = 0
+        for index, chunk in enumerate(self._chunks):
+            if i < start + chunk.count:
+                return self._load(index)[i - start]
+            start += chunk.count
+
+    @property
+    def spilled(self):
+        """The number of records that are in the temporary file."""
+        return self._spilled
+
+    @property
+    def error_size(self):
+        return sum(c.error_size for c in self._chunks) + len(
+            [x for x in self._records if x.errors]
+        )
+
+    @property
+    def error_count(self):
+        return sum(c.error_count for c in self._chunks) + sum(
+            len(x.errors) for x in self._records
+        )
+
+    def accepted(self):
+        return self._filter(False)
+
+    def rejected(self):
+        return self._filter(True)
+
+    def close(self):
+        """Remove the temporary file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._chunks = []
+        self._records = []
+        self._spilled = 0
+        self._memory = 0
+        self._cached = (None, None)
+
+    def _new(self):
+        return SpillingRecordSet(self.src, self.memory_budget, self.chunk_size,
+                                 self.dir, self.registry)
+
+    def _filter(self, errors):
+        x = self._new()
+        for index, chunk in enumerate(self._chunks):
+            if chunk.error_size == (chunk.count if errors else 0):
+                x._add_chunk(self._read(chunk), chunk)
+            elif chunk.error_size != (0 if errors else chunk.count):
+                x.extend([r for r in self._load(index) if bool(r.errors) == errors])
+        x.extend([r for r in self._records if bool(r.errors) == errors])
         return x
 
+    def _spill(self):
+        while self._memory > self.memory_budget and self._records:
+            records = self._records[: self.chunk_size]
+            del self._records[: self.chunk_size]
+            for record in records:
+                self._memory -= estimate_size(record)
+            self._write(self.registry.dumps(records), records)
+        if not self._records:
+            self._memory = 0
+
+    def _write(self, data, records):
+        self._add_chunk(data, _Chunk(
+            len(records),
+            len([r for r in records if r.errors]),
+            sum(len(r.errors) for r in records),
+        ))
+
+    def _add_chunk(self, data, chunk):
+        if self._records:
+            # Keep records in order: whatever is in memory goes first.
+            records = self._records
+            self._records = []
+            self._memory = 0
+            self._write(self.registry.dumps(records), records)
+        if self._file is None:
+            import tempfile
+
+            self._file = tempfile.TemporaryFile(dir=self.dir)
+        self._file.seek(0, io.SEEK_END)
+        chunk = _Chunk(chunk.count, chunk.error_size, chunk.error_count,
+                       self._file.tell(), len(data))
+        self._file.write(data)
+        self._chunks.append(chunk)
+        self._spilled += chunk.count
+
+    def _read(self, chunk):
+        self._file.seek(chunk.offset)
+        return self._file.read(chunk.size)
+
+    def _load(self, index):
+        cached_index, records = self._cached
+        if cached_index != index:
+            records = self.registry.loads(self._read(self._chunks[index]))
+            self._cached = (index, records)
+        return records
+
+
+class _Chunk(object):
+    def __init__(self, count, error_size, error_count, offset=None, size=None):
+        self.count = count
+        self.error_size = error_size
+        self.error_count = error_count
+        self.offset = offset
+        self.size = size
+
+
+def post_processed(parser, records, progress=None):
+    """Yield records once parser.post_process_batch has been called on
+    them, parser.batch_size at a time. Each batch is counted by progress,
+    a progress.Progress, if given. If records raises an error, the records
+    before it are processed and yielded first.
+    """
+    for batch in chunks(records, parser.batch_size):
+        parser.post_process_batch(batch)
+        if progress is not None:
+            progress.add_records(batch)
+        for record in batch:
+            yield record
+
+
+def tracked(progress, file_obj=None):
+    """The progress.Progress for the progress argument of a parse, or None.
+    progress is only imported when it is used.
+    """
+    if progress is None:
+        return None
+    from reclib.progress import tracker
+
+    return tracker(progress, file_obj)
+
+
+def estimate_size(record):
+    """A rough number of bytes held by a record and its values."""
+    getsizeof = sys.getsizeof
+    size = getsizeof(record)
+    for value in record.values():
+        size += getsizeof(value)
+    errors = getattr(record, "errors", None)
+    if errors:
+        size += getsizeof(errors) + 100 * len(errors)
+    return size
+
+
+class FieldRegistry(object):
+    """Pickles records with references to their parser's field objects in
+    place of copies of them. The fields of every registered record are
+    kept alive by the registry, so the references stay valid.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._objects = []
+
+    def register(self, record):
+        fields = getattr(record, "fields", None)
+        if fields is not None and id(fields) not in self._ids:
+            self._add(fields)
+
+    def _add(self, obj):
+        if id(obj) in self._ids:
+            return
+        self._ids[id(obj)] = len(self._objects)
+        self._objects.append(obj)
+        if isinstance(obj, (list, tuple)):
+            for field in obj:
+                self._add(field)
+        else:
+            for attr in ("fields", "stype"):
+                nested = getattr(obj, attr, None)
+                if nested is not None:
+                    self._add(nested)
+
+    def dumps(self, obj):
+        import pickle
+
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        ids = self._ids
+        pickler.persistent_id = lambda o: ids.get(id(o))
+        pickler.dump(obj)
+        return buf.getvalue()
+
+    def loads(self, data):
+        import pickle
+
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = self._objects.__getitem__
+        return unpickler.load()
+
+
+class Sampler(object):
+    """Chooses a sample of the records of a file: every Nth record, a
+    random sample of a fixed size, or the first or last K records. Exactly
+    one of every, random, first and last is given, as a positive int. seed
+    makes random samples repeatable.
+    """
+
+    def __init__(self, every=None, random=None, first=None, last=None, seed=None):
+        options = dict(every=every, random=random, first=first, last=last)
+        given = [(k, v) for k, v in options.items() if v is not None]
+        if len(given) != 1:
+            raise ValueError("give one of every, random, first or last")
+        name, value = given[0]
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError("%s must be a positive int, not %r" % (name, value))
+        self.every = every
+        self.random = random
+        self.first = first
+        self.last = last
+        self.seed = seed
+
+    def indexes(self, count):
+        """The sorted 0 based indexes to sample out of count records."""
+        if self.every:
+            return range(0, count, self.every)
+        if self.first is not None:
+            return range(min(self.first, count))
+        if self.last is not None:
+            return range(max(count - self.last, 0), count)
+        import random
+
+        rand = random.Random(self.seed)
+        return sorted(rand.sample(range(count), min(self.random, count)))
+
+    def select(self, items):
+        """Yield the (index, item) pairs of the sample from an iterable of
+        unknown length, in order. Only the chosen items are kept.
+        """
+        if self.every:
+            for i, item in enumerate(items):
+                if i % self.every == 0:
+                    yield i, item
+        elif self.first is not None:
+            for i, item in enumerate(items):
+                if i >= self.first:
+                    return
+                yield i, item
+        elif self.last is not None:
+            tail = collections.deque(enumerate(items), self.last)
+            for pair in tail:
+                yield pair
+        else:
+            # Reservoir sampling
+            import random
+
+            rand = random.Random(self.seed)
+            size = self.random
+            reservoir = []
+            for i, item in enumerate(items):
+                if i < size:
+                    reservoir.append((i, item))
+                else:
+                    j = rand.randint(0, i)
+                    if j < size:
+                        reservoir[j] = (i, item)
+            for pair in sorted(reservoir, key=lambda p: p[0]):
+                yield pair
+
+
+class ScanReport(object):
+    """Counts from a structure-only scan of a file: how many records were
+    seen, how many had errors, and per field the number of errors and the
+    first max_errors of them as (line_no, value, msg). Lines or rows that
+    are not the width of the layout are counted in width_errors.
+    """
+
+    def __init__(self, max_errors=10):
+        self.max_errors = max_errors
+        self.record_count = 0
+        self.error_size = 0
+        self.width_errors = 0
+        self.width_examples = []
+        self.field_errors = {}
+        self.examples = {}
+
+    def record(self, failed):
+        self.record_count += 1
+        if failed:
+            self.error_size += 1
+
+    def error(self, name, line_no, value, msg):
+        self.field_errors[name] = self.field_errors.get(name, 0) + 1
+        examples = self.examples.setdefault(name, [])
+        if len(examples) < self.max_errors:
+            examples.append((line_no, value, msg))
+
+    def width_error(self, line_no, width):
+        self.width_errors += 1
+        if len(self.width_examples) < self.max_errors:
+            self.width_examples.append((line_no, width))
+
+    def add_errors(self, record):
+        """Count the errors of a parsed record."""
+        for field, value, msg, col in record.errors:
+            self.error(field.name, record.line_no, value, msg)
+        self.record(bool(record.errors))
+
+    @property
+    def error_count(self):
+        return sum(self.field_errors.values())
+
+    @property
+    def ok(self):
+        return not self.error_count and not self.width_errors
+
+    def format(self, sep="\n"):
+        lines = [
+            "records: %d" % self.record_count,
+            "records with errors: %d" % self.error_size,
+            "wrong width: %d" % self.width_errors,
+        ]
+        for line_no, width in self.width_examples:
+            lines.append("  line %d: width %d" % (line_no, width))
+        for name, count in self.field_errors.items():
+            lines.append("%s: %d errors" % (name, count))
+            for line_no, value, msg in self.examples[name]:
+                lines.append("  line %d: %r: %s" % (line_no, value, msg))
+        return sep.join(lines)
+
+
+def checker(field, convert):
+    """A function of a raw value that returns None if it is valid, else
+    the list of every error message convert, a function of (value, err,
+    warn), reports for it, as parse would. field.check, if the field has
+    one, passes valid values without converting them.
+    """
+
+    def errors(value):
+        messages = []
+        convert(value, lambda msg, *a: messages.append(msg), lambda msg, *a: None)
+        return messages or None
+
+    check = getattr(field, "check", None)
+    if check is None:
+        return errors
+
+    def check_all(value):
+        if check(value) is not None:
+            return errors(value)
+
+    return check_all
+
+
 class RecordErrorSet(list):
+    # Set once RecordSet views have filed the record by whether it has
+    # errors. Adding the first error to a filed set, or removing its last,
+    # is counted in changes, which makes views file their records again.
+    filed = False
+    changes = 0
+
     def __call__(self, field, value, msg, col=None):
         self.append((field, value, msg, col))
 
@@ -34,6 +615,62 @@ class RecordErrorSet(list):
         else:
             return "%s=%r: %s" % (field.name, value, msg)
 
+    def _count(self, had):
+        if self.filed and bool(self) != had:
+            RecordErrorSet.changes += 1
+
+    def append(self, item):
+        had = bool(self)
+        list.append(self, item)
+        self._count(had)
+
+    def extend(self, items):
+        had = bool(self)
+        list.extend(self, items)
+        self._count(had)
+
+    def insert(self, i, item):
+        had = bool(self)
+        list.insert(self, i, item)
+        self._count(had)
+
+    def __setitem__(self, i, value):
+        had = bool(self)
+        list.__setitem__(self, i, value)
+        self._count(had)
+
+    def __delitem__(self, i):
+        had = bool(self)
+        list.__delitem__(self, i)
+        self._count(had)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, n):
+        had = bool(self)
+        list.__imul__(self, n)
+        self._count(had)
+        return self
+
+    def pop(self, *args):
+        had = bool(self)
+        item = list.pop(self, *args)
+        self._count(had)
+        return item
+
+    def remove(self, item):
+        had = bool(self)
+        list.remove(self, item)
+        self._count(had)
+
+    def clear(self):
+        had = bool(self)
+        list.clear(self)
+        self._count(had)
+
+
 class RecordWarningSet(list):
     def __call__(self, field, value, msg, col=None):
         self.append((field, value, msg, col))
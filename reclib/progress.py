@@ -0,0 +1,233 @@
+"""Progress reports for long parses and formats.
+
+Pass progress to the parse, parse_file, parse_iter, parse_many or
+parse_threaded of a fw.Parser or delim.Parser, or to format.fw.Formatter
+format, either as a callback or as a Progress. The callback is called
+with the Progress at most every `every` records or `interval` seconds,
+whichever comes first, and once more when the run is done. It is given a
+copy of the Progress taken when the report was due and is called outside
+the Progress's lock, so it may be slow without holding up other threads:
+
+    def report(p):
+        log.info("%d records, %s%%, %.0f/s, %d errors",
+                 p.records, p.percent, p.rate, p.errors)
+
+    parser.parse_file("claims.txt", progress=report)
+
+Records are counted a batch at a time and time is only read once per
+batch, so leaving it on costs little.
+"""
+
+import copy
+import os
+import threading
+import time
+
+
+class Progress(object):
+    """Counts of a run so far: records, characters read or written, bytes
+    read, records with errors (rejected) and errors. total is the expected
+    number of bytes, when it is known, for percent.
+    """
+
+    def __init__(self, callback, every=10000, interval=5.0, total=None):
+        self.callback = callback
+        self.every = every
+        self.interval = interval
+        self.total = total
+        self.records = 0
+        self.characters = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.errors = 0
+        self.done = False
+        self.start = time.monotonic()
+        self._next_records = every
+        self._next_time = self.start + interval
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):
+        """Records per second."""
+        elapsed = self.elapsed
+        return self.records / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def percent(self):
+        """Percent of total read, or None if the total is not known. Bytes
+        are counted from the position of the file read, when it has one;
+        otherwise characters are counted, which is only right for single
+        byte text.
+        """
+        if not self.total:
+            return None
+        read = self.bytes or self.characters
+        return min(100.0, 100.0 * read / self.total)
+
+    def lines(self, file_obj, flush=1 << 16):
+        """Yield the lines of file_obj, counting their characters and, if
+        it is text read from a seekable binary file, the bytes read from
+        that. Counts are added flush characters at a time, so that threads
+        may share a Progress. They are reported with the records.
+        """
+        tell = _tell(file_obj)
+        position = tell() if tell else 0
+        size = 0
+        for line in file_obj:
+            size += len(line)
+            if size >= flush:
+                position = self._add_characters(size, tell, position)
+                size = 0
+            yield line
+        self._add_characters(size, tell, position)
+
+    def _add_characters(self, size, tell=None, position=0):
+        """Add size characters, and the bytes read since position if tell
+        is given. The new position is returned.
+        """
+        read = 0
+        if tell is not None:
+            read = tell() - position
+            position += read
+        with self._lock:
+            self.characters += size
+            self.bytes += read
+        return position
+
+    def update(self, records=0, rejected=0, errors=0, characters=0):
+        """Add to the counts and call the callback if it is due."""
+        with self._lock:
+            self.records += records
+            self.rejected += rejected
+            self.errors += errors
+            self.characters += characters
+            if self.records < self._next_records:
+                now = time.monotonic()
+                if now < self._next_time:
+                    return
+            else:
+                now = time.monotonic()
+            self._next_records = self.records + self.every
+            self._next_time = now + self.interval
+            snapshot = copy.copy(self)
+        self.callback(snapshot)
+
+    def add_records(self, records):
+        """update with the counts of a batch of parsed records."""
+        rejected = errors = 0
+        for record in records:
+            if record.errors:
+                rejected += 1
+                errors += len(record.errors)
+        self.update(len(records), rejected, errors)
+
+    def finish(self):
+        """Call the callback a last time, with done set."""
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+            snapshot = copy.copy(self)
+        self.callback(snapshot)
+
+    def part(self):
+        """A Progress for one of several files parsed together, which adds
+        its counts to this one and leaves finishing to it.
+        """
+        return _Part(self)
+
+    def __repr__(self):
+        return "<Progress %d records, %d errors, %.0f/s>" % (
+            self.records,
+            self.errors,
+            self.rate,
+        )
+
+
+class _Part(Progress):
+    def __init__(self, whole):
+        self.whole = whole
+        self.total = whole.total
+
+    def __getattr__(self, name):
+        if name == "whole":
+            raise AttributeError(name)
+        return getattr(self.whole, name)
+
+    def _add_characters(self, size, tell=None, position=0):
+        return self.whole._add_characters(size, tell, position)
+
+    def update(self, records=0, rejected=0, errors=0, characters=0):
+        self.whole.update(records, rejected, errors, characters)
+
+    def finish(self):
+        pass
+
+
+def _tell(file_obj):
+    """The tell of the binary file under the text file file_obj, or None if
+    it has none that can be used.
+    """
+    buffer = getattr(file_obj, "buffer", None)
+    try:
+        if buffer is None or not buffer.seekable():
+            return None
+        buffer.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return buffer.tell
+
+
+def tracker(progress, file_obj=None):
+    """The Progress for the progress argument of a parse or format: None,
+    a Progress, or a callback to make one for. Its total is set from the
+    size of file_obj when it is a plain file.
+    """
+    if progress is None or isinstance(progress, Progress):
+        tracked = progress
+    else:
+        tracked = Progress(progress)
+    if tracked is not None and tracked.total is None and file_obj is not None:
+        tracked.total = _file_size(file_obj)
+    return tracked
+
+
+def total_size(files):
+    """The total size of files, paths or file objects, or None if the size
+    of any of them is not known.
+    """
+    total = 0
+    for file in files:
+        size = _file_size(file)
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+def _file_size(file):
+    """The size of the plain file at path file or read by file, or None.
+    The size of a compressed file, which would not match the bytes read,
+    is not used; compressed files opened by util.open_input have no
+    name.
+    """
+    from reclib.util import compression
+
+    if isinstance(file, str):
+        name = file
+    else:
+        name = getattr(file, "name", None)
+        if not isinstance(name, str):
+            return None
+    try:
+        # Only regular files have a size, and sniffing a pipe would read
+        # away its data.
+        if not os.path.isfile(name) or compression(name) is not None:
+            return None
+        return os.path.getsize(name)
+    except OSError:
+        return None
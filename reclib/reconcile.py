@@ -0,0 +1,222 @@
+"""Key based reconciliation of two streams of records.
+
+reconcile() joins an old and a new stream of records, from fw.Parser or
+delim.Parser parse_iter or any other iterable of dicts, on one or more key
+fields and yields a Change for every record that was added, removed or
+changed:
+
+    old = parser.parse_iter("eligibility.20240130.txt")
+    new = parser.parse_iter("eligibility.20240131.txt")
+    for change in reconcile.reconcile(old, new, ["member_id"]):
+        print(change.status, change.key, change.fields)
+
+The old records are held in memory by key. When they grow past
+memory_budget bytes, as estimated by rec.estimate_size, both streams are
+partitioned to a temporary file by a hash of their keys and reconciled one
+partition at a time. Partitions still past the budget are split again, so
+only the old records that share a key must fit in the budget rather than
+the whole file.
+
+Records with the same key are paired in the order they appear. Changes for
+new records come in the order of the new stream, followed by the records
+that were removed, in the order of the old stream. When the streams are
+partitioned, the order holds within each partition.
+"""
+
+import tempfile
+
+from reclib.parse import rec
+
+
+class Change(object):
+    """A record that differs between the old and the new stream. status is
+    "added", "removed" or "changed". old or new is None for added and
+    removed records. fields lists the names of the changed fields.
+    """
+
+    __slots__ = ("status", "key", "old", "new", "fields")
+
+    def __init__(self, status, key, old, new, fields=()):
+        self.status = status
+        self.key = key
+        self.old = old
+        self.new = new
+        self.fields = fields
+
+    def __repr__(self):
+        if self.status == "changed":
+            return "<Change changed %r %s>" % (self.key, ",".join(self.fields))
+        return "<Change %s %r>" % (self.status, self.key)
+
+
+def reconcile(
+    old,
+    new,
+    keys,
+    fields=None,
+    memory_budget=64 * 2**20,
+    partitions=64,
+    dir=None,
+):
+    """Yield a Change for each difference between the records of old and
+    new, joined on the key fields. fields names the fields compared, by
+    default the fields of the parser that made each record, or every key of
+    plain dicts. Past memory_budget bytes of old records, both streams are
+    split into partitions on disk under dir.
+    """
+    keys = list(keys)
+    held = {}
+    size = 0
+    old = iter(old)
+    for record in old:
+        held.setdefault(_key(record, keys), []).append(record)
+        size += rec.estimate_size(record)
+        if memory_budget and size > memory_budget:
+            break
+    else:
+        for change in _join(held, new, keys, fields):
+            yield change
+        return
+
+    spill = _Partitions(partitions, memory_budget, dir)
+    try:
+        for key, records in held.items():
+            for record in records:
+                spill.add(0, key, record)
+        held = None
+        for record in old:
+            spill.add(0, _key(record, keys), record)
+        for record in new:
+            spill.add(1, _key(record, keys), record)
+        spill.flush()
+        for change in _join_partitions(spill, keys, fields, dir):
+            yield change
+    finally:
+        spill.close()
+
+
+def _join_partitions(spill, keys, fields, dir, limit=None):
+    """Changes of every partition of spill. An old side larger than the
+    memory budget is split again with the next hash seed, as long as that
+    makes it smaller than limit, the size of the partition it came from;
+    records that all share a key cannot be split and are loaded whole.
+    """
+    for i in range(spill.count):
+        size = spill.sizes.get((0, i), 0)
+        if size > spill.memory_budget and (limit is None or size < limit):
+            sub = _Partitions(spill.count, spill.memory_budget, dir,
+                              spill.seed + 1)
+            try:
+                for side in (0, 1):
+                    for key, record in spill.read(side, i):
+                        sub.add(side, key, record)
+                sub.flush()
+                for change in _join_partitions(sub, keys, fields, dir, size):
+                    yield change
+            finally:
+                sub.close()
+            continue
+        part = {}
+        for key, record in spill.read(0, i):
+            part.setdefault(key, []).append(record)
+        others = (record for key, record in spill.read(1, i))
+        for change in _join(part, others, keys, fields):
+            yield change
+
+
+def _key(record, keys):
+    return tuple([record.get(k) for k in keys])
+
+
+def _names(record):
+    fields = getattr(record, "fields", None)
+    if fields is not None:
+        return [f.name for f in fields]
+    return list(record)
+
+
+def _join(held, new, keys, fields):
+    """Changes between held, old records in lists by key, and new records.
+    held is emptied.
+    """
+    for record in new:
+        key = _key(record, keys)
+        matches = held.get(key)
+        if not matches:
+            yield Change("added", key, None, record)
+            continue
+        before = matches.pop(0)
+        if not matches:
+            del held[key]
+        names = fields or _names(record)
+        changed = [n for n in names if before.get(n) != record.get(n)]
+        if changed:
+            yield Change("changed", key, before, record, changed)
+    for key, records in held.items():
+        for record in records:
+            yield Change("removed", key, record, None)
+    held.clear()
+
+
+class _Partitions(object):
+    """Records of two streams split into partitions by the digit of the
+    hash of their key picked by seed, kept in one temporary file in chunks
+    of pickled (key, record) pairs. Records waiting to be written are kept
+    to memory_budget bytes by writing out the largest pending partition.
+    sizes holds the estimated bytes of each (side, partition).
+    """
+
+    chunk_size = 500
+
+    def __init__(self, count, memory_budget, dir=None, seed=0):
+        self.count = count
+        self.memory_budget = memory_budget
+        self.seed = seed
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self.registry = rec.FieldRegistry()
+        self.pending = {}
+        self.pending_sizes = {}
+        self.pending_size = 0
+        self.sizes = {}
+        self.chunks = {}
+
+    def add(self, side, key, record):
+        # Each seed takes the next base count digit of the hash, so that a
+        # partition split again spreads over every new partition.
+        part = (side, hash(key) // self.count**self.seed % self.count)
+        pending = self.pending.setdefault(part, [])
+        self.registry.register(record)
+        pending.append((key, record))
+        size = rec.estimate_size(record)
+        self.sizes[part] = self.sizes.get(part, 0) + size
+        self.pending_sizes[part] = self.pending_sizes.get(part, 0) + size
+        self.pending_size += size
+        if len(pending) >= self.chunk_size:
+            self._write_pending(part)
+        while self.pending_size > self.memory_budget:
+            sizes = self.pending_sizes
+            self._write_pending(max(sizes, key=sizes.get))
+
+    def _write_pending(self, part):
+        self._write(part, self.pending.pop(part))
+        self.pending_size -= self.pending_sizes.pop(part)
+
+    def flush(self):
+        for part in list(self.pending):
+            self._write_pending(part)
+
+    def _write(self, part, pairs):
+        data = self.registry.dumps(pairs)
+        self.file.seek(0, 2)
+        self.chunks.setdefault(part, []).append((self.file.tell(), len(data)))
+        self.file.write(data)
+
+    def read(self, side, index):
+        """Yield the (key, record) pairs of one partition of one side."""
+        for offset, size in self.chunks.get((side, index), ()):
+            self.file.seek(offset)
+            for pair in self.registry.loads(self.file.read(size)):
+                yield pair
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,132 @@
+"""External merge sort and grouping of record streams.
+
+sort() orders a stream of records, such as the parse_iter of a fw.Parser or
+delim.Parser, by key fields without holding more than memory_budget bytes
+of them, as estimated by rec.estimate_size:
+
+    claims = parser.parse_iter("claims.txt")
+    for record in sort.sort(claims, ["member_id", "claim_id"]):
+        ...
+
+Records are gathered into runs that fit the budget. Each run is sorted and
+pickled to a temporary file through rec.FieldRegistry, which keeps the
+records' errors, warnings and line_no. The runs are then merged with
+heapq.merge. Input that fits in one run is sorted in memory and never
+touches disk.
+
+The sort is stable. None sorts after every other value of a field, with
+reverse too, so missing values do not break the comparison.
+"""
+
+import heapq
+import itertools
+import tempfile
+
+from reclib.parse import rec
+
+
+def sort_key(keys, reverse=False):
+    """A function that gives the sort key of a record for the key fields.
+    None sorts after every other value, also when the key is used with
+    reverse.
+    """
+    keys = list(keys)
+    none = (-1, 0) if reverse else (1, 0)
+
+    def key(record):
+        values = []
+        for k in keys:
+            value = record.get(k)
+            values.append(none if value is None else (0, value))
+        return values
+
+    return key
+
+
+def sort(records, keys, reverse=False, memory_budget=64 * 2**20, dir=None):
+    """Yield records in order of the key fields. Past memory_budget bytes,
+    sorted runs are written to a temporary file under dir and merged.
+    """
+    key = sort_key(keys, reverse)
+    records = iter(records)
+    run, full = _take_run(records, memory_budget)
+    run.sort(key=key, reverse=reverse)
+    if not full:
+        for record in run:
+            yield record
+        return
+
+    runs = _RunFile(dir)
+    try:
+        while run:
+            runs.add(run)
+            run, full = _take_run(records, memory_budget)
+            run.sort(key=key, reverse=reverse)
+        merged = heapq.merge(*runs.readers(), key=key, reverse=reverse)
+        for record in merged:
+            yield record
+    finally:
+        runs.close()
+
+
+def group_by(records, keys, presorted=False, **kwargs):
+    """Yield (key, [records]) for each distinct value of the key fields,
+    key being a tuple of the values. Unless presorted, records are first
+    put in order with sort, which is passed any other keyword arguments.
+    """
+    keys = list(keys)
+    if not presorted:
+        records = sort(records, keys, **kwargs)
+    value = lambda record: tuple([record.get(k) for k in keys])
+    for group, members in itertools.groupby(records, value):
+        yield group, list(members)
+
+
+def _take_run(records, memory_budget):
+    """The next records up to memory_budget bytes and whether the budget
+    was reached.
+    """
+    run = []
+    size = 0
+    for record in records:
+        run.append(record)
+        size += rec.estimate_size(record)
+        if memory_budget and size > memory_budget:
+            return run, True
+    return run, False
+
+
+class _RunFile(object):
+    """Sorted runs of records in one temporary file, pickled in chunks so
+    that each run can be read back a chunk at a time.
+    """
+
+    chunk_size = 500
+
+    def __init__(self, dir=None):
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self.registry = rec.FieldRegistry()
+        self.runs = []
+
+    def add(self, run):
+        chunks = []
+        for i in range(0, len(run), self.chunk_size):
+            chunk = run[i : i + self.chunk_size]
+            for record in chunk:
+                self.registry.register(record)
+            data = self.registry.dumps(chunk)
+            chunks.append((self.file.tell(), len(data)))
+            self.file.write(data)
+        self.runs.append(chunks)
+
+    def readers(self):
+        return [self._read(chunks) for chunks in self.runs]
+
+    def _read(self, chunks):
+        for offset, size in chunks:
+            self.file.seek(offset)
+            for record in self.registry.loads(self.file.read(size)):
+                yield record
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,294 @@
+"""Single pass, fixed memory profiles of the fields of record streams.
+
+A Profile counts, for every field of the records it sees, values, nulls,
+blanks and errors, the smallest and largest values, a histogram of value
+lengths, an estimate of the number of distinct values and the most common
+values. observe() profiles records as they go by, so it can wrap the
+parse_iter of a fw.Parser or delim.Parser:
+
+    profile = stats.Profile()
+    for record in profile.observe(parser.parse_iter("feed.txt")):
+        ...
+    for name, summary in profile.summary().items():
+        print(name, summary["distinct"], summary["error_rate"])
+
+Distinct values are estimated with a HyperLogLog, to about 1.6% with the
+default precision, and common values are kept by a TopK, whose counts are
+lower bounds. Both take the same memory however many records are seen.
+
+Profiles merge, so chunks of a file can be profiled in separate processes
+and combined:
+
+    total = stats.Profile()
+    for part in pool.map(profile_chunk, chunks):
+        total.merge(part)
+"""
+
+import hashlib
+import math
+
+
+class HyperLogLog(object):
+    """An estimate of the number of distinct values added, in 2**precision
+    bytes of registers. Values are hashed with blake2b.
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be from 4 to 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._shift = 64 - precision
+        self._mask = (1 << self._shift) - 1
+
+    def add(self, value):
+        self.add_hash(_hash(value))
+
+    def add_hash(self, h):
+        index = h >> self._shift
+        rank = self._shift - (h & self._mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("can not merge HyperLogLogs of other precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / float(zeros))
+        return estimate
+
+
+class TopK(object):
+    """The most common values added, counted with the Misra-Gries
+    algorithm. A count is less than the true count by at most the number
+    of values added divided by capacity + 1. Up to twice capacity counters
+    are kept between prunings, so that pruning is not done for every new
+    value.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, value, count=1):
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+        else:
+            counts[value] = count
+            if len(counts) > 2 * self.capacity:
+                self._prune()
+
+    def _prune(self):
+        """Subtract the (capacity + 1)th largest count from every count and
+        drop those left at zero or below.
+        """
+        counts = self.counts
+        if len(counts) <= self.capacity:
+            return
+        cut = sorted(counts.values(), reverse=True)[self.capacity]
+        self.counts = dict((v, c - cut) for v, c in counts.items() if c > cut)
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self._prune()
+
+    def top(self, n=10):
+        """[(value, count)] of the n most common values."""
+        items = sorted(self.counts.items(), key=lambda item: -item[1])
+        return items[:n]
+
+
+class FieldStats(object):
+    """Counts and sketches of the values of one field. The length and
+    blankness of up to memo_size distinct values are remembered, and those
+    values are only hashed and compared with min and max once. Values other
+    than strings are remembered by type and text, as equal values such as 1
+    and 1.0 may have different text.
+    """
+
+    # Lengths up to this are counted exactly, longer ones by power of two.
+    exact_lengths = 64
+    memo_size = 4096
+
+    def __init__(self, precision=12, capacity=64):
+        self.count = 0
+        self.nulls = 0
+        self.blanks = 0
+        self.errors = 0
+        self.min = None
+        self.max = None
+        self.lengths = {}
+        self.distinct = HyperLogLog(precision)
+        self.top = TopK(capacity)
+        self._seen = {}
+
+    def add(self, value):
+        self.count += 1
+        if value is None:
+            self.nulls += 1
+            return
+        if type(value) is str:
+            key = value
+        else:
+            try:
+                hash(value)
+            except TypeError:
+                # Unhashable, such as the lists of Multi fields.
+                value = str(value)
+            key = (type(value), str(value))
+        seen = self._seen.get(key)
+        if seen is None:
+            seen = self._first(value, key)
+        length, blank = seen
+        if blank:
+            self.blanks += 1
+        lengths = self.lengths
+        lengths[length] = lengths.get(length, 0) + 1
+        self.top.add(value)
+
+    def _first(self, value, key):
+        """(length bucket, blank) of a value not in the memo under key, which
+        is added to the distinct values and the range.
+        """
+        text = value if isinstance(value, str) else str(value)
+        length = len(text)
+        if length > self.exact_lengths:
+            length = 1 << (length - 1).bit_length()
+        seen = (length, not text.strip())
+        self._add_range(value)
+        self.distinct.add(value)
+        if len(self._seen) < self.memo_size:
+            self._seen[key] = seen
+        return seen
+
+    def _add_range(self, value):
+        try:
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+        except TypeError:
+            pass
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        self.blanks += other.blanks
+        self.errors += other.errors
+        for value in (other.min, other.max):
+            if value is not None:
+                self._add_range(value)
+        for length, count in other.lengths.items():
+            self.lengths[length] = self.lengths.get(length, 0) + count
+        self.distinct.merge(other.distinct)
+        self.top.merge(other.top)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_seen"] = {}
+        return state
+
+    def summary(self, top=10):
+        """A dict of the counts and estimates of the field."""
+        return {
+            "count": self.count,
+            "nulls": self.nulls,
+            "blanks": self.blanks,
+            "errors": self.errors,
+            "error_rate": self.errors / float(self.count) if self.count else 0.0,
+            "min": self.min,
+            "max": self.max,
+            "distinct": len(self.distinct),
+            "top": self.top.top(top),
+            "lengths": sorted(self.lengths.items()),
+        }
+
+
+class Profile(object):
+    """FieldStats for every field of a stream of records, by name, with
+    counts of records and of records with errors (rejected).
+    """
+
+    def __init__(self, fields=None, precision=12, capacity=64):
+        self.fields = fields
+        self.precision = precision
+        self.capacity = capacity
+        self.stats = {}
+        self.records = 0
+        self.rejected = 0
+
+    def __getitem__(self, name):
+        return self.stats[name]
+
+    def _stats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = FieldStats(self.precision, self.capacity)
+        return stats
+
+    def add(self, record):
+        """Count one record, a dict, and the fields with errors."""
+        self.records += 1
+        if self.fields is None:
+            for name, value in record.items():
+                self._stats(name).add(value)
+        else:
+            for name in self.fields:
+                self._stats(name).add(record.get(name))
+        errors = getattr(record, "errors", None)
+        if errors:
+            self.rejected += 1
+            # A field is counted once however many errors it has.
+            names = set(getattr(field, "name", field) for field, v, m, c in errors)
+            for name in names:
+                if self.fields is None or name in self.fields:
+                    self._stats(name).errors += 1
+
+    def observe(self, records):
+        """Yield records, adding each to the profile."""
+        add = self.add
+        for record in records:
+            add(record)
+            yield record
+
+    def update(self, records):
+        """Add every one of records and return the profile."""
+        for record in records:
+            self.add(record)
+        return self
+
+    def merge(self, other):
+        """Add the counts of other, a Profile of other records."""
+        self.records += other.records
+        self.rejected += other.rejected
+        for name, stats in other.stats.items():
+            self._stats(name).merge(stats)
+        return self
+
+    def summary(self, top=10):
+        """{field name: FieldStats.summary()}"""
+        return dict((n, s.summary(top)) for n, s in self.stats.items())
+
+
+def _hash(value):
+    """A 64 bit blake2b hash of value, the same in every process."""
+    if isinstance(value, str):
+        data = value.encode("utf-8", "surrogatepass")
+    elif isinstance(value, bytes):
+        data = value
+    else:
+        data = repr(value).encode("utf-8")
+    digest = hashlib.blake2b(data, digest_size=8).digest()
+    return int.from_bytes(digest, "big")
@@ -1,20 +1,41 @@
-from builtins import next
-from builtins import object
 import logging
 import datetime
+import decimal
+import functools
+import io
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
 import unittest
 
-import six
-
+import reclib.columnar as C
+import reclib.format.fw as F
+import reclib.util as U
 import reclib.validate as V
 import reclib.parse.fw as PF
 import reclib.parse.delim as P
+import reclib.parse.rec as R
+import reclib.progress as G
+import reclib.stats as S
 
 logging.basicConfig(level=logging.DEBUG)
 
-class ParseFWTestCase(unittest.TestCase):
+class TempDirMixin(object):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+class ParseFWTestCase(TempDirMixin, unittest.TestCase):
     def test_RecordStream(self):
-        buf = six.StringIO("abcdefg")
+        buf = io.StringIO("abcdefg")
         stream = PF.RecordStream(buf)
         stream.move_next()
         self.assertEqual(stream.read(1), "a")
@@ -43,12 +64,308 @@ class ParseFWTestCase(unittest.TestCase):
         h("18950101")
         self.assertEqual(h.errors[0][1], 'Expected year after 1900')
 
+    def test_parse_date_matches_strptime(self):
+        import time
+        values = ["20000229", "19000229", "20010431", "20011301", "2001 1 1",
+                  "00010101", "12/30/2001", "2/3/2001", "02/30/2004",
+                  "Dec 2001"]
+        for fmt in ("%Y%m%d", "%m/%d/%Y", "%d%m%Y", "%b %Y"):
+            field = PF.Date("d", 10, fmt)
+            for value in values:
+                try:
+                    expected = datetime.date(*time.strptime(value, fmt)[:3])
+                except ValueError:
+                    expected = None
+                errors = []
+                got = field.convert(value, lambda m, v=None: errors.append(m),
+                                    None)
+                self.assertEqual(got, expected, (fmt, value))
+                self.assertEqual(bool(errors), expected is None)
+
     def test_parse_datetime(self):
         import reclib.parse.fw as P
         h = FixedFieldParseHarness(P.Datetime("d", "YYYYMMDDHHMM"))
         value = h("200112301430")
         self.assertEqual(value, datetime.datetime(2001, 12, 30, 14, 30, 0))
 
+    def layout_parser(self):
+        return PF.Parser(
+            PF.String("id", 3, required=True),
+            PF.Multi(PF.String("code", 2), 3, join="|", rstrip=True),
+            PF.Multi(PF.Integer("qty", 2), 2),
+            PF.Multi(PF.Date("fill", 8, "%Y%m%d"), 2),
+            PF.RecordList("lines", 2,
+                          PF.String("ndc", 4),
+                          PF.Currency("amt", 5, implicit=2)),
+            PF.Datetime("ts", "YYYYMMDDHHMM"),
+            PF.Integer("n", 3))
+
+    def test_compiled_layout_matches_stream(self):
+        p = self.layout_parser()
+        p.spacing = 1
+        self.assertTrue(p.layout.compiled)
+        text = "\n".join([
+            "001 AABBCC 0102 2001010218991231 NDC100100NDC2x0200 200112301430 007",
+            "002 AA  C  0x05 2001130100000000 ND  00000",
+            "",
+            "   ",
+            "004 ABCDEF 1234 2001010120010101 NDC100100NDC200200 200112301430 12a",
+        ]) + "\n"
+        compiled = p.parse(io.StringIO(text))
+        stream = PF.RecordStream(io.StringIO(text))
+        expected = []
+        while True:
+            record = p.parseline(stream)
+            if stream.eof:
+                break
+            expected.append(record)
+
+        self.assertEqual(len(compiled), 5)
+        for got, want in zip(compiled, expected):
+            self.assertEqual(list(got.items()), list(want.items()))
+            self.assertEqual(got.line_no, want.line_no)
+            self.assertEqual(got.errors, want.errors)
+            for gsub, wsub in zip(got["lines"], want["lines"]):
+                self.assertEqual(gsub.errors, wsub.errors)
+                self.assertEqual(gsub.line_no, wsub.line_no)
+        self.assertEqual(compiled[0]["code"], "AA|BB|CC")
+        self.assertEqual(compiled[0]["fill_iso"], ["20010102", "18991231"])
+        self.assertEqual(compiled[4]["lines"][1]["amt"], decimal.Decimal("2"))
+        self.assertEqual(len(compiled[0]["lines"][1].errors), 1)
+
+    def test_uncompiled_layout_falls_back(self):
+        class Custom(object):
+            name = "custom"
+            def assign(self, record, stream, err, warn):
+                record[self.name] = stream.read(2)
+        p = PF.Parser(PF.String("a", 1), Custom(), PF.String("b", 1))
+        self.assertFalse(p.layout.compiled)
+        records = p.parse(io.StringIO("xyzw\n"))
+        self.assertEqual(dict(records[0]), {"a": "x", "custom": "yz", "b": "w"})
+        self.assertEqual(dict(p.parse_raw("1234", 9)),
+                         {"a": "1", "custom": "23", "b": "4"})
+
+    def test_fwarray_date_val_format(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        from reclib.parse import fwarray
+        p = PF.Parser(PF.Date("d", 8, "%Y%m%d", val_format="%m/%d/%Y"))
+        table = fwarray.parse_buffer(p, b"20011230\n20010230\n        \n")
+        self.assertEqual(table["d"].dtype, np.dtype(object))
+        self.assertEqual(list(table["d"]), ["12/30/2001", None, None])
+        self.assertEqual(list(table.errors["d"]), [False, True, False])
+
+    def test_overridden_parse_falls_back(self):
+        class Upper(PF.String):
+            def parse(self, stream, err, warn):
+                return PF.String.parse(self, stream, err, warn).upper()
+        p = PF.Parser(PF.String("a", 2), Upper("b", 2))
+        self.assertFalse(p.layout.compiled)
+        self.assertEqual(p.parse(io.StringIO("abcd\n"))[0]["b"], "CD")
+        p = PF.Parser(PF.Multi(Upper("m", 1), 2))
+        self.assertFalse(p.layout.compiled)
+        self.assertEqual(p.parse(io.StringIO("ab\n"))[0]["m"], ["A", "B"])
+
+    def test_overridden_parseline_is_used(self):
+        class Tagged(PF.Parser):
+            fields = [PF.String("a", 2), PF.Integer("n", 2)]
+
+            def parseline(self, stream):
+                record = PF.Parser.parseline(self, stream)
+                record["tagged"] = True
+                return record
+        p = Tagged()
+        self.assertTrue(p.layout.compiled)
+        self.assertFalse(p.sliced)
+        self.assertTrue(PF.Parser(*Tagged.fields).sliced)
+        text = "ab12\ncd34\n"
+        self.assertTrue(all(r["tagged"] for r in p.parse(io.StringIO(text))))
+        self.assertTrue(all(r["tagged"] for r in p.parse_iter(io.StringIO(text))))
+        self.assertTrue(all(r["tagged"] for r in
+                            p.parse_threaded(io.StringIO(text), jobs=2)))
+        self.assertTrue(p.parse_raw("ef56")["tagged"])
+        p.keep_lines = True
+        self.assertRaises(ValueError, p.parse_raw, "ef56")
+
+    def test_fwarray_matches_parser(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        from reclib.parse import fwarray
+        p = PF.Parser(
+            PF.String("name", 4, required=True),
+            PF.Integer("n", 4, strip_nonnumeric=False),
+            PF.Currency("amt", 7, implicit=2),
+            PF.Date("d", 8, "%Y%m%d", min_year=1900),
+            PF.Multi(PF.String("code", 1), 2, join="|"))
+        rows = [("abc", "  12", "0012345", "20011230", "1X"),
+                ("", " -5 ", "-001500", "00000000", "2 "),
+                ("x", "1 2 ", "abc.1", "20010230", "12"),
+                ("y", "   7", "   1.5", "18991231", "  ")]
+        text = "\n".join("%-4s%4s%-7s%-8s%2s" % row for row in rows)
+        table = fwarray.parse_buffer(p, text.encode("ascii"))
+        records = p.parse(io.StringIO(text))
+        self.assertEqual(len(table), len(records))
+        for i, record in enumerate(records):
+            failed = set(e[0].name for e in record.errors)
+            for name in ["name", "n", "amt", "d", "code"]:
+                self.assertEqual(bool(table.errors[name][i]), name in failed)
+                if name in failed:
+                    continue
+                value = record[name]
+                if isinstance(value, decimal.Decimal):
+                    value = float(value)
+                elif isinstance(value, datetime.date):
+                    value = np.datetime64(value)
+                elif value is None:
+                    self.assertTrue(np.isnat(table[name][i]))
+                    continue
+                self.assertEqual(table[name][i], value)
+        self.assertEqual(table["code"][0], "1|X")
+        self.assertEqual(table["amt"].dtype, np.float64)
+        self.assertEqual(str(table["d"][0]), "2001-12-30")
+
+    def test_scan_matches_parse(self):
+        p = PF.Parser(
+            PF.String("id", 3, required=True, regex="^[0-9]+$"),
+            PF.Integer("n", 3, strip_nonnumeric=False),
+            PF.Currency("amt", 5, nonzero=True),
+            PF.Date("d", 8, "%Y%m%d", min_year=1900),
+            PF.Multi(PF.String("c", 1, values=["A", "B"]), 2),
+            PF.String("s", 2, regex="^[0-9]+$", values=["11"]))
+        rows = ["00112345.0020011230AB11", "   +1 00000189912310 xy",
+                "x1 1_2  1e2200102301A12", "002 x 1.2.300000000BB11",
+                "003  7 5    2001123", "004  9 5    20011231AB11   "]
+        text = "\n".join(rows) + "\n"
+        report = p.scan(io.StringIO(text), max_errors=1)
+        counts = {}
+        for record in p.parse(io.StringIO(text)):
+            for field, value, msg, col in record.errors:
+                counts[field.name] = counts.get(field.name, 0) + 1
+        self.assertEqual(report.field_errors, counts)
+        self.assertEqual(counts["s"], 5)
+        self.assertEqual(report.record_count, 6)
+        self.assertEqual(report.error_size, 4)
+        self.assertEqual(report.width_errors, 2)
+        self.assertEqual(report.width_examples, [(5, 19)])
+        self.assertEqual(report.examples["id"], [(2, "   ", "missing required value")])
+        self.assertFalse(report.ok)
+
+    def test_sample(self):
+        p = PF.Parser(PF.String("id", 3), PF.Integer("n", 3))
+        rows = ["%03d%3s" % (i, "x" if i == 7 else i) for i in range(1, 21)]
+        path = self.path("sample.txt")
+        for text in ["\n".join(rows) + "\n", "\r\n".join(rows),
+                     "\n".join(rows[:5] + [rows[5] + " "] + rows[6:])]:
+            with open(path, "w", newline="") as f:
+                f.write(text)
+            every = p.sample(path, every=3)
+            self.assertEqual([r.line_no for r in every], list(range(1, 21, 3)))
+            self.assertEqual([r["n"] for r in every][:3], [1, 4, None])
+            self.assertEqual(len(every[2].errors), 1)
+            self.assertEqual(
+                [r["id"] for r in p.sample(path, last=2)], ["019", "020"])
+            self.assertEqual(
+                [r.line_no for r in p.sample(path, first=2)], [1, 2])
+            picked = [r.line_no for r in p.sample(path, random=5, seed=1)]
+            self.assertEqual(len(set(picked)), 5)
+            self.assertEqual(picked, sorted(picked))
+            self.assertEqual(
+                picked, [r.line_no for r in p.sample(path, random=5, seed=1)])
+        streamed = p.sample(io.StringIO("\n".join(rows)), last=1)
+        self.assertEqual([(r.line_no, r["n"]) for r in streamed], [(20, 20)])
+        self.assertRaises(ValueError, p.sample, path, every=2, first=2)
+        for bad in (0, -1, 1.5, True):
+            self.assertRaises(ValueError, p.sample, path, every=bad)
+        # Same total size as equal lines, but seeks land off line starts.
+        for lines in (rows[:1] + ["00x", "002  2abc"] + rows[3:],
+                      rows[:2] + ["ab", "cde"] + rows[4:]):
+            text = "\n".join(lines) + "\n"
+            with open(path, "w", newline="") as f:
+                f.write(text)
+            streamed = p.sample(io.StringIO(text), every=2)
+            self.assertEqual(
+                [(r.line_no, r["id"]) for r in p.sample(path, every=2)],
+                [(r.line_no, r["id"]) for r in streamed])
+
+    def test_transcode(self):
+        import csv
+        p = PF.Parser(PF.String("id", 3, required=True), PF.String("name", 6),
+                      PF.Integer("n", 3, strip_nonnumeric=False),
+                      PF.Currency("amt", 5, implicit=2),
+                      PF.Date("d", 8, "%Y%m%d", min_year=1900),
+                      PF.Multi(PF.String("c", 1), 2))
+        rand = random.Random(3)
+        lines = []
+        for i in range(300):
+            lines.append("%3s%-6s%3s%5s%8s%2s" % (
+                rand.choice(["001", "", "7"]), rand.choice(["ann", " bo", ""]),
+                rand.choice(["12", "1x", ""]), rand.choice(["125", "1.5", ""]),
+                rand.choice(["20010101", "18990101", "2001", ""]),
+                rand.choice(["AB", "A", ""])))
+        text = "\n".join(lines) + "\n"
+        names = ["d", "id", "n", "amt", "name", "c"]
+        expected = []
+        for record in p.parse(io.StringIO(text)):
+            expected.append(
+                (bool(record.errors),
+                 [U.csv_cell(record.get(name)) for name in names]))
+        for raw in (False, True):
+            out = io.StringIO()
+            report = p.transcode(io.StringIO(text), csv.writer(out),
+                                 fields=names, raw=raw, batch_size=7)
+            rows = list(csv.reader(io.StringIO(out.getvalue())))
+            self.assertEqual(rows, [row for failed, row in expected])
+            self.assertEqual(report.error_size,
+                             sum(failed for failed, row in expected))
+        out, rejects = io.StringIO(), io.StringIO()
+        p.transcode(io.StringIO(text), csv.writer(out),
+                    rejects=csv.writer(rejects), fields=names)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows, [row for failed, row in expected if not failed])
+        rejected = list(csv.reader(io.StringIO(rejects.getvalue())))
+        self.assertEqual(len(rejected), report.error_count)
+
+    def test_post_process_batch(self):
+        class Batched(PF.Parser):
+            fields = [PF.Integer("n", 3)]
+            batch_size = 4
+            def post_process_batch(self, records):
+                self.sizes.append(len(records))
+                self.threads.add(threading.current_thread())
+                for record in records:
+                    record["double"] = record["n"] * 2
+
+        class Single(PF.Parser):
+            fields = [PF.Integer("n", 3)]
+            def post_process(self, record):
+                record["double"] = record["n"] * 2
+
+        text = "".join("%3d\n" % i for i in range(10))
+        p = Batched()
+        threaded = functools.partial(p.parse_threaded, jobs=3, chunk_size=3)
+        pipelined = functools.partial(p.parse_pipelined, jobs=3, chunk_size=3)
+        for parse in (p.parse, p.parse_iter, threaded, pipelined):
+            p.sizes = []
+            p.threads = set()
+            records = list(parse(io.StringIO(text)))
+            self.assertEqual([r["double"] for r in records],
+                             list(range(0, 20, 2)))
+            self.assertEqual(p.sizes, [4, 4, 2])
+            self.assertEqual(p.threads, {threading.current_thread()})
+        records = Single().parse(io.StringIO(text))
+        self.assertEqual(records[-1]["double"], 18)
+
+    def test_intern_fields(self):
+        p = PF.Parser(PF.String("st", 2, intern=True))
+        records = p.parse(io.StringIO("TX\nTX\n"))
+        self.assertTrue(records[0]["st"] is records[1]["st"])
+        h = DelimFieldParseHarness(P.String("st", intern=10))
+        self.assertTrue(h("".join(["T", "X"])) is h("".join(["T", "X"])))
+
 class FixedFieldParseHarness(object):
     """ Use me to test individual fixed width parse field objects """
     def __init__(self, field):
@@ -57,7 +374,7 @@ class FixedFieldParseHarness(object):
     def __call__(self, value):
         self.errors = []
         self.warnings = []
-        buf = six.StringIO(value)
+        buf = io.StringIO(value)
         value = self.field.parse(buf, self.err, self.warn)
         return value
 
@@ -76,7 +393,7 @@ class ParseDelimTestCase(unittest.TestCase):
         self.assertEqual(h.errors[0], 'Expected year after 1900')
 
     def test_tab_delim(self):
-        b = six.StringIO("""\
+        b = io.StringIO("""\
 a\tb\tc
 d\te\tf
 """)
@@ -91,6 +408,36 @@ d\te\tf
         self.assertEqual(next(recs), {'baz': 'c', 'foo': 'a', 'bar': 'b'})
         self.assertEqual(next(recs), {'baz': 'f', 'foo': 'd', 'bar': 'e'})
 
+    def test_scan(self):
+        p = P.Parser()
+        p.fields = [P.String("a", required=True), P.Integer("n"),
+                    P.Currency("amt", nonzero=True), P.Date("d", "%Y%m%d"),
+                    P.String("s", regex="^[0-9]+$", values=["11"])]
+        text = "x,1,2.5,20010101,11\n,a,0,2001,xy\ny,2,abc\n"
+        report = p.scan(io.StringIO(text))
+        counts = {}
+        for record in p.parse(io.StringIO(text)):
+            for field, value, msg, col in record.errors:
+                counts[field.name] = counts.get(field.name, 0) + 1
+        self.assertEqual(report.field_errors, counts)
+        self.assertEqual(counts["s"], 2)
+        self.assertEqual(report.width_errors, 1)
+        self.assertEqual(report.error_size, 2)
+
+    def test_sample(self):
+        p = P.Parser()
+        p.header_lines = 1
+        p.fields = [P.String("a"), P.Integer("n")]
+        text = "a,n\n" + "".join("r%d,%d\n" % (i, i) for i in range(10))
+        records = p.sample(io.StringIO(text), every=4)
+        self.assertEqual([r.line_no for r in records], [2, 6, 10])
+        self.assertEqual([r["n"] for r in records], [0, 4, 8])
+        records = p.sample(io.StringIO(text), random=3, seed=7)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(
+            [r["a"] for r in records],
+            [r["a"] for r in p.sample(io.StringIO(text), random=3, seed=7)])
+
 class DelimFieldParseHarness(object):
     """ Use me to test individual delimited parse field objects """
     def __init__(self, field):
@@ -108,11 +455,593 @@ class DelimFieldParseHarness(object):
     def warn(self, msg):
         self.warnings.append(msg)
 
+def reference_parse_decimal(s):
+    """ parse_decimal as it was before the fast path was added """
+    if not isinstance(s, str):
+        return decimal.Decimal(s)
+    s = s.replace(",", "")
+    for p in [r"^(\.\d+)$", r"^.*?(\d+\.\d+).*$", r"^.*?(\d+).*$"]:
+        match = re.match(p, s)
+        if match:
+            return decimal.Decimal(match.groups()[0])
+    try:
+        return decimal.Decimal(s)
+    except decimal.InvalidOperation:
+        return None
+
+class UtilTestCase(unittest.TestCase):
+    def random_values(self, count):
+        rand = random.Random(1234)
+        alphabet = "0123456789" * 3 + ".,-+$ eE\n\u0663x"
+        values = []
+        for i in range(count):
+            size = rand.randint(0, 12)
+            values.append("".join(rand.choice(alphabet) for j in range(size)))
+        values.extend([0, 15, -3, decimal.Decimal("1.50")])
+        return values
+
+    def test_parse_decimal_property(self):
+        for value in self.random_values(20000):
+            self.assertEqual(repr(U.parse_decimal(value)),
+                             repr(reference_parse_decimal(value)), value)
+
+    def test_parse_decimals(self):
+        values = self.random_values(2000)
+        values = values + values[::-1]
+        expected = [repr(reference_parse_decimal(v)) for v in values]
+        got = U.parse_decimals(values, memo_size=100)
+        self.assertEqual([repr(v) for v in got], expected)
+
+    def test_strftime_time_zones(self):
+        utc = datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        east = utc.astimezone(datetime.timezone(datetime.timedelta(hours=2)))
+        self.assertEqual(utc, east)
+        self.assertEqual(U.strftime(utc, "%H:%M"), "12:00")
+        self.assertEqual(U.strftime(east, "%H:%M"), "14:00")
+
+    def test_strftime_before_1900(self):
+        d = datetime.datetime(1850, 7, 4, 9, 5, 3)
+        self.assertEqual(U.strftime(d, "%Y%m%d"), "18500704")
+        self.assertEqual(U.strftime(d, "%m/%d/%Y %H:%M:%S"),
+                         "07/04/1850 09:05:03")
+        self.assertEqual(U.strftime(d, "%y 100%%"), "50 100%")
+        self.assertEqual(U.strftime(datetime.date(999, 1, 2), "%Y-%m-%d"),
+                         " 999-01-02")
+        self.assertEqual(U.strftime(d, "%b %Y"), "Jul 1850")
+
+    def test_intern_table(self):
+        table = U.InternTable(limit=2)
+        a = table("".join(["T", "X"]))
+        self.assertTrue(table("".join(["T", "X"])) is a)
+        table("OK")
+        self.assertTrue(table.active)
+        table("LA")
+        self.assertFalse(table.active)
+        self.assertEqual(table.table, {})
+        self.assertFalse(table("".join(["T", "X"])) is a)
+
+class ImportTestCase(unittest.TestCase):
+    def test_lazy_imports(self):
+        """ Importing the parsers must not load heavy or optional modules """
+        import subprocess
+        import sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for module in ("reclib.parse.fw", "reclib.parse.delim",
+                       "reclib.validate"):
+            code = ("import sys, %s; print(' '.join(sorted(sys.modules)))"
+                    % module)
+            out = subprocess.check_output([sys.executable, "-S", "-c", code],
+                                          cwd=root, universal_newlines=True)
+            loaded = set(out.split())
+            for name in ("six", "future", "numpy", "concurrent.futures",
+                         "reclib.parse.fwarray", "reclib.columnar",
+                         "reclib.format", "queue", "threading", "pickle",
+                         "tempfile", "random", "locale", "shutil",
+                         "logging"):
+                self.assertNotIn(name, loaded, module)
+
+    def test_lazy_submodules(self):
+        import reclib
+        import reclib.parse
+        self.assertTrue(callable(reclib.sort.sort))
+        self.assertIs(reclib.parse.rec, R)
+        self.assertRaises(AttributeError, getattr, reclib, "nothing")
+        self.assertIs(PF.log, logging.getLogger("reclib"))
+        self.assertIs(P.log, PF.log)
+        self.assertRaises(AttributeError, getattr, PF, "nothing")
+
+class OpenInputTestCase(TempDirMixin, unittest.TestCase):
+    def write(self, name, text, module=None):
+        data = text.encode("ascii")
+        if module is not None:
+            data = module.compress(data)
+        with open(self.path(name), "wb") as f:
+            f.write(data)
+        return self.path(name)
+
+    def test_formats(self):
+        import bz2, gzip, lzma
+        text = "".join("%06d%-10s\n" % (i, "x" * (i % 7)) for i in range(5000))
+        paths = [self.write("plain.gz", text),
+                 self.write("a.txt", text, gzip),
+                 self.write("b", text, bz2),
+                 self.write("c.dat", text, lzma)]
+        self.assertEqual([U.compression(p) for p in paths],
+                         [None, "gzip", "bz2", "xz"])
+        p = PF.Parser(PF.Integer("n", 6), PF.String("s", 10))
+        expected = [dict(r) for r in p.parse(io.StringIO(text))]
+        for path in paths:
+            for threaded in (False, True):
+                with U.open_input(path, threaded=threaded,
+                                  buffer_size=4096) as f:
+                    self.assertEqual(f.read(), text)
+            self.assertEqual([dict(r) for r in p.parse_file(path)], expected)
+            self.assertEqual([dict(r) for r in p.parse_iter(path)], expected)
+        self.assertEqual(p.sample(paths[1], every=1000)[1]["n"], 1000)
+        self.assertEqual(
+            [dict(r) for r in p.parse_file(paths[1], "r", encoding="ascii",
+                                           threaded=True)], expected)
+        d = P.Parser()
+        d.fields = [P.Integer("n")]
+        for parser in (p, d):
+            # open's buffering would be open_input's encoding.
+            self.assertRaises(TypeError, parser.parse_file, paths[0], "r", -1)
+
+    def pipe(self, data):
+        """ A /dev/fd path reading data from a pipe fed by a thread """
+        read_fd, write_fd = os.pipe()
+
+        def feed():
+            with os.fdopen(write_fd, "wb") as f:
+                f.write(data)
+
+        thread = threading.Thread(target=feed)
+        thread.start()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(thread.join)
+        return "/dev/fd/%d" % read_fd
+
+    @unittest.skipUnless(os.path.isdir("/dev/fd"), "needs /dev/fd")
+    def test_pipes(self):
+        """ Pipes are opened once, so their first bytes are not lost """
+        import gzip
+        text = "".join("%06d%-10s\n" % (i, "x" * (i % 7)) for i in range(500))
+        p = PF.Parser(PF.Integer("n", 6), PF.String("s", 10))
+        expected = [dict(r) for r in p.parse(io.StringIO(text))]
+        for data in (text.encode("ascii"), gzip.compress(text.encode("ascii"))):
+            self.assertEqual([dict(r) for r in p.parse_file(self.pipe(data))],
+                             expected)
+            self.assertEqual(len(p.sample(self.pipe(data), every=100)), 5)
+        d = P.Parser()
+        d.fields = [P.Integer("n"), P.String("s")]
+        records = d.parse_file(self.pipe(b"1,a\n2,b\n"))
+        self.assertEqual([r["s"] for r in records], ["a", "b"])
+
+    def test_threaded_close_and_errors(self):
+        import gzip
+        text = "0123456789\n" * 200000
+        path = self.write("big", text, gzip)
+        f = U.open_input(path, threaded=True, buffer_size=1024)
+        self.assertEqual(f.readline(), "0123456789\n")
+        f.close()
+        with open(path, "rb") as src:
+            data = src.read()
+        with open(path, "wb") as dst:
+            dst.write(data[:len(data) // 2])
+        f = U.open_input(path, threaded=True)
+        self.assertRaises(EOFError, f.read)
+        f.close()
+
+class CLIParser(PF.Parser):
+    fields = [PF.String("id", 4, required=True), PF.Integer("qty", 3),
+              PF.Date("filled", 8, "%Y%m%d")]
+
+class CLIHookParser(CLIParser):
+    def post_process(self, record):
+        record["qty"] *= 2
+
+class CLIStreamParser(PF.Parser):
+    class Id(PF.String):
+        def parse(self, stream, err, warn):
+            value = PF.String.parse(self, stream, err, warn)
+            return value and value.lower()
+    fields = [Id("id", 4, required=True), PF.Integer("qty", 3),
+              PF.Date("filled", 8, "%Y%m%d")]
+
+class CLIFormatter(F.Formatter):
+    fields = [F.String("id", 4), F.Integer("qty", 3),
+              F.String("filled", 10)]
+
+class CLIAmountFormatter(F.Formatter):
+    fields = [F.String("id", 4), F.Currency("qty", 5, implied_decimal=2)]
+
+class CLITestCase(TempDirMixin, unittest.TestCase):
+    def run_main(self, *args):
+        import reclib.__main__ as M
+        self.assertEqual(M.main(list(args) + ["-q"]), 0)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def test_fw2csv(self):
+        import gzip
+        lines = ["A%03d%3d20240131" % (i % 1000, i % 50) for i in range(1, 3001)]
+        lines[9] = "    1x 20240131"
+        with gzip.open(self.path("in.gz"), "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        for jobs in ("1", "2"):
+            self.run_main("fw2csv", "reclib.test.CLIParser", self.path("in.gz"),
+                          "-o", self.path("out.csv"), "--jobs", jobs,
+                          "--chunk-size", "100", "--rejects", self.path("rej"))
+            out = self.read("out.csv").splitlines()
+            self.assertEqual(out[0], "id,qty,filled")
+            self.assertEqual(out[1], "A001,1,2024-01-31")
+            self.assertEqual(len(out), 3000)
+            self.assertEqual(out[-1], "A000,0,2024-01-31")
+            rejects = self.read("rej").splitlines()
+            self.assertEqual(rejects[1:], ["10,id,,missing required value"])
+        self.run_main("fw2csv", "reclib.test.CLIParser", self.path("in.gz"),
+                      "-o", self.path("out.csv"), "--fields", "filled,id")
+        out = self.read("out.csv").splitlines()
+        self.assertEqual(out[:2], ["filled,id", "2024-01-31,A001"])
+        self.assertEqual(len(out), 3001)
+        for jobs in ("1", "2"):
+            self.run_main("fw2csv", "reclib.test.CLIHookParser",
+                          self.path("in.gz"), "-o", self.path("out.csv"),
+                          "--fields", "id,qty,filled_iso", "--jobs", jobs)
+            out = self.read("out.csv").splitlines()
+            self.assertEqual(out[:2], ["id,qty,filled_iso", "A001,2,20240131"])
+            self.run_main("fw2csv", "reclib.test.CLIStreamParser",
+                          self.path("in.gz"), "-o", self.path("out.csv"),
+                          "--jobs", jobs, "--rejects", self.path("rej"))
+            out = self.read("out.csv").splitlines()
+            self.assertEqual(out[1], "a001,1,2024-01-31")
+            self.assertEqual(len(out), 3000)
+            rejects = self.read("rej").splitlines()
+            self.assertEqual(rejects[1:], ["10,id,,missing required value"])
+
+    def test_csv2fw(self):
+        with open(self.path("in.csv"), "w") as f:
+            f.write("id,qty,filled,other\nA1,5,2024-01-31,x\nB2,,,y\n")
+        self.run_main("csv2fw", "reclib.test.CLIFormatter",
+                      self.path("in.csv"), "-o", self.path("out.txt"))
+        self.assertEqual(self.read("out.txt"),
+                         "A1  0052024-01-31\nB2  000          \n")
+
+    def test_csv2fw_unformatted(self):
+        import contextlib
+        with open(self.path("in.csv"), "w", encoding="utf-8") as f:
+            f.write("id,qty,filled,other\nA1,5,2024-01-31,\u00e9\nC3,x,,z\n")
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            self.run_main("csv2fw", "reclib.test.CLIAmountFormatter",
+                          self.path("in.csv"), "-o", self.path("out.txt"))
+        self.assertEqual(self.read("out.txt"), "A1    500\n")
+        self.assertEqual(err.getvalue().splitlines()[0][:17],
+                         "line 3 left out: ")
+
+    def test_summary_counts_bytes(self):
+        import reclib.__main__ as M
+        summary = M.Summary()
+        f = io.TextIOWrapper(io.BytesIO("\u00e9\u00e9\nab\n".encode("utf-8")),
+                             encoding="utf-8")
+        self.assertEqual(list(summary.count_input(f)), ["\u00e9\u00e9\n", "ab\n"])
+        self.assertEqual(summary.bytes, 8)
+
+class ReconcileTestCase(unittest.TestCase):
+    def streams(self):
+        p = P.Parser()
+        p.fields = [P.String("id"), P.String("plan"), P.Integer("n")]
+        rand = random.Random(5)
+        old, new = [], []
+        for i in range(400):
+            row = "%d,%s,%d\n" % (i, rand.choice("AB"), i % 7)
+            if i % 10 != 3:
+                old.append(row)
+            if i % 10 == 5:
+                row = row.replace(",A,", ",C,").replace(",B,", ",C,")
+            if i % 10 != 7:
+                new.append(row)
+        new.append("1,A,1\n")
+        return (p.parse_iter(io.StringIO("".join(old))),
+                p.parse_iter(io.StringIO("".join(new))))
+
+    def summary(self, changes):
+        return sorted((c.status, c.key, c.fields) for c in changes)
+
+    def test_reconcile(self):
+        import reclib.reconcile as RC
+        changes = self.summary(RC.reconcile(*self.streams(), keys=["id"]))
+        self.assertEqual(len([c for c in changes if c[0] == "added"]), 41)
+        self.assertEqual(len([c for c in changes if c[0] == "removed"]), 40)
+        self.assertEqual([c for c in changes if c[0] == "changed"],
+                         [("changed", (str(i),), ["plan"])
+                          for i in sorted(range(5, 400, 10), key=str)])
+        spilled = RC.reconcile(*self.streams(), keys=["id"],
+                               memory_budget=2000, partitions=5)
+        self.assertEqual(self.summary(spilled), changes)
+        plain = RC.reconcile([{"a": 1, "b": 2}], [{"a": 1, "b": 3}], ["a"])
+        self.assertEqual(self.summary(plain), [("changed", (1,), ["b"])])
+
+    def test_partitions_fit_budget(self):
+        import reclib.reconcile as RC
+        old, new = self.streams()
+        spill = RC._Partitions(64, 3000)
+        try:
+            for record in old:
+                spill.add(0, (record["id"],), record)
+                self.assertLessEqual(spill.pending_size, 3000)
+        finally:
+            spill.close()
+        # Two partitions are each well past the budget, so they are split
+        # again; a key shared by every record cannot be and is loaded whole.
+        expected = self.summary(RC.reconcile(*self.streams(), keys=["id"]))
+        loaded = []
+        join = RC._join
+
+        def logged(held, *args):
+            loaded.append(sum(len(v) for v in held.values()))
+            return join(held, *args)
+
+        RC._join = logged
+        try:
+            changes = self.summary(RC.reconcile(*self.streams(), keys=["id"],
+                                                memory_budget=20000,
+                                                partitions=2))
+            self.assertEqual(changes, expected)
+            self.assertTrue(len(loaded) > 2)
+            self.assertTrue(max(loaded) < 100)
+            same = [{"k": 1, "n": i} for i in range(300)]
+            changes = RC.reconcile(same, same, ["k"], memory_budget=2000,
+                                   partitions=2)
+            self.assertEqual(list(changes), [])
+        finally:
+            RC._join = join
+
+class SortTestCase(unittest.TestCase):
+    def records(self):
+        p = PF.Parser(PF.String("member", 3), PF.Integer("n", 3),
+                      PF.Date("d", 8, "%Y%m%d"))
+        rand = random.Random(9)
+        lines = ["%-3s%3d%8s" % (rand.choice(["A", "B", "C", "D"]),
+                                rand.randint(0, 20),
+                                rand.choice(["20010101", "bad", ""]))
+                 for i in range(1000)]
+        return p.parse_iter(io.StringIO("\n".join(lines) + "\n"))
+
+    def summary(self, records):
+        return [(r["member"], r["d"], r.line_no, len(r.errors))
+                for r in records]
+
+    def test_sort(self):
+        import reclib.sort as S
+        key = lambda r: (r["d"] is None, r["d"] or 0, r["member"])
+        expected = self.summary(sorted(self.records(), key=key))
+        got = S.sort(self.records(), ["d", "member"], memory_budget=20000)
+        self.assertEqual(self.summary(got), expected)
+        # None stays last when reversed
+        key = lambda r: (r["d"] is not None, r["d"] or 0, r["member"])
+        expected = self.summary(sorted(self.records(), key=key, reverse=True))
+        self.assertEqual(expected[-1][1], None)
+        for budget in (20000, None):
+            got = S.sort(self.records(), ["d", "member"], reverse=True,
+                         memory_budget=budget)
+            self.assertEqual(self.summary(got), expected)
+
+    def test_group_by(self):
+        import reclib.sort as S
+        groups = list(S.group_by(self.records(), ["member"],
+                                 memory_budget=20000))
+        self.assertEqual([g for g, rs in groups], [("A",), ("B",), ("C",),
+                                                   ("D",)])
+        self.assertEqual(sum(len(rs) for g, rs in groups), 1000)
+        for group, records in groups:
+            line_nos = [r.line_no for r in records]
+            self.assertEqual(line_nos, sorted(line_nos))
+
+class ColumnarTestCase(TempDirMixin, unittest.TestCase):
+    def test_round_trip(self):
+        p = PF.Parser(
+            PF.String("name", 4, required=True),
+            PF.Integer("n", 3),
+            PF.Currency("amt", 6, implicit=2),
+            PF.Date("d", 8, "%Y%m%d"),
+            PF.Multi(PF.String("c", 1), 2))
+        records = p.parse(io.StringIO(
+            "abcd12300150020011230xy\n"
+            "    x  000001        ab\n"))
+        path = self.path("recs.col")
+        self.assertEqual(C.dump(records, path), 2)
+        with C.load(path) as cf:
+            self.assertEqual(cf.kind("amt"), "decimal")
+            self.assertEqual(cf.kind("d"), "date")
+            self.assertEqual(list(cf.records()), [dict(r) for r in records])
+            self.assertEqual(list(cf.line_nos), [1, 2])
+            self.assertEqual([e[1:4:2] for e in cf.errors],
+                             [('name', 'missing required value'),
+                              ('n', 'cannot translate to number')])
+            self.assertEqual(cf["n"].values[0], 123)
+
+    def test_mixed_values(self):
+        records = [{"a": None, "b": 1}, {"a": "x", "b": "s"},
+                   {"a": 2 ** 70, "c": decimal.Decimal("1.5")},
+                   {"c": decimal.Decimal("-2.125")}]
+        path = self.path("mixed.col")
+        C.dump(records, path, ["a", "b", "c"])
+        with C.load(path) as cf:
+            self.assertEqual([cf.kind(n) for n in cf.names],
+                             ["object", "object", "decimal"])
+            self.assertEqual(list(cf["a"]), [None, "x", 2 ** 70, None])
+            self.assertEqual(list(cf["c"]), [None, None, decimal.Decimal("1.5"),
+                                             decimal.Decimal("-2.125")])
+
+class RecordSetTestCase(unittest.TestCase):
+    def record(self, claim, line, failed=False):
+        record = PF.Record([], 0)
+        record.update(claim=claim, line=line)
+        if failed:
+            record.errors(PF.String("claim", 3), claim, "bad")
+        return record
+
+    def test_index_by(self):
+        records = R.RecordSet()
+        records.extend([self.record("A", 1), self.record("A", 2),
+                        self.record("B", 1)])
+        claims = records.index_by("claim")
+        self.assertIs(records.index_by("claim"), claims)
+        self.assertEqual([r["line"] for r in claims.all("A")], [1, 2])
+        self.assertEqual(claims.get("B")["line"], 1)
+        self.assertIsNone(claims.get("C"))
+        self.assertRaises(ValueError, claims.one, "A")
+        self.assertRaises(KeyError, claims.one, "C")
+        lines = records.index_by("claim", "line")
+        self.assertEqual(lines[("A", 2)]["line"], 2)
+        records.append(self.record("C", 1))
+        self.assertEqual(claims.one("C")["claim"], "C")
+        self.assertIn(("C", 1), lines)
+        del records[0]
+        self.assertEqual(len(claims.all("A")), 1)
+        records.sort(key=lambda r: r["line"], reverse=True)
+        self.assertEqual(claims.one("A")["line"], 2)
+        self.assertEqual(len(lines), 3)
+
+    def test_views(self):
+        records = R.RecordSet("src")
+        records.extend([self.record("A", 1), self.record("B", 1, True)])
+        accepted = records.accepted()
+        self.assertEqual([r["claim"] for r in accepted], ["A"])
+        self.assertEqual(accepted.src, "src")
+        records.append(self.record("C", 1, True))
+        self.assertIs(records.accepted(), accepted)
+        self.assertEqual([r["claim"] for r in records.rejected()],
+                         ["B", "C"])
+        records.pop(1)
+        self.assertEqual([r["claim"] for r in records.rejected()], ["C"])
+        records[0].errors(PF.String("claim", 3), "A", "late")
+        self.assertEqual(len(records.accepted()), 0)
+        self.assertEqual(len(records.rejected()), 2)
+        records.rejected().clear()
+        self.assertEqual(len(records.rejected()), 2)
+        del records[0].errors[0]
+        self.assertIs(records.accepted(), accepted)
+        self.assertEqual([r["claim"] for r in accepted], ["A"])
+
+    def test_views_file_new_records_only(self):
+        looked = []
+
+        class Looked(PF.Record):
+            @property
+            def errors(self):
+                looked.append(self["claim"])
+                return self._errors
+
+            @errors.setter
+            def errors(self, errors):
+                self._errors = errors
+
+        records = R.RecordSet()
+        for claim in "ABC":
+            record = Looked([], 0)
+            record["claim"] = claim
+            records.append(record)
+        records[1].errors(PF.String("claim", 3), "B", "bad")
+        self.assertEqual(len(records.rejected()), 1)
+        del looked[:]
+        records.append(self.record("D", 1, True))
+        self.assertEqual(len(records.accepted()), 2)
+        self.assertEqual(len(records.rejected()), 2)
+        self.assertEqual(looked, [])
+        records[0].errors(PF.String("claim", 3), "A", "late")
+        self.assertEqual(len(records.rejected()), 3)
+
+class SpillingRecordSetTestCase(unittest.TestCase):
+    def parser(self):
+        p = PF.Parser(PF.String("id", 4), PF.Integer("n", 3),
+                      PF.RecordList("subs", 2, PF.String("s", 1)))
+        p.memory_budget = 2000
+        return p
+
+    def text(self):
+        return "".join("%04d%3s%s\n" % (i, "x" if i % 7 == 0 else i, "ab")
+                       for i in range(200))
+
+    def test_spill(self):
+        p = self.parser()
+        records = p.parse(io.StringIO(self.text()))
+        self.assertTrue(isinstance(records, R.SpillingRecordSet))
+        self.assertTrue(records.spilled > 0)
+        p.memory_budget = None
+        expected = p.parse(io.StringIO(self.text()))
+        self.assertEqual(len(records), 200)
+        self.assertEqual([dict(r) for r in records], [dict(r) for r in expected])
+        self.assertEqual([r.line_no for r in records], list(range(1, 201)))
+        self.assertEqual(records.error_count, expected.error_count)
+        self.assertEqual(records.error_size, 29)
+        self.assertEqual(records[7]["id"], "0007")
+        self.assertEqual(records[-1]["id"], "0199")
+        self.assertTrue(records[7].errors[0][0] is p.fields[1])
+        self.assertTrue(records[7]["subs"][0].fields is p.fields[2].fields)
+
+    def test_accepted_rejected(self):
+        p = self.parser()
+        p.memory_budget = 500
+        records = p.parse(io.StringIO(self.text()))
+        rejected = records.rejected()
+        accepted = records.accepted()
+        self.assertEqual([r["id"] for r in rejected],
+                         ["%04d" % i for i in range(0, 200, 7)])
+        self.assertEqual(len(accepted), 171)
+        self.assertEqual(accepted.error_count, 0)
+        records.close()
+        self.assertEqual(len(records), 0)
+
+    def test_reuse_after_close(self):
+        """ A set filled again after close does not return old records """
+        def record(id):
+            r = PF.Record([], 0)
+            r["id"] = id
+            return r
+
+        # Spills every second record, in chunks of two
+        records = R.SpillingRecordSet(
+            memory_budget=R.estimate_size(record("aaaa")), chunk_size=2)
+
+        def fill(ids):
+            records.extend(record(id) for id in ids)
+
+        fill(["aaaa", "bbbb", "cccc", "dddd"])
+        self.assertEqual([r["id"] for r in records],
+                         ["aaaa", "bbbb", "cccc", "dddd"])
+        self.assertEqual(records.spilled, 4)
+        records.close()
+        fill(["wwww", "xxxx", "yyyy", "zzzz"])
+        self.assertEqual(records[2]["id"], "yyyy")
+        self.assertEqual(records[3]["id"], "zzzz")
+        self.assertEqual([r["id"] for r in records],
+                         ["wwww", "xxxx", "yyyy", "zzzz"])
+        records.close()
+
+def _parent_only():
+    raise TypeError("not in a worker")
+
+class ParentOnlyCheck(object):
+    """ A check that pickles but cannot be unpickled """
+    def __init__(self, field):
+        self.field = field
+
+    def __call__(self, record, result):
+        if record.get(self.field) == 1:
+            result.error(self.field, 'one')
+
+    def __reduce__(self):
+        return _parent_only, ()
+
 class ValidatorTestCase(unittest.TestCase):
     def test_DateInPast(self):
         validator = V.DateInPast('dob')
         res = V.RecordValidationResult()
-        record = {'dob' : '20230101'}
+        record = {'dob' : '29990101'}
         validator(record, res)
         self.assertEqual(res[0].field, 'dob')
         self.assertEqual(res[0].msg, 'Value must be in the past.')
@@ -122,6 +1051,63 @@ class ValidatorTestCase(unittest.TestCase):
         validator(record, res)
         self.assertEqual(len(res), 0)
 
+    def test_context_shared_between_checks(self):
+        context = V.ValidationContext(today=datetime.date(2010, 6, 1))
+        v = V.Validator(V.ISODate('dob'), V.DateInPast('dob'))
+        res = v.validate({'dob': '20100701'}, context)
+        self.assertEqual([e.msg for e in res], ['Value must be in the past.'])
+        res = v.validate({'dob': '20101301'}, context)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(context._dates, {
+            ('20100701', '%Y%m%d'): datetime.date(2010, 7, 1),
+            ('20101301', '%Y%m%d'): None})
+
+    def test_validate_all(self):
+        v = V.Validator(V.Required('name'), V.ISODate('dob'))
+        results = v.validate_all([
+            {'name': 'a', 'dob': '20010101'},
+            {'name': '', 'dob': 'bad'}])
+        self.assertEqual(len(results[0]), 0)
+        self.assertEqual([e.field for e in results[1]], ['name', 'dob'])
+        self.assertTrue(results[0].context is results[1].context)
+
+    def test_validate_parallel(self):
+        v = V.Validator(V.Required('name'), V.ISODate('dob'),
+                        V.Values('color', ['red', 'blue']))
+        records = [{'name': 'n%d' % i if i % 3 else '',
+                    'dob': '2001%02d01' % (i % 14),
+                    'color': ['red', 'green', 'blue'][i % 3],
+                    'unused': i}
+                   for i in range(500)]
+        expected = [[str(e) for e in r] for r in v.validate_all(records)]
+        got = v.validate_parallel(records, jobs=2, chunk_size=64)
+        self.assertEqual([[str(e) for e in r] for r in got], expected)
+
+    def test_worker_today(self):
+        import pickle
+        V._init_worker(pickle.dumps([V.DateInPast('dob')]),
+                       datetime.date(2000, 1, 1))
+        try:
+            size, errors = V._validate_chunk([{'dob': '20050101'},
+                                              {'dob': '19990101'}])
+        finally:
+            V._init_worker(pickle.dumps([]))
+        self.assertEqual(errors, [(0, 'dob', 'Value must be in the past.')])
+
+    def test_validate_parallel_unpicklable(self):
+        def check(record, result):
+            if record.get('x') == 1:
+                result.error('x', 'one')
+        v = V.Validator(check)
+        got = v.validate_parallel(iter([{'x': 1}, {'x': 2}]), jobs=2)
+        self.assertEqual([len(r) for r in got], [1, 0])
+
+    def test_validate_parallel_worker_unpickling(self):
+        """ Checks that workers cannot unpickle are run serially """
+        v = V.Validator(ParentOnlyCheck('x'))
+        got = v.validate_parallel(iter([{'x': 1}, {'x': 2}]), jobs=2)
+        self.assertEqual([len(r) for r in got], [1, 0])
+
     def test_length_validator(self):
         validator = V.Length('first_name', max=12)
         res = V.RecordValidationResult()
@@ -131,6 +1117,475 @@ class ValidatorTestCase(unittest.TestCase):
         validator({'first_name': 'xxxxxxxfasdfasdf'}, res)
         self.assertEqual(len(res), 1)
 
+def record_summary(records):
+    return [(dict(r), r.line_no,
+             [(f.name, v, m) for f, v, m, c in r.errors])
+            for r in records]
+
+def fw_text(seed):
+    """800 random lines of a 24 column layout, some with errors."""
+    rand = random.Random(seed)
+    lines = []
+    for i in range(800):
+        lines.append("%-4s%5s%8s%7s" % (
+            rand.choice(["AB", "", "CD", "x y"]),
+            rand.choice(["12", "", "1x", str(i)]),
+            rand.choice(["20010101", "20011301", "", "1899010"]),
+            rand.choice(["1.25", "0", "", "1.2.3", "-7"])))
+    return "\n".join(lines) + "\n"
+
+class ThreadedParseTestCase(unittest.TestCase):
+    """ Shared parsers must give the same records from many threads """
+
+    def test_fw(self):
+        p = PF.Parser(PF.String("s", 4, required=True, intern=True),
+                      PF.Integer("n", 5, strip_nonnumeric=False),
+                      PF.Date("d", 8, "%Y%m%d", min_year=1900),
+                      PF.Currency("amt", 7, nonzero=True))
+        texts = [fw_text(seed) for seed in range(8)]
+        expected = [record_summary(p.parse(io.StringIO(t))) for t in texts]
+        got = p.parse_many([io.StringIO(t) for t in texts], jobs=8)
+        self.assertEqual([record_summary(r) for r in got], expected)
+        for text, records in zip(texts, expected):
+            got = p.parse_threaded(io.StringIO(text), jobs=8, chunk_size=7)
+            self.assertEqual(record_summary(got), records)
+
+    def test_delim(self):
+        p = P.Parser()
+        p.header_lines = 1
+        p.fields = [P.String("s", required=True, intern=True),
+                    P.Integer("n"), P.Date("d", "%Y%m%d"),
+                    P.Currency("amt", nonzero=True)]
+        texts = [fw_text(seed).replace(" ", ",") for seed in range(8)]
+        texts = ["s,n,d,amt\n" + t for t in texts]
+        expected = [record_summary(p.parse(io.StringIO(t))) for t in texts]
+        got = p.parse_many([io.StringIO(t) for t in texts], jobs=8)
+        self.assertEqual([record_summary(r) for r in got], expected)
+        for text, records in zip(texts, expected):
+            got = p.parse_threaded(io.StringIO(text), jobs=8, chunk_size=7)
+            self.assertEqual(record_summary(got), records)
+
+class ProgressTestCase(TempDirMixin, unittest.TestCase):
+    """ Progress callbacks see the counts of a run and a final report """
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.parser = PF.Parser(PF.String("s", 4),
+                                PF.Integer("n", 5, strip_nonnumeric=False))
+        self.parser.batch_size = 100
+        lines = ["AB  %5s" % ("1x" if i % 10 == 0 else i) for i in range(1000)]
+        self.text = "\n".join(lines) + "\n"
+        self.file = self.path("in.txt")
+        with open(self.file, "w") as f:
+            f.write(self.text)
+
+    def reports(self, **kwargs):
+        seen = []
+        progress = G.Progress(
+            lambda p: seen.append((p.records, p.characters, p.percent, p.done)),
+            **kwargs)
+        return progress, seen
+
+    def test_parse_file(self):
+        progress, seen = self.reports(every=250, interval=3600)
+        self.parser.parse_file(self.file, progress=progress)
+        self.assertEqual([r[0] for r in seen], [300, 600, 900, 1000])
+        self.assertEqual(seen[-1][1:], (len(self.text), 100.0, True))
+        self.assertEqual(progress.rejected, 100)
+        self.assertEqual(progress.errors, 100)
+        self.assertTrue(progress.rate > 0)
+
+    def test_multibyte_percent(self):
+        with open(self.file, "w", encoding="utf-8") as f:
+            f.write(self.text.replace("AB", "\u00c9\u00c9"))
+        progress, seen = self.reports(every=250, interval=3600)
+        self.parser.parse_file(self.file, progress=progress, encoding="utf-8")
+        self.assertEqual(progress.bytes, os.path.getsize(self.file))
+        self.assertEqual(seen[-1][1:], (len(self.text), 100.0, True))
+        percents = [r[2] for r in seen]
+        self.assertEqual(percents, sorted(percents))
+
+    def test_interval(self):
+        progress, seen = self.reports(every=10**9, interval=0)
+        records = list(self.parser.parse_iter(io.StringIO(self.text),
+                                              progress=progress))
+        self.assertEqual(len(records), 1000)
+        self.assertEqual([r[0] for r in seen], list(range(100, 1001, 100)) +
+                         [1000])
+        self.assertEqual(seen[-1][2], None)
+
+    def test_callback(self):
+        seen = []
+        self.parser.parse_threaded(io.StringIO(self.text), jobs=4,
+                                   chunk_size=64, progress=seen.append)
+        self.assertEqual(len(seen), 1)
+        self.assertEqual((seen[0].records, seen[0].errors), (1000, 100))
+
+    def test_parse_many(self):
+        progress, seen = self.reports()
+        self.parser.parse_many([self.file, self.file], jobs=2,
+                               progress=progress)
+        self.assertEqual(seen, [(2000, 2 * len(self.text), 100.0, True)])
+
+        class Counting(PF.Parser):
+            fields = self.parser.fields
+            def parse(self, file_obj, src=None, progress=None):
+                self.calls.append(src)
+                return PF.Parser.parse(self, file_obj, src, progress)
+        p = Counting()
+        p.calls = []
+        progress, seen = self.reports()
+        got = p.parse_many([self.file, io.StringIO(self.text)], jobs=2,
+                           progress=progress)
+        self.assertEqual(sorted(p.calls, key=str), [None, "in.txt"])
+        self.assertEqual([len(r) for r in got], [1000, 1000])
+        self.assertEqual([r[0] for r in seen], [2000])
+
+    def test_callback_outside_lock(self):
+        seen = []
+        progress = G.Progress(
+            lambda p: seen.append((p.records, progress._lock.locked())),
+            every=100)
+        self.parser.parse(io.StringIO(self.text), progress=progress)
+        self.assertEqual(seen[-1], (1000, False))
+        self.assertFalse(any(locked for records, locked in seen))
+
+    def test_early_stop(self):
+        d = P.Parser()
+        d.fields = [P.String("s")]
+        for parser in (self.parser, d):
+            progress, seen = self.reports()
+            records = parser.parse_iter(io.StringIO(self.text),
+                                        progress=progress)
+            next(records)
+            records.close()
+            self.assertTrue(progress.done)
+            self.assertEqual(seen[-1][3], True)
+
+    def test_delim(self):
+        p = P.Parser()
+        p.fields = [P.String("s"), P.Integer("n", strip_nonnumeric=False)]
+        progress, seen = self.reports()
+        text = re.sub(" +", ",", self.text)
+        p.parse(io.StringIO(text), progress=progress)
+        self.assertEqual(seen[-1][0], 1000)
+        self.assertEqual(progress.errors, 100)
+
+    def test_format(self):
+        f = F.Formatter()
+        f.fields = [F.String("s", 2), F.Integer("n", 4)]
+        records = [{"s": "ABC" if i % 5 else "AB", "n": i}
+                   for i in range(2500)]
+        progress, seen = self.reports(every=1000, interval=3600)
+        out = f.format(records, progress=progress)
+        self.assertEqual([r[0] for r in seen], [1000, 2000, 2500])
+        self.assertEqual(seen[-1][1], len(out.getvalue()))
+        self.assertEqual(progress.errors, 2000)
+
+class EditTestCase(unittest.TestCase):
+    """ Records parsed with keep_lines are written back byte for byte """
+    def setUp(self):
+        self.parser = PF.Parser(PF.String("name", 6),
+                                PF.Currency("amt", 8),
+                                PF.Date("d", 8, "%Y%m%d"),
+                                PF.Integer("n", 4))
+        self.parser.keep_lines = True
+        self.formatter = F.Formatter()
+        self.formatter.fields = [F.String("name", 6), F.Currency("amt", 8),
+                                 F.Date("d", 8, "%Y%m%d"), F.Integer("n", 4)]
+        self.lines = ["abc   0001.50 20010101  12",
+                      "xyz   -2.0    20011301 007"]
+
+    def parse(self):
+        return self.parser.parse(io.StringIO("\n".join(self.lines) + "\n"))
+
+    def test_untouched(self):
+        records = self.parse()
+        self.assertEqual(records[0].edited, set())
+        out = self.formatter.format(records).getvalue()
+        self.assertEqual(out, "\n".join(self.lines))
+
+    def test_splice(self):
+        records = self.parse()
+        records[0]["name"] = "ABCDEF"
+        records[1]["n"] = 42
+        records[1]["note"] = "not written"
+        self.assertEqual(records[1].edited, set(["n", "note"]))
+        out = self.formatter.format(records).getvalue().split("\n")
+        self.assertEqual(out, ["ABCDEF0001.50 20010101  12",
+                               "xyz   -2.0    200113010042"])
+
+    def test_fallback(self):
+        self.formatter.fields = self.formatter.fields[1:]
+        records = self.parse()
+        records[0]["amt"] = decimal.Decimal("3")
+        out = self.formatter.format(records[:1]).getvalue()
+        self.assertEqual(out, "       3200101010012")
+
+    def test_other_layout(self):
+        """ A formatter with the fields in another order formats in full """
+        p = PF.Parser(PF.String("name", 6), PF.Integer("n", 4))
+        p.keep_lines = True
+        f = F.Formatter()
+        f.fields = [F.Integer("n", 4), F.String("name", 6)]
+        record = p.parse_raw("abc     12")
+        self.assertEqual(f.formatline(record, F.Reporter(), 1), "0012abc   ")
+        f.fields = [F.String("name", 6), F.Integer("n", 4)]
+        self.assertEqual(f.formatline(record, F.Reporter(), 1), "abc     12")
+
+    def test_nested(self):
+        """ Changes inside Multi and RecordList values are written """
+        class Pairs(object):
+            name = "l"
+            length = 4
+
+            def format(self, record, reporter):
+                return "".join(r["s"] for r in record["l"])
+
+        p = PF.Parser(PF.Multi(PF.String("m", 2), 2),
+                      PF.RecordList("l", 2, PF.String("s", 2)))
+        p.keep_lines = True
+        f = F.Formatter()
+        f.fields = [F.Array(F.String("m", 2), 2), Pairs()]
+        record = p.parse_raw("xxyyaabb")
+        self.assertIsInstance(record, PF.EditRecord)
+        self.assertEqual(record.edited, set(["m", "l"]))
+        record["l"][0]["s"] = "ZZ"
+        record["m"][1] = "QQ"
+        self.assertEqual(f.formatline(record, F.Reporter(), 1), "xxQQZZbb")
+
+    def test_pickle(self):
+        registry = R.FieldRegistry()
+        records = self.parse()
+        records[1]["name"] = "q"
+        registry.register(records[1])
+        copy = registry.loads(registry.dumps(records[1]))
+        self.assertEqual(copy.edited, set(["name"]))
+        self.assertEqual(self.formatter.formatline(copy, F.Reporter(), 1),
+                         "q     -2.0    20011301 007")
+
+class StatsTestCase(unittest.TestCase):
+    """ Field profiles are counted in one pass and merge """
+    def setUp(self):
+        self.parser = PF.Parser(PF.String("s", 4),
+                                PF.Integer("n", 5, strip_nonnumeric=False))
+        rand = random.Random(3)
+        lines = []
+        for i in range(3000):
+            s = rand.choice(["AB", "CD", "", "EFGH"]) if i % 3 else "x%d" % i
+            n = rand.choice(["1x", "", str(i)])
+            lines.append("%-4s%5s" % (s[:4], n))
+        self.text = "\n".join(lines) + "\n"
+
+    def test_errors_once_per_record(self):
+        p = PF.Parser(PF.String("s", 2, regex="^[0-9]+$", values=["11"]))
+        profile = S.Profile().update(p.parse_iter(io.StringIO("xy\n11\n")))
+        s = profile.summary()["s"]
+        self.assertEqual((s["errors"], s["error_rate"]), (1, 0.5))
+        self.assertEqual(profile.rejected, 1)
+
+    def test_profile(self):
+        profile = S.Profile()
+        records = list(profile.observe(
+            self.parser.parse_iter(io.StringIO(self.text))))
+        self.assertEqual(profile.records, len(records))
+        n = profile.summary()["n"]
+        values = [r["n"] for r in records]
+        self.assertEqual(n["count"], 3000)
+        self.assertEqual(n["nulls"], values.count(None))
+        self.assertEqual(n["errors"],
+                         sum(1 for r in records if r.errors))
+        self.assertEqual(profile.rejected, n["errors"])
+        self.assertEqual(n["max"], max(v for v in values if v is not None))
+        s = profile["s"]
+        self.assertEqual(s.top.top(1)[0][0],
+                         max(["AB", "CD", "", "EFGH"], key=[
+                             r["s"] for r in records].count))
+        exact = len(set(r["s"] for r in records))
+        self.assertTrue(abs(len(s.distinct) - exact) < exact * 0.05)
+
+    def test_merge(self):
+        lines = self.text.splitlines(True)
+        whole = S.Profile().update(self.parser.parse(io.StringIO(self.text)))
+        merged = S.Profile()
+        registry = R.FieldRegistry()
+        for i in range(0, 3000, 700):
+            part = S.Profile().update(
+                self.parser.parse(io.StringIO("".join(lines[i:i + 700]))))
+            merged.merge(registry.loads(registry.dumps(part)))
+        # Misra-Gries counts depend on the order values are pruned in.
+        merged, whole = merged.summary(), whole.summary()
+        self.assertEqual([v for v, c in merged["s"]["top"][:2]],
+                         [v for v, c in whole["s"]["top"][:2]])
+        for name in ("s", "n"):
+            del merged[name]["top"], whole[name]["top"]
+        self.assertEqual(merged, whole)
+
+    def test_hyperloglog(self):
+        a, b = S.HyperLogLog(), S.HyperLogLog()
+        for i in range(20000):
+            a.add(i)
+            b.add(i + 10000)
+        self.assertTrue(abs(len(a) - 20000) < 1000)
+        a.merge(b)
+        self.assertTrue(abs(len(a) - 30000) < 1500)
+
+    def test_topk(self):
+        top = S.TopK(4)
+        for i in range(1000):
+            top.add("hot" if i % 4 == 0 else i)
+        self.assertEqual(top.top(1)[0][0], "hot")
+        self.assertTrue(len(top.counts) <= 8)
+
+    def test_equal_values_of_other_text(self):
+        stats = S.FieldStats()
+        for value in (decimal.Decimal("1.5"), decimal.Decimal("1.50"), 1, 1.0,
+                      decimal.Decimal("1.50")):
+            stats.add(value)
+        self.assertEqual(stats.lengths, {3: 2, 4: 2, 1: 1})
+
+class FailingLines(object):
+    """ Lines of text, then an IOError """
+    def __init__(self, text, fail_at):
+        self.lines = text.splitlines(True)[:fail_at]
+
+    def __iter__(self):
+        for line in self.lines:
+            yield line
+        raise IOError("disk went away")
+
+
+class PipelinedTestCase(unittest.TestCase):
+    """ Pipelined parses give parse_iter's records and clean up """
+    def setUp(self):
+        self.parser = PF.Parser(PF.String("s", 4),
+                                PF.Integer("n", 5, strip_nonnumeric=False),
+                                PF.Date("d", 8, "%Y%m%d"))
+        self.text = fw_text(5)
+        self.threads = threading.active_count()
+
+    def test_order(self):
+        expected = record_summary(self.parser.parse_iter(
+            io.StringIO(self.text)))
+        for jobs in (1, 3):
+            got = self.parser.parse_pipelined(io.StringIO(self.text),
+                                              jobs=jobs, chunk_size=7)
+            self.assertEqual(record_summary(got), expected)
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def test_delim(self):
+        p = P.Parser()
+        p.header_lines = 1
+        p.fields = [P.String("s"), P.Integer("n"), P.Date("d", "%Y%m%d")]
+        text = "s,n,d\n" + re.sub("  +", ",", self.text)
+        expected = record_summary(p.parse_iter(io.StringIO(text)))
+        got = p.parse_pipelined(io.StringIO(text), jobs=2, chunk_size=5)
+        self.assertEqual(record_summary(got), expected)
+
+    def test_read_error(self):
+        got = []
+        records = self.parser.parse_pipelined(FailingLines(self.text, 500),
+                                              chunk_size=64)
+        with self.assertRaises(IOError):
+            for record in records:
+                got.append(record.line_no)
+        self.assertEqual(got, list(range(1, 501)))
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def test_parse_error(self):
+        class Failing(PF.Parser):
+            fields = self.parser.fields
+            batch_size = 100
+
+            def post_process(self, record):
+                if record.line_no == 300:
+                    raise ValueError("bad record")
+        got = []
+        with self.assertRaises(ValueError):
+            for record in Failing().parse_pipelined(io.StringIO(self.text),
+                                                    jobs=2, chunk_size=50):
+                got.append(record.line_no)
+        # As parse_iter, the records of the failing batch are not given.
+        self.assertEqual(got, list(range(1, 201)))
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def test_hooks_in_consumer(self):
+        class Custom(object):
+            name = "custom"
+            def assign(self, record, stream, err, warn):
+                record[self.name] = stream.read(2)
+        class Hooked(PF.Parser):
+            def post_process(self, record):
+                self.threads.add(threading.current_thread())
+        for fields in (self.parser.fields, [Custom()]):
+            p = Hooked(*fields)
+            p.threads = set()
+            progress = G.Progress(lambda p: None)
+            records = p.parse_pipelined(io.StringIO(self.text), jobs=2,
+                                        chunk_size=50, progress=progress)
+            next(records)
+            records.close()
+            self.assertEqual(p.threads, {threading.current_thread()})
+            self.assertTrue(progress.done)
+
+    def test_close(self):
+        records = self.parser.parse_pipelined(io.StringIO(self.text * 50),
+                                              jobs=2, chunk_size=10, ahead=2)
+        first = [next(records) for i in range(5)]
+        self.assertTrue(threading.active_count() > self.threads)
+        records.close()
+        self.assertEqual([r.line_no for r in first], [1, 2, 3, 4, 5])
+        self.assertEqual(threading.active_count(), self.threads)
+
+class FormatAsyncTestCase(unittest.TestCase):
+    """ format_async streams what format writes to a socket """
+    def setUp(self):
+        self.formatter = F.Formatter()
+        self.formatter.fields = [F.String("s", 3), F.Integer("n", 6)]
+        self.records = [{"s": "abcd" if i % 7 == 0 else "ab\u00e9", "n": i}
+                        for i in range(5000)]
+
+    def serve(self, records, **kwargs):
+        import asyncio
+
+        async def run():
+            received = []
+            done = asyncio.Event()
+
+            async def handle(reader, writer):
+                received.append(await reader.read())
+                writer.close()
+                done.set()
+
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            reporter = await self.formatter.format_async(records, writer,
+                                                         **kwargs)
+            writer.close()
+            await writer.wait_closed()
+            await done.wait()
+            server.close()
+            await server.wait_closed()
+            return received[0], reporter
+
+        return asyncio.run(run())
+
+    def test_sync_records(self):
+        data, reporter = self.serve(self.records, chunk_size=1000)
+        expected = self.formatter.format(self.records).getvalue()
+        self.assertEqual(data.decode("utf-8"), expected)
+        self.assertEqual(len(reporter.warnings), 715)
+
+    def test_async_records(self):
+        async def records():
+            for record in self.records[:10]:
+                yield record
+
+        data, reporter = self.serve(records(), encoding="latin-1")
+        expected = self.formatter.format(self.records[:10]).getvalue()
+        self.assertEqual(data, expected.encode("latin-1"))
+        self.assertEqual(len(reporter.warnings), 2)
+
 if __name__ == '__main__':
     unittest.main()
 
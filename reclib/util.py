@@ -1,5 +1,10 @@
-from builtins import str
+import collections
+import datetime
 import decimal
+import functools
+import io
+import itertools
+import operator
 import re
 import time
 
@@ -19,15 +24,20 @@ def decimal2implicit(value, implicit):
 
 def parse_decimal(
     s,
-    p1=re.compile("^(\.\d+)$"),
-    p2=re.compile("^.*?(\d+\.\d+).*$"),
-    p3=re.compile("^.*?(\d+).*$"),
+    p1=re.compile(r"^(\.\d+)$"),
+    p2=re.compile(r"^.*?(\d+\.\d+).*$"),
+    p3=re.compile(r"^.*?(\d+).*$"),
+    plain=re.compile(r"\d*\.?\d+\Z").match,
 ):
     """Strips out a real number from an arbitrary string. If no number can
     be found, returns None. Useful for currency parsing.
     """
     if not isinstance(s, str):
         return decimal.Decimal(s)
+    # Already clean strings like "12", "12.50" and ".5" are what the
+    # patterns below would extract anyway.
+    if plain(s):
+        return decimal.Decimal(s)
     s = s.replace(",", "")
 
     for p in [p1, p2, p3]:
@@ -40,6 +50,132 @@ def parse_decimal(
         return None
 
 
+def parse_decimals(values, memo_size=1024):
+    """parse_decimal for many values. Remembers the result for up to
+    memo_size distinct strings, so columns with repeated amounts are
+    parsed once per distinct value.
+    """
+    memo = {}
+    result = []
+    for value in values:
+        if not isinstance(value, str):
+            result.append(parse_decimal(value))
+            continue
+        try:
+            result.append(memo[value])
+        except KeyError:
+            parsed = parse_decimal(value)
+            if len(memo) < memo_size:
+                memo[value] = parsed
+            result.append(parsed)
+    return result
+
+
+_plain_int = re.compile(r"[+-]?\d+(?:_\d+)*\Z").match
+_plain_decimal = re.compile(r"[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)\Z").match
+
+
+def is_int(value):
+    """Whether int(value) would succeed for a stripped string."""
+    return _plain_int(value) is not None
+
+
+def decimal_error(value):
+    """None if decimal.Decimal(value) would succeed, else the message of
+    the exception it raises. Plain numbers are checked without building a
+    Decimal.
+    """
+    if _plain_decimal(value):
+        return None
+    try:
+        decimal.Decimal(value)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+_nonzero_digit = re.compile("[1-9]").search
+
+
+def decimal_is_zero(value):
+    """Whether a string that Decimal accepts is zero."""
+    if _plain_decimal(value):
+        return not _nonzero_digit(value)
+    return decimal.Decimal(value) == 0
+
+
+@functools.lru_cache(maxsize=64)
+def _fixed_date_format(fmt):
+    """A pattern matching the zero padded form of a strptime format made
+    of %Y, %m, %d and literal characters, and the order of its groups, or
+    None for any other format.
+    """
+    parts = []
+    order = []
+    i = 0
+    while i < len(fmt):
+        if fmt[i] == "%":
+            directive = fmt[i + 1 : i + 2]
+            if directive not in ("Y", "m", "d"):
+                return None
+            parts.append("([0-9]{4})" if directive == "Y" else "([0-9]{2})")
+            order.append(directive)
+            i += 2
+        else:
+            if fmt[i].isspace():
+                return None
+            parts.append(re.escape(fmt[i]))
+            i += 1
+    if sorted(order) != ["Y", "d", "m"]:
+        return None
+    return re.compile("".join(parts) + r"\Z").match, tuple(order)
+
+
+_month_days = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def date_tuple(value, fmt):
+    """(year, month, day) of value parsed with the strptime format fmt, or
+    None if time.strptime would reject it. Zero padded numeric formats like
+    %Y%m%d are checked with a pattern instead of through strptime.
+    """
+    fixed = _fixed_date_format(fmt)
+    if fixed is not None:
+        match, order = fixed
+        found = match(value)
+        if found is not None:
+            if order == ("Y", "m", "d"):
+                year, month, day = map(int, found.groups())
+            else:
+                parts = dict(zip(order, map(int, found.groups())))
+                year, month, day = parts["Y"], parts["m"], parts["d"]
+            if year < 1 or not 1 <= month <= 12 or day < 1:
+                return None
+            if day > 28:
+                last = _month_days[month]
+                if month == 2 and year % 4 == 0 and (
+                    year % 100 != 0 or year % 400 == 0
+                ):
+                    last = 29
+                if day > last:
+                    return None
+            return year, month, day
+    try:
+        return time.strptime(value, fmt)[:3]
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(None)
+def logger():
+    """The "reclib" logger. logging imports threading, so it is only
+    imported once something logs, not with the parsers.
+    """
+    import logging
+
+    return logging.getLogger("reclib")
+
+
 def _findall(text, substr):
     # Also finds overlaps
     sites = []
@@ -53,16 +189,88 @@ def _findall(text, substr):
     return sites
 
 
+_strftime_memo = {}
+
+
+def strftime(dt, fmt, memo_size=4096):
+    """dt.strftime(fmt), also for years before 1900. Results are memoized
+    for up to memo_size keys of time tuple, time zone and format; not of
+    dt itself, since aware datetimes in different zones can compare equal.
+    """
+    key = (dt.timetuple(), getattr(dt, "tzinfo", None), fmt)
+    try:
+        return _strftime_memo[key]
+    except KeyError:
+        pass
+    text = _strftime(dt, fmt)
+    if len(_strftime_memo) < memo_size:
+        _strftime_memo[key] = text
+    return text
+
+
+def _strftime(dt, fmt):
+    if dt.year > 1900:
+        return time.strftime(fmt, dt.timetuple())
+    direct = _direct_format(fmt)
+    if direct is None:
+        return _strftime_shifted(dt, fmt)
+    template, getter = direct
+    timetuple = dt.timetuple()
+    return template % getter(timetuple[:6] + (timetuple[0] % 100,))
+
+
+# Directives that do not depend on the locale, as a %-format and an index
+# into a time tuple extended with the two digit year.
+_directives = {
+    "Y": ("%4d", 0),
+    "m": ("%02d", 1),
+    "d": ("%02d", 2),
+    "H": ("%02d", 3),
+    "M": ("%02d", 4),
+    "S": ("%02d", 5),
+    "y": ("%02d", 6),
+}
+
+
+@functools.lru_cache(maxsize=256)
+def _direct_format(fmt):
+    """Compile fmt into a %-template and an itemgetter for the values it
+    needs, or None if fmt uses a directive that _directives does not cover.
+    """
+    parts = []
+    indexes = []
+    pos = 0
+    while True:
+        i = fmt.find("%", pos)
+        if i == -1:
+            parts.append(fmt[pos:].replace("%", "%%"))
+            break
+        parts.append(fmt[pos:i])
+        directive = fmt[i + 1 : i + 2]
+        if directive == "%":
+            parts.append("%%")
+        elif directive in _directives:
+            spec, index = _directives[directive]
+            parts.append(spec)
+            indexes.append(index)
+        else:
+            return None
+        pos = i + 2
+    if len(indexes) > 1:
+        getter = operator.itemgetter(*indexes)
+    else:
+        # itemgetter returns a bare value for one index, not a tuple
+        getter = lambda t: tuple(t[i] for i in indexes)
+    return "".join(parts), getter
+
+
 # I hope I did this math right. Every 28 years the
 # calendar repeats, except through century leap years
 # excepting the 400 year leap years. But only if
 # you're using the Gregorian calendar.
 
 
-def strftime(dt, fmt):
-    if dt.year > 1900:
-        return time.strftime(fmt, dt.timetuple())
-
+def _strftime_shifted(dt, fmt):
     # WARNING: known bug with "%s", which is the number
     # of seconds since the epoch. This is too harsh
     # of a check. It should allow "%%s".
@@ -94,3 +302,321 @@ def strftime(dt, fmt):
     for site in sites:
         s = s[:site] + syear + s[site + 4 :]
     return s
+
+
+def csv_cell(value):
+    """The text of a parsed value in a delimited file: "" for None, ISO
+    dates and values of lists joined by spaces.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, list):
+        return " ".join(csv_cell(v) for v in value)
+    return str(value)
+
+
+def chunks(iterable, size):
+    """Yield lists of up to size items from iterable. If iterable raises
+    an error, the items read before it are yielded first.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = []
+        try:
+            chunk.extend(itertools.islice(it, size))
+        except Exception:
+            if chunk:
+                yield chunk
+            raise
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_map(executor, fn, iterable, ahead):
+    """Like executor.map, but submits at most ahead calls before their
+    results are consumed so that a long iterable is not read into memory
+    all at once. Results are yielded in order. An error reading iterable
+    is raised after the results of the items before it.
+    """
+    pending = collections.deque()
+    items = iter(iterable)
+    try:
+        while True:
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            except Exception:
+                while pending:
+                    yield pending.popleft().result()
+                raise
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def read_ahead(iterable, ahead=4):
+    """Yield the items of iterable, which is read in a thread of its own up
+    to ahead items before they are consumed. An error in the thread is
+    raised where the consumer reaches it. Closing the generator stops the
+    thread and waits for it, so a read in progress is finished first.
+    """
+    import queue
+    import threading
+
+    items = queue.Queue(ahead)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                put((True, item))
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class InternTable(object):
+    """Dedupes equal values so that a column with few distinct values
+    shares one object per value. Once more than limit distinct values have
+    been seen the column is taken to be high cardinality: the table is
+    dropped and values are passed through from then on.
+    """
+
+    def __init__(self, limit=4096):
+        self.limit = limit
+        self.table = {}
+        self.active = True
+
+    def __call__(self, value):
+        if not self.active:
+            return value
+        table = self.table
+        try:
+            return table[value]
+        except KeyError:
+            pass
+        except TypeError:
+            return value
+        if len(table) >= self.limit:
+            self.active = False
+            self.table = {}
+            return value
+        table[value] = value
+        return value
+
+
+def intern_table(option):
+    """The InternTable for a field's intern option: True for the default
+    limit or a number for a limit of its own. None if the option is off.
+    """
+    if option is True:
+        return InternTable()
+    if option:
+        return InternTable(option)
+    return None
+
+
+_magic = [
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+]
+
+
+def compression(file):
+    """The compression of file, "gzip", "bz2" or "xz", found from its first
+    bytes, or None for a plain file. file is a path or a buffered binary
+    file, which is peeked at rather than read so that its position does not
+    move.
+    """
+    if hasattr(file, "peek"):
+        head = file.peek(6)[:6]
+    else:
+        with open(file, "rb") as f:
+            head = f.read(6)
+    for magic, name in _magic:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _decompressor(name, file_obj):
+    if name == "gzip":
+        import gzip
+
+        return gzip.GzipFile(fileobj=file_obj, mode="rb")
+    if name == "bz2":
+        import bz2
+
+        return bz2.BZ2File(file_obj, "rb")
+    import lzma
+
+    return lzma.LZMAFile(file_obj, "rb")
+
+
+def open_input(
+    path,
+    mode="r",
+    encoding=None,
+    errors=None,
+    newline=None,
+    buffer_size=1 << 20,
+    threaded=False,
+):
+    """Open the file at path for reading like open, decompressing gzip,
+    bz2 and xz files on the fly. Compression is found from the first bytes
+    of the file, not its name.
+
+    Compressed files are read buffer_size bytes at a time. With threaded,
+    decompression runs in a thread of its own, ahead of the reader, so that
+    it overlaps with parsing; zlib, bz2 and lzma release the GIL while they
+    work.
+    """
+    if mode not in ("r", "rt", "rb"):
+        raise ValueError("open_input only reads: %r" % (mode,))
+    binary = mode == "rb"
+    # The file is opened once, so pipes and process substitutions can be
+    # read too: its first bytes are peeked at and left in the buffer.
+    raw = open(path, "rb", buffering=buffer_size)
+    try:
+        name = compression(raw)
+        if name is not None:
+            stream = _decompressor(name, raw)
+    except Exception:
+        raw.close()
+        raise
+    if name is None:
+        if binary:
+            return raw
+        return io.TextIOWrapper(raw, encoding, errors, newline)
+
+    if threaded:
+        source = _ThreadedSource(stream, raw, buffer_size)
+    else:
+        source = _Source(stream, raw)
+    buf = io.BufferedReader(source, buffer_size)
+    if binary:
+        return buf
+    return io.TextIOWrapper(buf, encoding, errors, newline)
+
+
+class _Source(io.RawIOBase):
+    """The decompressed bytes of stream. Closing it closes the compressed
+    file under stream too.
+    """
+
+    def __init__(self, stream, raw):
+        self._stream = stream
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._stream.readinto(b)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._stream.close()
+            finally:
+                self._raw.close()
+        super(_Source, self).close()
+
+
+class _ThreadedSource(_Source):
+    """A _Source that decompresses in a thread of its own, up to a few
+    blocks ahead of the reader. Errors in the thread are raised by the
+    read that reaches them.
+    """
+
+    ahead = 4
+
+    def __init__(self, stream, raw, block_size):
+        import queue
+        import threading
+
+        super(_ThreadedSource, self).__init__(stream, raw)
+        self._blocks = queue.Queue(self.ahead)
+        self._full = queue.Full
+        self._stop = threading.Event()
+        self._pending = memoryview(b"")
+        self._done = False
+        self._thread = threading.Thread(
+            target=self._run, args=(block_size,), daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, block_size):
+        try:
+            while not self._stop.is_set():
+                block = self._stream.read(block_size)
+                self._put(block)
+                if not block:
+                    return
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except self._full:
+                pass
+
+    def readinto(self, b):
+        if not self._pending:
+            if self._done:
+                return 0
+            block = self._blocks.get()
+            if isinstance(block, BaseException):
+                self._done = True
+                raise block
+            if not block:
+                self._done = True
+                return 0
+            self._pending = memoryview(block)
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+        super(_ThreadedSource, self).close()
@@ -2,8 +2,6 @@
 See reclib.test for usage
 """
 
-from builtins import str
-from builtins import object
 import datetime
 import time
 
@@ -15,14 +13,152 @@ class Validator(object):
         if checks:
             self.checks = checks
 
-    def validate(self, record):
-        result = RecordValidationResult()
+    def validate(self, record, context=None):
+        result = RecordValidationResult(context)
         for field in self.checks:
             field(record, result)
         return result
 
+    def validate_all(self, records):
+        """Validate many records in one run. Values parsed by the checks
+        are shared between checks and across records through a single
+        ValidationContext.
+        """
+        context = ValidationContext()
+        return [self.validate(record, context) for record in records]
+
+    def validate_parallel(self, records, jobs=None, chunk_size=2000):
+        """Validate records (a RecordSet or any iterable of records) in a
+        pool of jobs worker processes. Results are returned in record order,
+        like validate_all.
+
+        Workers are only sent the fields that the checks name in their field
+        attribute. If any check does not have one, whole records are sent.
+        When the checks cannot be pickled, or unpickled by the workers,
+        validation runs serially.
+        """
+        if jobs == 1:
+            return self.validate_all(records)
+        import pickle
+
+        try:
+            payload = pickle.dumps(list(self.checks))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return self.validate_all(records)
+
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+
+        from reclib.util import chunks, ordered_map
+
+        fields = _check_fields(self.checks)
+        if fields is None:
+            rows = (dict(r) for r in records)
+        else:
+            rows = (dict((f, r[f]) for f in fields if f in r) for r in records)
+
+        # Every worker checks against the same today as the whole run.
+        today = ValidationContext().today
+        results = []
+        with ProcessPoolExecutor(
+            jobs, initializer=_init_worker, initargs=(payload, today)
+        ) as pool:
+            # Workers unpickle the checks as they start, which can fail
+            # where pickling did not, as for classes defined in __main__
+            # under spawn. An empty chunk finds out before any record is
+            # read, so that validation can still run serially.
+            try:
+                pool.submit(_validate_chunk, []).result()
+            except BrokenProcessPool:
+                return self.validate_all(records)
+            batches = ordered_map(
+                pool, _validate_chunk, chunks(rows, chunk_size), (jobs or 4) * 2
+            )
+            for size, errors in batches:
+                start = len(results)
+                results.extend(RecordValidationResult() for i in range(size))
+                for idx, field, msg in errors:
+                    results[start + idx].append(RecordError(field, msg))
+        return results
+
+
+def _check_fields(checks):
+    """The record fields named by checks or None if it cannot be known."""
+    fields = []
+    for check in checks:
+        field = getattr(check, "field", None)
+        if field is None:
+            return None
+        if isinstance(field, (list, tuple)):
+            fields.extend(field)
+        else:
+            fields.append(field)
+    return list(dict.fromkeys(fields))
+
+
+_worker_checks = None
+_worker_today = None
+
+
+def _init_worker(payload, today=None):
+    global _worker_checks, _worker_today
+    import pickle
+
+    _worker_checks = pickle.loads(payload)
+    _worker_today = today
+
+
+def _validate_chunk(rows):
+    validator = Validator(*_worker_checks)
+    context = ValidationContext(_worker_today)
+    errors = []
+    for idx, row in enumerate(rows):
+        for error in validator.validate(row, context):
+            errors.append((idx, error.field, error.msg))
+    return len(rows), errors
+
+
+class ValidationContext(object):
+    """State shared by the checks of one validation run. Snapshots today's
+    date when created and memoizes parsed values so that a raw value is
+    parsed at most once per run no matter how many checks look at it.
+    """
+
+    max_size = 100000
+
+    def __init__(self, today=None):
+        if today is None:
+            today = datetime.date.today()
+        self.today = today
+        self._dates = {}
+
+    def date(self, value, format="%Y%m%d"):
+        """The datetime.date for value or None if it does not parse."""
+        key = (value, format)
+        try:
+            return self._dates[key]
+        except KeyError:
+            pass
+        try:
+            parsed = datetime.date(*time.strptime(value, format)[:3])
+        except ValueError:
+            parsed = None
+        if len(self._dates) >= self.max_size:
+            self._dates.clear()
+        self._dates[key] = parsed
+        return parsed
+
 
 class RecordValidationResult(list):
+    def __init__(self, context=None):
+        list.__init__(self)
+        self._context = context
+
+    @property
+    def context(self):
+        if self._context is None:
+            self._context = ValidationContext()
+        return self._context
 
     def error(self, field, msg, *a):
         if a:
@@ -109,9 +245,7 @@ class ISODate(object):
         if not value:
             return
 
-        try:
-            time.strptime(value, "%Y%m%d")
-        except ValueError:
+        if result.context.date(value) is None:
             result.error(fld, self.msg % value)
 
 
@@ -123,13 +257,11 @@ class DateInPast(object):
         value = record.get(self.field, "")
         if not value:
             return
-        try:
-            value = time.strptime(value, "%Y%m%d")
-        except ValueError:
+        context = result.context
+        value = context.date(value)
+        if value is None:
             return
-
-        value = datetime.date(*value[:3])
-        if value > datetime.date.today():
+        if value > context.today:
             result.error(self.field, "Value must be in the past.")
 
 
@@ -12,4 +12,5 @@ setup(
     url="http://bitrel.com",
     platforms="POSIX",
     packages=["reclib", "reclib.parse", "reclib.format"],
+    extras_require={"numpy": ["numpy"]},
 )